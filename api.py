@@ -1,20 +1,33 @@
 import requests
 import json
-import pandas as pd
+import hashlib
 import uuid
 import base64
 import os
 from datetime import datetime
+from collections import namedtuple
 from colorama import init, Fore, Style
 import threading
 import time
 import sys
 import random
+import tempfile
 from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 from urllib3.util.retry import Retry
 
+from sheet_reader import iter_sheet_rows
+from tracing import tracer
+from metrics import (HTTP_REQUESTS, HTTP_ERRORS, HTTP_REQUEST_SECONDS, HTTP_IN_FLIGHT, RANDOM_DELAY_SECONDS,
+                     API_ATTEMPTS, API_RETRIES, API_RETRY_WAIT_SECONDS, API_CALL_SECONDS, RESPONSE_BYTES,
+                     IMAGES_SAVED, IMAGE_BYTES_WRITTEN, IMAGE_SAVE_SECONDS, IMAGE_SIZE_BYTES, CONCURRENCY_LIMIT)
+
 API_URL = "http://62.171.131.164:5000"
 
+# Endpoint Google Labs / Whisk - có thể trỏ sang server giả lập (benchmarks/mock_whisk_server.py) qua biến môi trường
+LABS_BASE_URL = os.environ.get("WHISK_LABS_BASE_URL", "https://labs.google").rstrip("/")
+WHISK_API_BASE_URL = os.environ.get("WHISK_API_BASE_URL", "https://aisandbox-pa.googleapis.com").rstrip("/")
+
 # Khởi tạo colorama
 init(autoreset=True)
 
@@ -36,7 +49,214 @@ progress_lock = threading.Lock()
 seed_lock = threading.Lock()
 current_seed = 0  # Global seed counter for multi-threading
 
+def _resolve_log_value(value):
+    """Tính giá trị trì hoãn: callable được gọi, giá trị thường giữ nguyên"""
+    return value() if callable(value) else value
+
+class LazyLogger:
+    """Logger có cấu trúc với đối số trì hoãn - không format gì khi level đang tắt
+
+    Cách dùng:
+        log.debug("Headers: {}", lambda: dict(response.headers))
+        log.info("Đã lưu {}", filename, size=lambda: os.path.getsize(path))
+
+    Message dùng placeholder {} của str.format; đối số hoặc field là callable
+    chỉ được gọi khi level đang bật (vì vậy không truyền callable làm giá trị thật).
+    """
+
+    # Level -> cờ bật/tắt trong LogConfig (level không có ở đây luôn bật: error, user)
+    LEVEL_FLAGS = {'debug': 'DEBUG', 'info': 'INFO', 'success': 'SUCCESS', 'warning': 'WARNING'}
+
+    def __init__(self, config):
+        self.config = config
+
+    def is_enabled(self, level):
+        """Kiểm tra level có đang bật không (error và user luôn bật); không log khi không có stdout"""
+        if sys.stdout is None:
+            return False
+        flag = self.LEVEL_FLAGS.get(level)
+        return flag is None or getattr(self.config, flag)
+
+    def _emit(self, tag, color, message, args, fields):
+        message = _resolve_log_value(message)
+        if args:
+            message = str(message).format(*[_resolve_log_value(arg) for arg in args])
+        if fields:
+            message = f"{message} " + " ".join(f"{key}={_resolve_log_value(value)}" for key, value in fields.items())
+        with log_lock:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{Fore.CYAN}[{timestamp}] {color}[{tag}]{Style.RESET_ALL} {message}")
+
+    def debug(self, message, *args, **fields):
+        """Log debug chi tiết - chỉ hiển thị khi DEBUG = True"""
+        if self.is_enabled('debug'):
+            self._emit("DEBUG", Fore.BLUE, message, args, fields)
+
+    def info(self, message, *args, **fields):
+        """Log thông tin với thời gian và màu xanh"""
+        if self.is_enabled('info'):
+            self._emit("INFO", Fore.GREEN, message, args, fields)
+
+    def success(self, message, *args, **fields):
+        """Log thành công với thời gian và màu xanh lá"""
+        if self.is_enabled('success'):
+            self._emit("SUCCESS", Fore.GREEN, message, args, fields)
+
+    def warning(self, message, *args, **fields):
+        """Log cảnh báo với thời gian và màu vàng"""
+        if self.is_enabled('warning'):
+            self._emit("WARNING", Fore.YELLOW, message, args, fields)
+
+    def error(self, message, *args, **fields):
+        """Log lỗi với thời gian và màu đỏ - luôn hiển thị"""
+        if self.is_enabled('error'):
+            self._emit("ERROR", Fore.RED, message, args, fields)
+
+    def user(self, name, email):
+        """Log thông tin user với màu đặc biệt"""
+        if self.is_enabled('user'):
+            self._emit("USER", Fore.MAGENTA, f"{Fore.BLUE}{{}}{Style.RESET_ALL} <{Fore.CYAN}{{}}{Style.RESET_ALL}>", (name, email), None)
+
+log = LazyLogger(log_config)
+
 # ===== BROWSER SIMULATION SETTINGS =====
+# ===== HTTP SESSION POOL =====
+POOL_HOSTS = 4  # Số host giữ pool kết nối riêng: labs.google, aisandbox-pa.googleapis.com (+ proxy)
+
+def _release_session_on_close(response, pool, session):
+    """Trả session về pool khi response stream được đọc hết hoặc close() (chỉ một lần)"""
+    released = threading.Lock()  # Giữ luôn sau lần acquire đầu tiên: chỉ trả session một lần
+    close = response.close
+    iter_content = response.iter_content
+
+    def release():
+        if released.acquire(blocking=False):
+            pool.release(session)
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            release()
+
+    def iter_content_and_release(*args, **kwargs):
+        # .content, .text, .json() và iter_lines() đều đọc body qua iter_content
+        for chunk in iter_content(*args, **kwargs):
+            yield chunk
+        release()
+
+    response.close = close_and_release
+    response.iter_content = iter_content_and_release
+
+class HttpSessionPool:
+    """Pool các requests.Session dùng lại giữa các worker và giữa các lượt chạy
+
+    Mỗi request mượn một session rảnh (hit) hoặc tạo session mới nếu pool đang hết (miss), rồi trả lại.
+    Số session giữ lại bằng số worker nên kết nối keep-alive (TLS đã bắt tay) tới Google Labs/Whisk
+    luôn sẵn sàng cho lượt chạy sau.
+    """
+
+    def __init__(self, size=4):
+        self.size = max(1, int(size))
+        self._lock = threading.Lock()
+        self._idle = []
+        self._sessions = []  # Mọi session đang được giữ (để đếm kết nối, cập nhật proxy)
+        self._proxies = None
+        self._closed_counts = (0, 0)
+        self.hits = 0
+        self.misses = 0
+
+    def _create_session(self):
+        """Session chỉ tự thử lại lỗi kết nối; mỗi host giữ một kết nối
+
+        Retry theo mã HTTP (429/5xx) và lỗi đọc do WhiskRequestExecutor (BackoffPolicy) đảm nhận để số
+        lần thử và tín hiệu cho limiter đúng với từng request thực sự được gửi. Mỗi session chỉ phục vụ
+        một request tại một thời điểm (kể cả request stream: trả về pool khi đọc hết body) nên một kết
+        nối cho mỗi host là đủ.
+        """
+        session = requests.Session()
+        retry_strategy = Retry(total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.5)
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=POOL_HOSTS, pool_maxsize=1)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if self._proxies:
+            session.proxies.update(self._proxies)
+        return session
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+            self.misses += 1
+            session = self._create_session()
+            self._sessions.append(session)
+            return session
+
+    def release(self, session):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(session)
+                return
+            self._sessions.remove(session)
+        self._close([session])  # Thừa so với số worker - đóng kết nối
+
+    def resize(self, size):
+        """Đổi số session được giữ lại; session thừa đang rảnh được đóng"""
+        with self._lock:
+            self.size = max(1, int(size))
+            extra = self._idle[self.size:]
+            del self._idle[self.size:]
+            for session in extra:
+                self._sessions.remove(session)
+        self._close(extra)
+
+    def set_proxies(self, proxies):
+        with self._lock:
+            self._proxies = dict(proxies) if proxies else None
+            for session in self._sessions:
+                session.proxies.clear()
+                if proxies:
+                    session.proxies.update(proxies)
+
+    def stats(self):
+        """Số liệu pool: hit/miss khi mượn session, số kết nối mới và số request dùng lại kết nối cũ"""
+        with self._lock:
+            sessions = list(self._sessions)
+            stats = {'size': self.size, 'sessions': len(sessions), 'idle': len(self._idle),
+                     'hits': self.hits, 'misses': self.misses}
+            connections, requests_sent = self._closed_counts
+        for session in sessions:
+            session_connections, session_requests = _session_connection_counts(session)
+            connections += session_connections
+            requests_sent += session_requests
+        stats['connections'] = connections
+        stats['requests'] = requests_sent
+        stats['reused'] = max(requests_sent - connections, 0)
+        return stats
+
+    def _close(self, sessions):
+        """Đóng session thừa, giữ lại số đếm kết nối của chúng cho stats()"""
+        for session in sessions:
+            session_connections, session_requests = _session_connection_counts(session)
+            with self._lock:
+                connections, requests_sent = self._closed_counts
+                self._closed_counts = (connections + session_connections, requests_sent + session_requests)
+            session.close()
+
+def _session_connection_counts(session):
+    """(số kết nối đã mở, số request đã gửi) qua các pool urllib3 của session"""
+    connections = 0
+    requests_sent = 0
+    for adapter in {id(a): a for a in session.adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+    return connections, requests_sent
+
 class BrowserSimulator:
     """Lớp giả lập trình duyệt thật"""
     
@@ -49,30 +269,24 @@ class BrowserSimulator:
             "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
             "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Edge/120.0.0.0 Safari/537.36"
         ]
-        self.session = requests.Session()
         self.proxy_config = None
-        self._setup_session()
+        self.session_pool = HttpSessionPool()
+    
+    def configure_pool(self, size):
+        """Đặt số session (= số worker) được giữ sẵn kết nối keep-alive"""
+        self.session_pool.resize(size)
     
-    def _setup_session(self):
-        """Thiết lập session với retry strategy"""
-        retry_strategy = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session.mount("http://", adapter)
-        self.session.mount("https://", adapter)
+    def pool_stats(self):
+        return self.session_pool.stats()
     
     def set_proxy(self, proxy_config):
-        """Thiết lập proxy cho session"""
+        """Thiết lập proxy cho mọi session trong pool"""
         self.proxy_config = proxy_config
+        self.session_pool.set_proxies(proxy_config)
         if proxy_config:
-            self.session.proxies.update(proxy_config)
-            log_success("Đã thiết lập proxy thành công")
+            log.success("Đã thiết lập proxy thành công")
         else:
-            self.session.proxies.clear()
-            log_info("Đã xóa cấu hình proxy")
+            log.info("Đã xóa cấu hình proxy")
     
     def get_random_user_agent(self):
         """Lấy User-Agent ngẫu nhiên"""
@@ -133,7 +347,9 @@ class BrowserSimulator:
     def random_delay(self, min_delay=1, max_delay=3):
         """Delay ngẫu nhiên giữa các request"""
         delay = random.uniform(min_delay, max_delay)
-        time.sleep(delay)
+        with tracer.span("random_delay"):
+            time.sleep(delay)
+        RANDOM_DELAY_SECONDS.observe(delay)
         return delay
     
     def make_request(self, method, url, **kwargs):
@@ -151,52 +367,79 @@ class BrowserSimulator:
             kwargs['proxies'] = self.proxy_config
         
         # Random delay trước request
-        delay = self.random_delay()
+        self.random_delay()
+        host = urlsplit(url).netloc
         
         try:
-            log_debug(f"🔍 make_request:")
-            log_debug(f"  - Method: {method}")
-            log_debug(f"  - URL: {url}")
-            log_debug(f"  - Headers: {kwargs.get('headers', {})}")
-            log_debug(f"  - Proxies: {kwargs.get('proxies', 'None')}")
-            log_debug(f"  - Timeout: {kwargs.get('timeout', 'None')}")
+            log.debug("🔍 make_request:")
+            log.debug("  - Method: {}", method)
+            log.debug("  - URL: {}", url)
+            log.debug("  - Headers: {}", lambda: kwargs.get('headers', {}))
+            log.debug("  - Proxies: {}", lambda: kwargs.get('proxies', 'None'))
+            log.debug("  - Timeout: {}", lambda: kwargs.get('timeout', 'None'))
             
-            response = self.session.request(method, url, **kwargs)
+            # Mỗi request mượn riêng một session của pool (cookie/proxy không bị chia sẻ giữa các worker)
+            with tracer.span("session_acquire"):
+                session = self.session_pool.acquire()
+            HTTP_IN_FLIGHT.inc()
+            started = time.monotonic()
+            response = None
+            try:
+                # Gồm kết nối, gửi body, thời gian server xử lý và nhận header (cả body nếu không stream)
+                with tracer.span("http_request", method=method, host=host) as span:
+                    response = session.request(method, url, **kwargs)
+                    span.set(status=getattr(response, "status_code", None))
+            finally:
+                HTTP_IN_FLIGHT.dec()
+                if kwargs.get('stream') and response is not None:
+                    # Body chưa đọc vẫn giữ kết nối của session: chỉ trả session khi đọc hết hoặc close()
+                    _release_session_on_close(response, self.session_pool, session)
+                else:
+                    # Không stream: requests đã đọc xong body, kết nối đã về pool của session
+                    self.session_pool.release(session)
+            HTTP_REQUEST_SECONDS.observe(time.monotonic() - started, host=host)
+            HTTP_REQUESTS.inc(method=method, host=host, status=getattr(response, "status_code", "none"))
             
-            log_debug(f"🔍 make_request response:")
-            log_debug(f"  - Status: {response.status_code if response else 'None'}")
-            log_debug(f"  - Response object: {type(response)}")
+            log.debug("🔍 make_request response:")
+            log.debug("  - Status: {}", lambda: response.status_code if response else 'None')
+            log.debug("  - Response object: {}", lambda: type(response))
             
             # Kiểm tra response có hợp lệ không
             if response is None:
-                log_error("Response là None - không có phản hồi từ server")
+                log.error("Response là None - không có phản hồi từ server")
                 return None
             
-            # Log thêm thông tin response
-            log_debug(f"  - Response headers: {dict(response.headers)}")
-            log_debug(f"  - Response text length: {len(response.text) if response.text else 0}")
+            # Log thêm thông tin response (không đọc body khi stream để tránh nạp cả ảnh vào RAM)
+            log.debug("  - Response headers: {}", lambda: dict(response.headers))
+            if not kwargs.get('stream'):
+                log.debug("  - Response text length: {}", lambda: len(response.text) if response.text else 0)
             
             return response
             
         except requests.exceptions.ProxyError as e:
-            log_error(f"Lỗi proxy: {e}")
-            log_error("Kiểm tra lại cấu hình proxy trong proxy.txt")
+            HTTP_ERRORS.inc(host=host, kind="proxy")
+            log.error("Lỗi proxy: {}", e)
+            log.error("Kiểm tra lại cấu hình proxy trong proxy.txt")
             return None
         except requests.exceptions.Timeout as e:
-            log_error(f"Request timeout: {e}")
-            log_error("Thử tăng timeout hoặc kiểm tra kết nối mạng")
+            HTTP_ERRORS.inc(host=host, kind="timeout")
+            log.error("Request timeout: {}", e)
+            log.error("Thử tăng timeout hoặc kiểm tra kết nối mạng")
             return None
         except requests.exceptions.ConnectionError as e:
-            log_error(f"Lỗi kết nối: {e}")
-            log_error("Kiểm tra kết nối internet và proxy")
+            HTTP_ERRORS.inc(host=host, kind="connection")
+            log.error("Lỗi kết nối: {}", e)
+            log.error("Kiểm tra kết nối internet và proxy")
             return None
         except requests.exceptions.RequestException as e:
-            log_error(f"Lỗi request: {e}")
+            HTTP_ERRORS.inc(host=host, kind="request")
+            log.error("Lỗi request: {}", e)
             return None
         except Exception as e:
-            log_error(f"Lỗi không xác định: {e}")
+            HTTP_ERRORS.inc(host=host, kind="other")
+            log.error("Lỗi không xác định: {}", e)
             import traceback
-            log_error(f"Chi tiết lỗi: {traceback.format_exc()}")
+            log.error("Chi tiết lỗi: {}", traceback.format_exc())
             return None
 
 # Khởi tạo browser simulator
@@ -212,48 +455,6 @@ def activate_browser_simulation():
         print("  - Retry strategy cho request")
         print("  - Connection pooling")
 
-def log_debug(message):
-    """Log debug chi tiết - chỉ hiển thị khi DEBUG = True"""
-    if log_config.DEBUG and sys.stdout is not None:
-        with log_lock:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{Fore.CYAN}[{timestamp}] {Fore.BLUE}[DEBUG]{Style.RESET_ALL} {message}")
-
-def log_info(message):
-    """Log thông tin với thời gian và màu xanh"""
-    if log_config.INFO and sys.stdout is not None:
-        with log_lock:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{Fore.CYAN}[{timestamp}] {Fore.GREEN}[INFO]{Style.RESET_ALL} {message}")
-
-def log_success(message):
-    """Log thành công với thời gian và màu xanh lá"""
-    if log_config.SUCCESS and sys.stdout is not None:
-        with log_lock:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{Fore.CYAN}[{timestamp}] {Fore.GREEN}[SUCCESS]{Style.RESET_ALL} {message}")
-
-def log_error(message):
-    """Log lỗi với thời gian và màu đỏ - luôn hiển thị"""
-    if sys.stdout is not None:
-        with log_lock:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{Fore.CYAN}[{timestamp}] {Fore.RED}[ERROR]{Style.RESET_ALL} {message}")
-
-def log_warning(message):
-    """Log cảnh báo với thời gian và màu vàng"""
-    if log_config.WARNING and sys.stdout is not None:
-        with log_lock:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{Fore.CYAN}[{timestamp}] {Fore.YELLOW}[WARNING]{Style.RESET_ALL} {message}")
-
-def log_user_info(name, email):
-    """Log thông tin user với màu đặc biệt"""
-    if sys.stdout is not None:
-        with log_lock:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(f"{Fore.CYAN}[{timestamp}] {Fore.MAGENTA}[USER]{Style.RESET_ALL} {Fore.BLUE}{name}{Style.RESET_ALL} <{Fore.CYAN}{email}{Style.RESET_ALL}>")
-
 class LoadingSpinner:
     """Loading spinner với animation"""
     def __init__(self, message="Loading...", color=Fore.YELLOW):
@@ -262,10 +463,12 @@ class LoadingSpinner:
         self.spinner_chars = ['⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧', '⠇', '⠏']
         self.running = False
         self.thread = None
+        self._stopped = threading.Event()  # stop() đánh thức thread ngay thay vì chờ hết nhịp 0.1 giây
     
     def start(self):
         """Bắt đầu spinner"""
         self.running = True
+        self._stopped.clear()
         self.thread = threading.Thread(target=self._spin)
         self.thread.daemon = True
         self.thread.start()
@@ -273,6 +476,7 @@ class LoadingSpinner:
     def stop(self):
         """Dừng spinner"""
         self.running = False
+        self._stopped.set()
         if self.thread:
             self.thread.join()
         # Xóa dòng hiện tại - kiểm tra sys.stdout trước khi gọi write()
@@ -287,7 +491,7 @@ class LoadingSpinner:
             if sys.stdout is not None:
                 sys.stdout.write(f'\r{self.color}{self.spinner_chars[i % len(self.spinner_chars)]}{Style.RESET_ALL} {self.message}')
                 sys.stdout.flush()
-            time.sleep(0.1)
+            self._stopped.wait(0.1)
             i += 1
 
 def show_loading(message, duration=2):
@@ -297,69 +501,18 @@ def show_loading(message, duration=2):
     time.sleep(duration)
     spinner.stop()
 
-def get_thread_count():
-    """Lấy số luồng từ user input"""
-    if sys.stdout is not None:
-        print(f"\n{Fore.YELLOW}🧵 Cấu hình số luồng:{Style.RESET_ALL}")
-        print(f"{Fore.CYAN}Lưu ý:{Style.RESET_ALL} Số luồng cao hơn sẽ tạo ảnh nhanh hơn nhưng có thể gây quá tải server")
-        print(f"{Fore.CYAN}Khuyến nghị:{Style.RESET_ALL} 2-5 luồng cho hiệu suất tối ưu")
-    
-    while True:
-        try:
-            thread_input = input(f"\n{Fore.GREEN}Nhập số luồng (1-10, mặc định 3): {Style.RESET_ALL}").strip()
-            
-            if not thread_input:
-                return 3  # Mặc định 3 luồng
-            
-            thread_count = int(thread_input)
-            
-            if 1 <= thread_count <= 10:
-                log_success(f"Đã chọn {thread_count} luồng")
-                return thread_count
-            else:
-                if sys.stdout is not None:
-                    print(f"{Fore.RED}Số luồng phải từ 1 đến 10!{Style.RESET_ALL}")
-        except ValueError:
-            if sys.stdout is not None:
-                print(f"{Fore.RED}Vui lòng nhập số nguyên hợp lệ!{Style.RESET_ALL}")
-
-def get_output_folder():
-    """Lấy folder output từ user input"""
-    if sys.stdout is not None:
-        print(f"\n{Fore.YELLOW}📁 Chọn folder để lưu ảnh:{Style.RESET_ALL}")
-        print(f"{Fore.CYAN}1.{Style.RESET_ALL} Sử dụng folder hiện tại (./)")
-        print(f"{Fore.CYAN}2.{Style.RESET_ALL} Tạo folder mới")
-        print(f"{Fore.CYAN}3.{Style.RESET_ALL} Nhập đường dẫn folder")
-    
-    while True:
-        choice = input(f"\n{Fore.GREEN}Chọn (1/2/3): {Style.RESET_ALL}").strip()
-        
-        if choice == "1":
-            return "./"
-        elif choice == "2":
-            folder_name = input(f"{Fore.GREEN}Nhập tên folder mới: {Style.RESET_ALL}").strip()
-            if not folder_name:
-                folder_name = f"images_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            return folder_name
-        elif choice == "3":
-            folder_path = input(f"{Fore.GREEN}Nhập đường dẫn folder: {Style.RESET_ALL}").strip()
-            return folder_path
-        else:
-            if sys.stdout is not None:
-                print(f"{Fore.RED}Lựa chọn không hợp lệ! Vui lòng chọn 1, 2 hoặc 3.{Style.RESET_ALL}")
-
 def create_folder_if_not_exists(folder_path):
     """Tạo folder nếu chưa tồn tại"""
     if not os.path.exists(folder_path):
         try:
             os.makedirs(folder_path, exist_ok=True)
-            log_success(f"Đã tạo folder: {folder_path}")
+            log.success("Đã tạo folder: {}", folder_path)
             return True
         except Exception as e:
-            log_error(f"Không thể tạo folder {folder_path}: {e}")
+            log.error("Không thể tạo folder {}: {}", folder_path, e)
             return False
     else:
-        log_info(f"Folder đã tồn tại: {folder_path}")
+        log.info("Folder đã tồn tại: {}", folder_path)
         return True
 
 def read_cookie():
@@ -369,7 +522,7 @@ def read_cookie():
 
 def get_access_token(cookie):
     """Lấy access_token từ Google Labs API"""
-    url = "https://labs.google/fx/api/auth/session"
+    url = f"{LABS_BASE_URL}/fx/api/auth/session"
     headers = browser_sim.get_api_headers(cookie=cookie)
     
     # Hiển thị loading spinner
@@ -391,7 +544,7 @@ def get_access_token(cookie):
                 try:
                     # Parse ISO 8601 timestamp: "2025-09-22T03:46:30.000Z"
                     expires_str = data['expires']
-                    log_debug(f"Original expires string: {expires_str}")
+                    log.debug("Original expires string: {}", expires_str)
                     
                     # Xử lý timezone UTC
                     if expires_str.endswith('Z'):
@@ -407,8 +560,8 @@ def get_access_token(cookie):
                         
                         # Validation: Kiểm tra xem thời gian hết hạn có hợp lệ không
                         if expires_datetime <= current_time:
-                            log_error(f"Token đã hết hạn! Expires: {data['expires_at']}, Current: {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
-                            log_error("Token hết hạn - cần lấy cookie mới từ Google Labs")
+                            log.error("Token đã hết hạn! Expires: {}, Current: {}", data['expires_at'], current_time.strftime('%Y-%m-%d %H:%M:%S'))
+                            log.error("Token hết hạn - cần lấy cookie mới từ Google Labs")
                             # Token đã hết hạn, không tự tạo thời gian mới
                             data['expires_at'] = expires_datetime.strftime("%Y-%m-%d %H:%M:%S")
                             data['expires_in_seconds'] = 0
@@ -419,8 +572,8 @@ def get_access_token(cookie):
                             data['expires_in_seconds'] = int(time_diff.total_seconds())
                             data['token_expired'] = False
                         
-                        log_debug(f"Token expires at (from API, converted to local): {data['expires_at']}")
-                        log_debug(f"Token expires in seconds: {data['expires_in_seconds']}")
+                        log.debug("Token expires at (from API, converted to local): {}", lambda: data['expires_at'])
+                        log.debug("Token expires in seconds: {}", lambda: data['expires_in_seconds'])
                         
                     else:
                         # Nếu không có timezone info, parse trực tiếp
@@ -430,8 +583,8 @@ def get_access_token(cookie):
                         
                         # Validation
                         if expires_datetime <= current_time:
-                            log_error(f"Token đã hết hạn! Expires: {data['expires_at']}, Current: {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
-                            log_error("Token hết hạn - cần lấy cookie mới từ Google Labs")
+                            log.error("Token đã hết hạn! Expires: {}, Current: {}", data['expires_at'], current_time.strftime('%Y-%m-%d %H:%M:%S'))
+                            log.error("Token hết hạn - cần lấy cookie mới từ Google Labs")
                             # Token đã hết hạn, không tự tạo thời gian mới
                             data['expires_at'] = expires_datetime.strftime("%Y-%m-%d %H:%M:%S")
                             data['expires_in_seconds'] = 0
@@ -442,16 +595,16 @@ def get_access_token(cookie):
                             data['token_expired'] = False
                         
                 except Exception as e:
-                    log_error(f"Lỗi parse thời gian hết hạn: {e}")
-                    log_error(f"Expires string: {data.get('expires', 'None')}")
-                    log_error("Không thể parse thời gian hết hạn - cần lấy cookie mới")
+                    log.error("Lỗi parse thời gian hết hạn: {}", e)
+                    log.error("Expires string: {}", data.get('expires', 'None'))
+                    log.error("Không thể parse thời gian hết hạn - cần lấy cookie mới")
                     # Không tự tạo thời gian khi có lỗi parse
                     data['expires_at'] = 'Parse Error'
                     data['expires_in_seconds'] = 0
                     data['token_expired'] = True
             else:
                 # Nếu không có expires trong response, đánh dấu cần lấy cookie mới
-                log_warning("API response không có thông tin expires - cần lấy cookie mới")
+                log.warning("API response không có thông tin expires - cần lấy cookie mới")
                 data['expires_at'] = 'No Expires Info'
                 data['expires_in_seconds'] = 0
                 data['token_expired'] = True
@@ -461,232 +614,65 @@ def get_access_token(cookie):
             return data
         else:
             if response:
-                log_error(f"Lỗi khi lấy access_token: {response.status_code}")
-                log_error(response.text)
+                log.error("Lỗi khi lấy access_token: {}", response.status_code)
+                log.error(response.text)
             return None
     except requests.exceptions.Timeout:
         spinner.stop()
-        log_error("Timeout khi kết nối đến Google Labs")
+        log.error("Timeout khi kết nối đến Google Labs")
         return None
     except Exception as e:
         spinner.stop()
-        log_error(f"Lỗi kết nối: {e}")
+        log.error("Lỗi kết nối: {}", e)
         return None
 
 def read_excel_data(excel_file_path='prompt_image.xlsx'):
     """Đọc dữ liệu từ file Excel (STT, PROMPT)"""
     try:
-        df = pd.read_excel(excel_file_path)
-        stt_list = df.iloc[:, 0].tolist()  # Cột A
-        prompt_list = df.iloc[:, 1].tolist()  # Cột B
-        return list(zip(stt_list, prompt_list))
+        return [row[:2] for row in iter_sheet_rows(excel_file_path, width=2)]
     except Exception as e:
-        log_error(f"Lỗi khi đọc file Excel: {e}")
+        log.error("Lỗi khi đọc file Excel: {}", e)
         return []
 
 def read_excel_img2img_data(excel_file_path='prompt_image.xlsx'):
     """Đọc dữ liệu từ file Excel cho Image-to-Image (STT, PROMPT, IMAGE_PATH)"""
     try:
-        df = pd.read_excel(excel_file_path)
-        stt_list = df.iloc[:, 0].tolist()  # Cột A
-        prompt_list = df.iloc[:, 1].tolist()  # Cột B
-        image_path_list = df.iloc[:, 2].tolist()  # Cột C
-        return list(zip(stt_list, prompt_list, image_path_list))
+        return [row[:3] for row in iter_sheet_rows(excel_file_path, width=3)]
     except Exception as e:
-        log_error(f"Lỗi khi đọc file Excel: {e}")
+        log.error("Lỗi khi đọc file Excel: {}", e)
         return []
 
-def generate_image(access_token, prompt, seed, aspect_ratio="IMAGE_ASPECT_RATIO_LANDSCAPE", max_retries=3, output_folder=None):
-    """Gọi API để tạo ảnh với cơ chế retry"""
-    url = "https://aisandbox-pa.googleapis.com/v1/whisk:generateImage"
-    
+DEFAULT_IMAGE_MODEL = "IMAGEN_3_5"  # Model tạo ảnh (Prompt to Image / Image to Image)
+
+def generate_image(access_token, prompt, seed, aspect_ratio="IMAGE_ASPECT_RATIO_LANDSCAPE", max_retries=3, output_folder=None, limiter=None, defer_decode=False):
+    """Gọi API để tạo ảnh, trả về WhiskResult (result.data là JSON response)
+
+    limiter (AdaptiveConcurrencyLimiter) dùng chung giữa các worker của một lượt chạy.
+    defer_decode=True: chỉ lấy response thô (result.body), decode/ghi file ở pipeline phía sau.
+    """
     headers = browser_sim.get_api_headers(access_token=access_token)
     
     # Các thông số cố định
-    image_model = "IMAGEN_3_5"
+    image_model = DEFAULT_IMAGE_MODEL
     
-    for attempt in range(max_retries):
-        # Tạo UUID ngẫu nhiên cho workflowId mỗi lần retry
-        workflow_id = str(uuid.uuid4())
-        
-        payload = {
-            "clientContext": {
-                "workflowId": workflow_id,
-                "tool": "BACKBONE",
-                "sessionId": f";{uuid.uuid4().int}"
-            },
-            "imageModelSettings": {
-                "imageModel": image_model,
-                "aspectRatio": aspect_ratio
-            },
-            "seed": seed,
-            "prompt": prompt,
-            "mediaCategory": "MEDIA_CATEGORY_BOARD"
-        }
-        
-        # Hiển thị loading spinner
-        if attempt == 0:
-            spinner = LoadingSpinner("Đang tạo ảnh với AI...", Fore.MAGENTA)
-        else:
-            spinner = LoadingSpinner(f"Đang tạo ảnh với AI... (Thử lại lần {attempt + 1})", Fore.MAGENTA)
-        spinner.start()
-        
-        try:
-            if attempt > 0:
-                log_info(f"🔄 Thử lại lần {attempt + 1}/{max_retries}")
-                # Delay trước khi retry
-                time.sleep(2 * attempt)
-            
-            log_debug(f"🔍 Đang gọi API generate_image:")
-            log_debug(f"  - URL: {url}")
-            log_debug(f"  - Payload: {json.dumps(payload, indent=2)}")
-            
-            response = browser_sim.make_request("POST", url, headers=headers, json=payload, timeout=60)
-            spinner.stop()
-            
-            if response is None:
-                log_error("API trả về None - không có kết quả")
-                if attempt < max_retries - 1:
-                    log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                    continue
-                else:
-                    log_error("Có thể do:")
-                    log_error("  - Proxy không hoạt động")
-                    log_error("  - Kết nối mạng bị lỗi")
-                    log_error("  - Server Google Labs không phản hồi")
-                    log_error("  - Access token hết hạn")
-                    return None
-            
-            log_debug(f"🔍 API response:")
-            log_debug(f"  - Status code: {response.status_code}")
-            log_debug(f"  - Headers: {dict(response.headers)}")
-            log_debug(f"  - Response text: {response.text[:500]}...")  # Chỉ in 500 ký tự đầu
-            
-            if response.status_code == 200:
-                try:
-                    result = response.json()
-                    log_debug(f"🔍 JSON response:")
-                    log_debug(f"  - Response keys: {list(result.keys()) if result else 'None'}")
-                    if 'imagePanels' in result:
-                        log_debug(f"  - imagePanels count: {len(result['imagePanels'])}")
-                        for i, panel in enumerate(result['imagePanels']):
-                            log_debug(f"    Panel {i} keys: {list(panel.keys())}")
-                            if 'generatedImages' in panel:
-                                log_debug(f"    Panel {i} generatedImages count: {len(panel['generatedImages'])}")
-                                for j, img in enumerate(panel['generatedImages']):
-                                    log_debug(f"      Image {j} keys: {list(img.keys())}")
-                    return result
-                except Exception as json_error:
-                    log_error(f"Lỗi parse JSON: {json_error}")
-                    log_error(f"Response text gốc: {response.text}")
-                    if attempt < max_retries - 1:
-                        log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                        continue
-                    return None
-            elif response.status_code == 401:
-                log_error("Lỗi xác thực (401) - Access token có thể đã hết hạn")
-                log_error("Vui lòng cập nhật cookie mới trong ứng dụng")
-                log_error("Hướng dẫn: Vào tab 'Quản lý Tài khoản' -> Chọn tài khoản -> Click 'Checker' để kiểm tra")
-                log_error("Nếu vẫn lỗi, hãy thêm cookie mới từ Google Labs")
-                return None
-            elif response.status_code == 403:
-                log_error("Lỗi quyền truy cập (403) - Có thể bị chặn bởi Google")
-                if attempt < max_retries - 1:
-                    log_warning("Thử đổi proxy hoặc User-Agent và thử lại...")
-                    continue
-                else:
-                    log_error("Thử đổi proxy hoặc User-Agent")
-                    return None
-            elif response.status_code == 429:
-                # Parse error details from response
-                error_details = ""
-                try:
-                    error_data = response.json()
-                    if 'error' in error_data:
-                        error_info = error_data['error']
-                        error_code = error_info.get('code', 'Unknown')
-                        error_message = error_info.get('message', 'Unknown error')
-                        error_status = error_info.get('status', 'Unknown')
-                        
-                        # Check for specific error types
-                        if error_status == "RESOURCE_EXHAUSTED":
-                            log_error("🚫 Tài nguyên đã cạn kiệt - Quota đã hết")
-                            log_error("💡 Hướng dẫn: Chờ một lúc rồi thử lại hoặc sử dụng tài khoản khác")
-                        elif "PUBLIC_ERROR_USER_REQUESTS_THROTTLED" in str(error_info.get('details', [])):
-                            log_error("⏰ Quá nhiều request - Bị giới hạn tốc độ")
-                            log_error("💡 Hướng dẫn: Giảm số luồng hoặc chờ lâu hơn")
-                        else:
-                            log_error(f"Quá nhiều request (429) - {error_message}")
-                        
-                        error_details = f" - {error_message}"
-                    else:
-                        log_error("Quá nhiều request (429) - Bị rate limit")
-                except:
-                    log_error("Quá nhiều request (429) - Bị rate limit")
-                
-                if attempt < max_retries - 1:
-                    # Exponential backoff with jitter
-                    base_wait = 10 * (2 ** attempt)  # 10, 20, 40 seconds
-                    jitter = random.uniform(0.5, 1.5)  # Add randomness
-                    wait_time = int(base_wait * jitter)
-                    
-                    log_warning(f"⏳ Chờ {wait_time} giây rồi thử lại... (Lần {attempt + 1}/{max_retries})")
-                    log_warning("💡 Mẹo: Giảm số luồng để tránh bị rate limit")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    log_error("❌ Đã thử nhiều lần nhưng vẫn bị rate limit")
-                    log_error("🔧 Các giải pháp:")
-                    log_error("  1. Giảm số luồng xuống 1-2")
-                    log_error("  2. Chờ 5-10 phút rồi thử lại")
-                    log_error("  3. Sử dụng tài khoản khác")
-                    log_error("  4. Kiểm tra proxy có hoạt động tốt không")
-                    return None
-            elif response.status_code >= 500:
-                log_error(f"Lỗi server (5xx): {response.status_code}")
-                log_error("🔧 Các nguyên nhân có thể:")
-                log_error("  - Server Google Labs đang gặp sự cố")
-                log_error("  - Payload không đúng format")
-                log_error("  - MediaGenerationId không hợp lệ")
-                log_error("  - RawBytes bị lỗi format")
-                log_error("  - Prompt quá dài hoặc chứa ký tự đặc biệt")
-                
-                if attempt < max_retries - 1:
-                    wait_time = 10 * (attempt + 1)  # Tăng thời gian chờ cho lỗi 500
-                    log_warning(f"Chờ {wait_time} giây rồi thử lại...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    log_error("💡 Hướng dẫn khắc phục:")
-                    log_error("  1. Kiểm tra lại ảnh gốc có hợp lệ không")
-                    log_error("  2. Thử với prompt ngắn hơn")
-                    log_error("  3. Upload lại ảnh để lấy MediaGenerationId mới")
-                    log_error("  4. Thử với tài khoản khác")
-                    return None
-            else:
-                log_error(f"Lỗi HTTP không xác định: {response.status_code}")
-                log_error(f"Response text: {response.text}")
-                if attempt < max_retries - 1:
-                    log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                    continue
-                return None
-        except requests.exceptions.Timeout:
-            spinner.stop()
-            log_error("Timeout khi tạo ảnh - có thể prompt quá phức tạp")
-            if attempt < max_retries - 1:
-                log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                continue
-            return None
-        except Exception as e:
-            spinner.stop()
-            log_error(f"Lỗi khi tạo ảnh: {e}")
-            if attempt < max_retries - 1:
-                log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                continue
-            return None
+    payload = {
+        "clientContext": {
+            "workflowId": str(uuid.uuid4()),
+            "tool": "BACKBONE",
+            "sessionId": f";{uuid.uuid4().int}"
+        },
+        "imageModelSettings": {
+            "imageModel": image_model,
+            "aspectRatio": aspect_ratio
+        },
+        "seed": seed,
+        "prompt": prompt,
+        "mediaCategory": "MEDIA_CATEGORY_BOARD"
+    }
     
-    log_error(f"Đã thử {max_retries} lần nhưng vẫn thất bại")
-    return None
+    with tracer.trace("generate_image", seed=seed):
+        return generate_image_executor.execute(headers, payload, "Đang tạo ảnh với AI...",
+                                               max_attempts=max_retries, limiter=limiter, defer_decode=defer_decode)
 
 def download_image(image_url, filename):
     """Tải xuống ảnh"""
@@ -697,55 +683,795 @@ def download_image(image_url, filename):
         if response.status_code == 200:
             with open(filename, 'wb') as f:
                 f.write(response.content)
-            log_success(f"Đã tải xuống: {filename}")
+            log.success("Đã tải xuống: {}", filename)
             return True
     except Exception as e:
-        log_error(f"Lỗi khi tải xuống ảnh {filename}: {e}")
+        log.error("Lỗi khi tải xuống ảnh {}: {}", filename, e)
     return False
 
-def save_base64_image(base64_data, filename, output_folder="./"):
-    """Lưu ảnh từ base64 vào folder được chỉ định"""
-    full_path = os.path.join(output_folder, filename)
-    
+def record_image_saved(path, size, seconds=None):
+    """Cập nhật metrics cho một ảnh đã ghi ra đĩa (path: nhãn đường ghi, vd "pipeline")"""
+    IMAGES_SAVED.inc(path=path)
+    IMAGE_BYTES_WRITTEN.inc(size, path=path)
+    IMAGE_SIZE_BYTES.observe(size)
+    if seconds is not None:
+        IMAGE_SAVE_SECONDS.observe(seconds, path=path)
+
+# ===== RESPONSE DECODER =====
+STREAM_CHUNK_SIZE = 64 * 1024  # Kích thước mỗi chunk đọc từ response và đưa vào decoder
+STREAM_PLACEHOLDER = "__decoded_image__"  # Giá trị thay thế encodedImage trong metadata
+
+# Ảnh đã giải mã ra file .part ở giai đoạn decode, chờ giai đoạn disk đổi tên (xem write_image_file)
+DecodedImage = namedtuple('DecodedImage', 'full_path part_path size write_seconds sha256')
+
+class _Base64FileSink:
+    """Giải mã base64 theo từng chunk và ghi thẳng ra file .part (không giữ cả ảnh trong bộ nhớ)"""
+
+    def __init__(self, full_path):
+        self.full_path = full_path
+        self.part_path = f"{full_path}.part" if full_path else None
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+        self._hasher = hashlib.sha256()  # sha256 của nội dung ảnh, tính khi ghi (không phải đọc lại file)
+        self._pending = b""
+        self._prefix_checked = False
+        self._file = None
+        if full_path:
+            folder = os.path.dirname(full_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._file = open(self.part_path, 'wb')
+
+    def write(self, data):
+        """Nhận một đoạn base64 (bytes), giải mã phần đủ bội số 4 ký tự"""
+        if not data:
+            return
+        data = self._pending + data
+        if not self._prefix_checked:
+            # Loại bỏ prefix data:image/jpeg;base64, nếu có
+            if data.startswith(b"data:") or b"data:".startswith(data):
+                comma = data.find(b",")
+                if comma == -1:
+                    self._pending = data
+                    return
+                data = data[comma + 1:]
+            self._prefix_checked = True
+        usable = len(data) - (len(data) % 4)
+        self._pending = data[usable:]
+        if usable and self._file:
+            self._write_decoded(base64.b64decode(data[:usable]))
+
+    def _write_decoded(self, decoded):
+        self._hasher.update(decoded)
+        started = time.monotonic()
+        self._file.write(decoded)
+        self.write_seconds += time.monotonic() - started
+        self.bytes_written += len(decoded)
+
+    def close(self):
+        """Giải mã phần còn lại và đóng file .part (giai đoạn disk đổi tên thành file đích)"""
+        if self._pending:
+            padded = self._pending + b"=" * (-len(self._pending) % 4)
+            self._pending = b""
+            if self._file:
+                self._write_decoded(base64.b64decode(padded))
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def decoded_image(self):
+        return DecodedImage(self.full_path, self.part_path, self.bytes_written, self.write_seconds,
+                            self._hasher.hexdigest())
+
+    def abort(self):
+        """Hủy ghi và xóa file .part (kể cả khi ảnh đã giải mã xong nhưng body phía sau lỗi)"""
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.part_path:
+            discard_part_file(self.part_path)
+
+def discard_part_file(part_path):
     try:
-        # Log thông tin debug
-        log_info(f"Đang lưu ảnh: {filename}")
-        log_info(f"Thư mục đích: {output_folder}")
-        log_info(f"Đường dẫn đầy đủ: {full_path}")
-        
-        # Kiểm tra thư mục có tồn tại không
-        if not os.path.exists(output_folder):
-            log_info(f"Tạo thư mục: {output_folder}")
+        os.remove(part_path)
+    except OSError:
+        pass
+
+class EncodedImageStreamDecoder:
+    """Tokenizer JSON tăng dần: ghi imagePanels[*].generatedImages[*].encodedImage thẳng ra file,
+    chỉ giữ lại metadata nhỏ trong bộ nhớ"""
+
+    def __init__(self, image_path_for, sink_factory=_Base64FileSink):
+        # image_path_for(panel_index, image_index, ordinal) -> đường dẫn file hoặc None (bỏ qua ảnh)
+        # ordinal: thứ tự (từ 0) của ảnh trong response này
+        self.image_path_for = image_path_for
+        self._ordinal = 0
+        self.sink_factory = sink_factory
+        self.saved_images = {}  # (panel_index, image_index) -> (full_path, bytes_written)
+        self.sinks = {}         # (panel_index, image_index) -> sink đã đóng
+        self._kept = bytearray()
+        self._stack = []  # Mỗi frame: [kind, key, index, expect_key]
+        self._in_string = False
+        self._string_role = None  # 'key' | 'value' | 'target'
+        self._key_buf = bytearray()
+        self._escape = False
+        self._sink = None
+        self._target_index = None
+
+    def feed(self, chunk):
+        """Xử lý một chunk bytes từ response"""
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if self._in_string:
+                i = self._consume_string(chunk, i, n)
+                continue
+            c = chunk[i]
+            if c == 0x22:  # '"'
+                self._start_string()
+            elif c == 0x7B or c == 0x5B:  # '{' hoặc '['
+                if c == 0x7B:
+                    self._stack.append(['{', None, 0, True])
+                else:
+                    self._stack.append(['[', None, 0, False])
+                self._kept.append(c)
+            elif c == 0x7D or c == 0x5D:  # '}' hoặc ']'
+                if self._stack:
+                    self._stack.pop()
+                self._kept.append(c)
+            elif c == 0x2C:  # ','
+                if self._stack:
+                    frame = self._stack[-1]
+                    if frame[0] == '{':
+                        frame[3] = True
+                    else:
+                        frame[2] += 1
+                self._kept.append(c)
+            elif c == 0x3A:  # ':'
+                if self._stack:
+                    self._stack[-1][3] = False
+                self._kept.append(c)
+            else:
+                self._kept.append(c)
+            i += 1
+
+    def _start_string(self):
+        self._in_string = True
+        frame = self._stack[-1] if self._stack else None
+        if frame is not None and frame[0] == '{' and frame[3]:
+            self._string_role = 'key'
+            self._key_buf = bytearray()
+            return
+        target = self._match_target()
+        if target is not None:
+            self._string_role = 'target'
+            self._target_index = target
+            self._sink = self.sink_factory(self.image_path_for(*target, self._ordinal))
+            self._ordinal += 1
+        else:
+            self._string_role = 'value'
+            self._kept.append(0x22)
+
+    def _match_target(self):
+        """Trả về (panel_index, image_index) nếu đang ở vị trí ...imagePanels[p].generatedImages[i].encodedImage"""
+        s = self._stack
+        if len(s) < 5:
+            return None
+        if (s[-1][0] == '{' and s[-1][1] == 'encodedImage'
+                and s[-2][0] == '['
+                and s[-3][0] == '{' and s[-3][1] == 'generatedImages'
+                and s[-4][0] == '['
+                and s[-5][0] == '{' and s[-5][1] == 'imagePanels'):
+            return (s[-4][2], s[-2][2])
+        return None
+
+    def _emit(self, data):
+        if not data:
+            return
+        if self._string_role == 'target':
+            self._sink.write(data)
+        elif self._string_role == 'key':
+            self._key_buf += data
+        else:
+            self._kept += data
+
+    def _consume_string(self, chunk, i, n):
+        if self._escape:
+            self._escape = False
+            if self._string_role == 'target':
+                # Base64 chỉ có thể chứa escape '\/'; bỏ qua các escape khoảng trắng
+                if chunk[i] == 0x2F:
+                    self._sink.write(b"/")
+            else:
+                self._emit(b"\\" + chunk[i:i + 1])
+            return i + 1
+        quote = chunk.find(b'"', i)
+        backslash = chunk.find(b'\\', i, quote if quote != -1 else n)
+        if backslash != -1:
+            self._emit(chunk[i:backslash])
+            self._escape = True
+            return backslash + 1
+        if quote == -1:
+            self._emit(chunk[i:n])
+            return n
+        self._emit(chunk[i:quote])
+        self._end_string()
+        return quote + 1
+
+    def _end_string(self):
+        self._in_string = False
+        role = self._string_role
+        self._string_role = None
+        if role == 'key':
+            self._stack[-1][1] = json.loads(b'"' + bytes(self._key_buf) + b'"')
+            self._kept += b'"' + self._key_buf + b'"'
+        elif role == 'target':
+            sink = self._sink
+            self._sink = None
+            sink.close()
+            if sink.full_path:
+                self.saved_images[self._target_index] = (sink.full_path, sink.bytes_written)
+                self.sinks[self._target_index] = sink
+            self._kept += json.dumps(STREAM_PLACEHOLDER).encode()
+        else:
+            self._kept.append(0x22)
+
+    def abort(self):
+        """Hủy mọi ảnh đã ghi (khi body lỗi): xóa file .part của ảnh đang ghi dở và ảnh đã xong"""
+        if self._sink:
+            self._sink.abort()
+            self._sink = None
+        for sink in self.sinks.values():
+            sink.abort()
+        self.sinks = {}
+
+    def finish(self):
+        """Parse phần metadata còn lại và gắn savedPath vào từng ảnh đã lưu"""
+        if self._in_string or self._stack:
+            self.abort()
+            raise ValueError("Response JSON bị cắt ngang")
+        result = json.loads(bytes(self._kept))
+        self._kept = bytearray()
+        _attach_saved_paths(result, self.saved_images)
+        return result
+
+def _attach_saved_paths(node, saved_images):
+    """Thay encodedImage placeholder bằng savedPath/savedBytes trong mọi imagePanels"""
+    if isinstance(node, dict):
+        if isinstance(node.get('imagePanels'), list):
+            for p, panel in enumerate(node['imagePanels']):
+                images = panel.get('generatedImages') if isinstance(panel, dict) else None
+                for j, img in enumerate(images or []):
+                    if isinstance(img, dict) and img.get('encodedImage') == STREAM_PLACEHOLDER:
+                        del img['encodedImage']
+                        if (p, j) in saved_images:
+                            img['savedPath'], img['savedBytes'] = saved_images[(p, j)]
+        for value in node.values():
+            if isinstance(value, (dict, list)):
+                _attach_saved_paths(value, saved_images)
+    elif isinstance(node, list):
+        for value in node:
+            if isinstance(value, (dict, list)):
+                _attach_saved_paths(value, saved_images)
+
+def decode_deferred_body(result, image_path_for):
+    """Giai đoạn decode của một result lấy bằng defer_decode=True
+
+    Đọc body (file tạm do giai đoạn network ghi) theo từng chunk qua tokenizer, encodedImage được giải mã thẳng ra file .part. Trả về
+    danh sách DecodedImage chờ giai đoạn disk đổi tên (write_image_file); result.data được gán
+    metadata kèm savedPath. Lỗi parse làm result chuyển thành BAD_RESPONSE, file .part bị xóa và
+    danh sách trả về rỗng (image_pipeline gửi lại request để thử lại).
+    """
+    body, result.body = result.body, None
+    decoder = EncodedImageStreamDecoder(image_path_for)
+    try:
+        with tracer.span("json_base64_decode", bytes=result.body_size):
+            for chunk in iter(lambda: body.read(STREAM_CHUNK_SIZE), b""):
+                decoder.feed(chunk)
+            data = decoder.finish()
+        if result.unwrap:
+            data = result.unwrap(data)
+    except Exception as e:
+        decoder.abort()
+        log.error("Lỗi parse JSON: {}", e)
+        result.outcome = RequestOutcome.BAD_RESPONSE
+        result.error_message = str(e)
+        return []
+    finally:
+        body.close()
+    result.data = data
+    return [sink.decoded_image() for sink in decoder.sinks.values()]
+
+def write_image_file(image):
+    """Giai đoạn disk: đổi tên file .part (DecodedImage đã giải mã xong) thành file ảnh đích
+
+    Trả về sha256 của ảnh (đã tính khi giải mã) để ghi catalog/result cache mà không đọc lại file.
+    """
+    started = time.monotonic()
+    try:
+        with tracer.span("disk_write", bytes=image.size):
+            os.replace(image.part_path, image.full_path)
+    except Exception:
+        discard_part_file(image.part_path)
+        raise
+    record_image_saved("pipeline", image.size, image.write_seconds + time.monotonic() - started)
+    return image.sha256
+
+def variant_filename(filename, variant):
+    """Tên file của biến thể thứ variant (1 = ảnh đầu tiên, giữ nguyên tên): STT_PROMPT_v2.jpg, ..."""
+    if variant <= 1:
+        return filename
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}_v{variant}{ext}"
+
+def all_images_target(output_folder, filename):
+    """Tạo image_path_for lưu mọi ảnh (biến thể) của response vào output_folder
+
+    Tên file chỉ phụ thuộc thứ tự của ảnh trong response (ordinal do decoder/result cache truyền vào):
+    ảnh đầu tiên dùng đúng filename, các ảnh tiếp theo là filename_v2, filename_v3, ...
+    Không giữ trạng thái nên dùng lại được cho lần thử sau hoặc khi lấy từ cache thất bại.
+    """
+    def image_path_for(panel_index, image_index, ordinal):
+        return os.path.join(output_folder or "./", variant_filename(filename, ordinal + 1))
+
+    return image_path_for
+
+def iter_saved_images(result):
+    """Duyệt các ảnh đã được lưu ra đĩa (có savedPath) trong result"""
+    for panel in (result or {}).get('imagePanels', []):
+        for img in panel.get('generatedImages', []):
+            if img.get('savedPath'):
+                yield img
+
+# ===== REQUEST EXECUTOR =====
+class RequestOutcome:
+    """Phân loại kết quả của một request tới Whisk API"""
+    SUCCESS = "success"
+    AUTH_ERROR = "auth_error"            # 401 - token/cookie hết hạn
+    FORBIDDEN = "forbidden"              # 403 - bị chặn
+    RATE_LIMITED = "rate_limited"        # 429 - rate limit hoặc hết quota
+    SERVER_ERROR = "server_error"        # 5xx
+    HTTP_ERROR = "http_error"            # Mã HTTP khác
+    BAD_RESPONSE = "bad_response"        # 200 nhưng không parse được
+    TRANSPORT_ERROR = "transport_error"  # Timeout, lỗi kết nối, proxy
+    INVALID_INPUT = "invalid_input"      # Dữ liệu đầu vào không hợp lệ, không gửi request
+
+class WhiskResult:
+    """Kết quả có kiểu của WhiskRequestExecutor (thay cho None khi lỗi)"""
+
+    def __init__(self, outcome, data=None, status_code=None, error_status=None, error_message="",
+                 attempts=0, retry_after=None, elapsed=0.0):
+        self.outcome = outcome
+        self.data = data
+        self.status_code = status_code
+        self.error_status = error_status      # error.status trong body, vd: RESOURCE_EXHAUSTED
+        self.error_message = error_message
+        self.attempts = attempts
+        self.retry_after = retry_after        # Số giây server yêu cầu chờ (nếu có)
+        self.elapsed = elapsed
+        self.body = None                      # File tạm chứa response thô chưa decode (defer_decode=True)
+        self.body_size = 0                    # Số byte của body
+        self.unwrap = None                    # unwrap của executor, áp dụng khi decode body
+        self.from_cache = False               # True nếu ảnh lấy từ result cache (không gọi API)
+
+    @property
+    def ok(self):
+        return self.outcome == RequestOutcome.SUCCESS
+
+    def __bool__(self):
+        return self.ok
+
+    @property
+    def is_auth_error(self):
+        return self.outcome == RequestOutcome.AUTH_ERROR
+
+    @property
+    def is_rate_limited(self):
+        return self.outcome == RequestOutcome.RATE_LIMITED
+
+    @property
+    def is_quota_exhausted(self):
+        return self.outcome == RequestOutcome.RATE_LIMITED and self.error_status == "RESOURCE_EXHAUSTED"
+
+    @property
+    def is_server_error(self):
+        return self.outcome == RequestOutcome.SERVER_ERROR
+
+    @property
+    def is_transport_error(self):
+        return self.outcome == RequestOutcome.TRANSPORT_ERROR
+
+    def describe(self):
+        """Mô tả ngắn gọn nguyên nhân lỗi để hiển thị cho người dùng"""
+        if self.ok:
+            return "Thành công"
+        if self.is_quota_exhausted:
+            return "Tài nguyên đã cạn kiệt - Quota hết (429 RESOURCE_EXHAUSTED)"
+        descriptions = {
+            RequestOutcome.AUTH_ERROR: "Access token/cookie hết hạn (401)",
+            RequestOutcome.FORBIDDEN: "Bị chặn quyền truy cập (403)",
+            RequestOutcome.RATE_LIMITED: "Quá nhiều request - Rate limit (429)",
+            RequestOutcome.SERVER_ERROR: f"Lỗi server ({self.status_code})",
+            RequestOutcome.HTTP_ERROR: f"Lỗi HTTP {self.status_code}",
+            RequestOutcome.BAD_RESPONSE: "Response không hợp lệ",
+            RequestOutcome.TRANSPORT_ERROR: "Lỗi kết nối/timeout/proxy",
+            RequestOutcome.INVALID_INPUT: "Dữ liệu đầu vào không hợp lệ",
+        }
+        text = descriptions.get(self.outcome, self.outcome)
+        if self.error_message:
+            text = f"{text} - {self.error_message}"
+        return text
+
+    def __repr__(self):
+        return f"WhiskResult(outcome={self.outcome!r}, status_code={self.status_code!r}, attempts={self.attempts})"
+
+class BackoffPolicy:
+    """Chính sách retry/backoff, có thể tinh chỉnh theo từng endpoint"""
+
+    def __init__(self, max_attempts=3, base_delay=2.0, rate_limit_delay=10.0, server_error_delay=10.0,
+                 max_delay=120.0, jitter=0.5, retry_on=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay                  # Lỗi chung: base_delay * (attempt + 1)
+        self.rate_limit_delay = rate_limit_delay      # 429: rate_limit_delay * 2^attempt
+        self.server_error_delay = server_error_delay  # 5xx: server_error_delay * (attempt + 1)
+        self.max_delay = max_delay
+        self.jitter = jitter                          # Hệ số ngẫu nhiên ±jitter cho 429
+        self.retry_on = set(retry_on) if retry_on is not None else {
+            RequestOutcome.FORBIDDEN, RequestOutcome.RATE_LIMITED, RequestOutcome.SERVER_ERROR,
+            RequestOutcome.HTTP_ERROR, RequestOutcome.BAD_RESPONSE, RequestOutcome.TRANSPORT_ERROR,
+        }
+
+    def should_retry(self, result, attempt):
+        """attempt tính từ 0"""
+        return result.outcome in self.retry_on and attempt + 1 < self.max_attempts
+
+    def delay_for(self, result, attempt):
+        """Số giây chờ trước lần thử tiếp theo - ưu tiên Retry-After của server"""
+        if result.retry_after is not None:
+            return min(max(result.retry_after, 0.0), self.max_delay)
+        if result.outcome == RequestOutcome.RATE_LIMITED:
+            delay = self.rate_limit_delay * (2 ** attempt)
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        elif result.outcome == RequestOutcome.SERVER_ERROR:
+            delay = self.server_error_delay * (attempt + 1)
+        else:
+            delay = self.base_delay * (attempt + 1)
+        return min(delay, self.max_delay)
+
+    def with_max_attempts(self, max_attempts):
+        """Tạo bản sao với số lần thử khác (dùng cho tham số max_retries cũ)"""
+        if max_attempts is None or max_attempts == self.max_attempts:
+            return self
+        return BackoffPolicy(max_attempts, self.base_delay, self.rate_limit_delay, self.server_error_delay,
+                             self.max_delay, self.jitter, self.retry_on)
+
+def parse_retry_after(response, error_info=None):
+    """Đọc thời gian chờ từ header Retry-After hoặc RetryInfo.retryDelay trong body lỗi"""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                from email.utils import parsedate_to_datetime
+                retry_at = parsedate_to_datetime(value)
+                return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+            except Exception:
+                pass
+    for detail in (error_info or {}).get('details', []) or []:
+        if isinstance(detail, dict) and 'retryDelay' in detail:
+            try:
+                return float(str(detail['retryDelay']).rstrip('s'))
+            except ValueError:
+                pass
+    return None
+
+def _read_error_info(response):
+    """Lấy object error trong body JSON (nếu có)"""
+    try:
+        error_data = response.json()
+    except Exception:
+        return {}
+    if isinstance(error_data, dict) and isinstance(error_data.get('error'), dict):
+        return error_data['error']
+    if isinstance(error_data, list) and error_data and isinstance(error_data[0], dict):
+        # tRPC trả về danh sách lỗi: [{"error": {"json": {...}}}]
+        error = error_data[0].get('error', {})
+        return error.get('json', error) if isinstance(error, dict) else {}
+    return {}
+
+def classify_response(response):
+    """Phân loại response lỗi (status != 200) thành WhiskResult chưa có data"""
+    status = response.status_code
+    if status == 401:
+        return WhiskResult(RequestOutcome.AUTH_ERROR, status_code=status)
+    if status == 403:
+        return WhiskResult(RequestOutcome.FORBIDDEN, status_code=status)
+    error_info = _read_error_info(response) if status == 429 or status >= 500 else {}
+    error_status = error_info.get('status')
+    message = error_info.get('message', '')
+    retry_after = parse_retry_after(response, error_info)
+    if status == 429 or error_status == "RESOURCE_EXHAUSTED":
+        return WhiskResult(RequestOutcome.RATE_LIMITED, status_code=status, error_status=error_status,
+                           error_message=message, retry_after=retry_after)
+    if status >= 500:
+        return WhiskResult(RequestOutcome.SERVER_ERROR, status_code=status, error_status=error_status,
+                           error_message=message, retry_after=retry_after)
+    return WhiskResult(RequestOutcome.HTTP_ERROR, status_code=status)
+
+def _log_failure_hints(result):
+    """In hướng dẫn khắc phục khi đã hết số lần thử"""
+    if result.is_auth_error:
+        log.error("Vui lòng cập nhật cookie mới trong ứng dụng")
+        log.error("Hướng dẫn: Vào tab 'Quản lý Tài khoản' -> Chọn tài khoản -> Click 'Checker' để kiểm tra")
+        log.error("Nếu vẫn lỗi, hãy thêm cookie mới từ Google Labs")
+    elif result.is_quota_exhausted:
+        log.error("💡 Hướng dẫn: Chờ một lúc rồi thử lại hoặc sử dụng tài khoản khác")
+    elif result.is_rate_limited:
+        log.error("🔧 Các giải pháp:")
+        log.error("  1. Giảm số luồng xuống 1-2")
+        log.error("  2. Chờ 5-10 phút rồi thử lại")
+        log.error("  3. Sử dụng tài khoản khác")
+        log.error("  4. Kiểm tra proxy có hoạt động tốt không")
+    elif result.outcome == RequestOutcome.FORBIDDEN:
+        log.error("Thử đổi proxy hoặc User-Agent")
+    elif result.is_server_error:
+        log.error("🔧 Các nguyên nhân có thể:")
+        log.error("  - Server Google Labs đang gặp sự cố")
+        log.error("  - Payload không đúng format hoặc MediaGenerationId không hợp lệ")
+        log.error("  - Prompt quá dài hoặc chứa ký tự đặc biệt")
+    elif result.is_transport_error:
+        log.error("Có thể do:")
+        log.error("  - Proxy không hoạt động")
+        log.error("  - Kết nối mạng bị lỗi")
+        log.error("  - Server Google Labs không phản hồi")
+
+# ===== ADAPTIVE CONCURRENCY =====
+class AdaptiveConcurrencyLimiter:
+    """Giới hạn số request đồng thời theo kiểu AIMD, dùng chung cho mọi worker trong một lượt chạy
+
+    - 429/RESOURCE_EXHAUSTED: giảm nhân (limit * decrease_factor) và tạm dừng tất cả worker
+      trong thời gian cooldown (ưu tiên Retry-After của server).
+    - Thành công với độ trễ bình thường: tăng cộng (~+1 sau mỗi `limit` request thành công).
+    - max_limit (số luồng trên GUI) là trần, không phải con số cố định.
+    """
+
+    def __init__(self, max_limit, min_limit=1, initial_limit=None, decrease_factor=0.5, increase_step=1.0,
+                 default_cooldown=10.0, latency_tolerance=2.5, on_change=None):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self.default_cooldown = default_cooldown
+        self.latency_tolerance = latency_tolerance  # Độ trễ > tolerance * độ trễ tốt nhất thì không tăng
+        self.on_change = on_change                  # callback(limit, reason) khi limit (làm tròn) thay đổi
+        self._limit = float(initial_limit if initial_limit is not None else self.max_limit)
+        self._limit = min(max(self._limit, self.min_limit), self.max_limit)
+        self._in_flight = 0
+        self._cooldown_until = 0.0
+        self._last_decrease = 0.0
+        self._best_latency = None
+        self._cond = threading.Condition()
+        CONCURRENCY_LIMIT.set(int(self._limit))
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def cooldown_remaining(self):
+        return max(0.0, self._cooldown_until - time.monotonic())
+
+    def acquire(self):
+        """Chờ tới khi hết cooldown và còn slot trống"""
+        with self._cond:
+            while True:
+                wait = self._cooldown_until - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                if self._in_flight < int(self._limit):
+                    self._in_flight += 1
+                    return
+                self._cond.wait()
+
+    def release(self, result=None, latency=None, cooldown=None):
+        """Trả slot và điều chỉnh limit theo kết quả (WhiskResult) của request"""
+        reason = None
+        decreased = False
+        with self._cond:
+            self._in_flight -= 1
+            old_limit = int(self._limit)
+            now = time.monotonic()
+            if result is not None and result.is_rate_limited:
+                if cooldown is None:
+                    cooldown = result.retry_after if result.retry_after is not None else self.default_cooldown
+                self._cooldown_until = max(self._cooldown_until, now + cooldown)
+                # Nhiều worker cùng nhận 429 trong một đợt chỉ tính là một lần giảm
+                if now - self._last_decrease >= cooldown:
+                    self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+                    self._last_decrease = now
+                    decreased = True
+                reason = f"{result.describe()} - tạm dừng {cooldown:.1f} giây"
+            elif result is not None and result.ok and latency is not None:
+                if self._best_latency is None or latency < self._best_latency:
+                    self._best_latency = latency
+                if latency <= self._best_latency * self.latency_tolerance:
+                    self._limit = min(self.max_limit, self._limit + self.increase_step / max(self._limit, 1.0))
+                    reason = "ổn định"
+                else:
+                    reason = f"độ trễ cao ({latency:.1f}s)"
+            new_limit = int(self._limit)
+            self._cond.notify_all()
+        CONCURRENCY_LIMIT.set(new_limit)
+        if self.on_change and (new_limit != old_limit or decreased):
             try:
-                os.makedirs(output_folder, exist_ok=True)
-                log_success(f"Đã tạo thư mục thành công: {output_folder}")
+                self.on_change(new_limit, reason)
             except Exception as e:
-                log_error(f"Không thể tạo thư mục {output_folder}: {e}")
-                return False
-        
-        # Kiểm tra quyền ghi
-        if not os.access(output_folder, os.W_OK):
-            log_error(f"Không có quyền ghi vào thư mục: {output_folder}")
-            return False
-        
-        # Loại bỏ prefix data:image/jpeg;base64, nếu có
-        if ',' in base64_data:
-            base64_data = base64_data.split(',')[1]
-        
-        image_data = base64.b64decode(base64_data)
-        
-        with open(full_path, 'wb') as f:
-            f.write(image_data)
-        
-        log_success(f"Đã lưu thành công: {full_path}")
-        return True
-    except Exception as e:
-        log_error(f"Lỗi khi lưu ảnh {full_path}: {e}")
-        return False
+                log.debug("Lỗi callback limiter: {}", e)
+
+    def snapshot(self):
+        """Trạng thái hiện tại (limit, in_flight, cooldown còn lại)"""
+        with self._cond:
+            return {
+                'limit': int(self._limit),
+                'max_limit': self.max_limit,
+                'in_flight': self._in_flight,
+                'cooldown_remaining': self.cooldown_remaining(),
+            }
+
+class WhiskRequestExecutor:
+    """Thực thi request POST tới một endpoint với retry, backoff và phân loại lỗi thống nhất"""
+
+    def __init__(self, name, url, policy=None, timeout=60, unwrap=None):
+        self.name = name
+        self.url = url
+        self.policy = policy or BackoffPolicy()
+        self.timeout = timeout
+        self.unwrap = unwrap  # Hàm lấy phần dữ liệu cần thiết từ JSON response (vd: tRPC)
+
+    def execute(self, headers, payload, spinner_message="Đang gọi API...", max_attempts=None,
+                limiter=None, defer_decode=False):
+        """Gửi payload (serialize một lần, dùng lại qua các lần thử) và trả về WhiskResult
+
+        Nếu truyền limiter (AdaptiveConcurrencyLimiter), mỗi lần thử chiếm một slot của limiter
+        và thời gian chờ khi bị 429 được áp dụng chung cho mọi worker thay vì từng worker tự ngủ.
+        defer_decode=True: response được đọc dạng stream theo chunk vào file tạm (result.body), việc
+        parse/giải mã/ghi file do giai đoạn sau đảm nhận (xem decode_deferred_body, image_pipeline).
+        Không giữ cả body trong bộ nhớ; body lỗi được pipeline gửi lại giai đoạn network để thử lại.
+        """
+        policy = self.policy.with_max_attempts(max_attempts)
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        headers = dict(headers)
+        headers["Content-Type"] = "application/json"
+        log.debug("🔍 {} -> {}", self.name, self.url)
+        log.debug("  - Payload: {}", lambda: body[:2000].decode('utf-8', 'replace'))
+
+        started = time.monotonic()
+        spinner = LoadingSpinner(spinner_message, Fore.MAGENTA)
+        spinner.start()
+        try:
+            attempt = 0
+            while True:
+                with tracer.span("attempt", api=self.name, attempt=attempt + 1) as span:
+                    result = self._limited_attempt(headers, body, limiter, policy, attempt, defer_decode)
+                    span.set(outcome=result.outcome)
+                result.attempts = attempt + 1
+                API_ATTEMPTS.inc(api=self.name, outcome=result.outcome)
+                if result.ok or not policy.should_retry(result, attempt):
+                    break
+                delay = policy.delay_for(result, attempt)
+                API_RETRIES.inc(api=self.name, outcome=result.outcome)
+                log.warning("{}: {} - thử lại sau {:.1f} giây... (Lần {}/{})",
+                            self.name, result.describe(), delay, attempt + 1, policy.max_attempts)
+                spinner.message = f"{spinner_message} (Thử lại lần {attempt + 2})"
+                if not (limiter and result.is_rate_limited):
+                    with tracer.span("retry_wait", seconds=round(delay, 3)):
+                        time.sleep(delay)  # Với limiter, cooldown 429 được chờ trong limiter.acquire()
+                    API_RETRY_WAIT_SECONDS.inc(delay, api=self.name)
+                attempt += 1
+        finally:
+            spinner.stop()
+
+        result.elapsed = time.monotonic() - started
+        API_CALL_SECONDS.observe(result.elapsed, api=self.name, outcome=result.outcome)
+        if not result.ok:
+            log.error("{}: {} (sau {} lần thử)", self.name, result.describe(), result.attempts)
+            _log_failure_hints(result)
+        return result
+
+    def _limited_attempt(self, headers, body, limiter, policy, attempt, defer_decode=False):
+        if limiter is None:
+            return self._attempt(headers, body, defer_decode)
+        with tracer.span("limiter_wait"):
+            limiter.acquire()
+        result = None
+        started = time.monotonic()
+        try:
+            result = self._attempt(headers, body, defer_decode)
+            return result
+        finally:
+            cooldown = policy.delay_for(result, attempt) if result is not None and result.is_rate_limited else None
+            limiter.release(result, time.monotonic() - started, cooldown)
+
+    def _attempt(self, headers, body, defer_decode=False):
+        try:
+            response = browser_sim.make_request("POST", self.url, headers=headers, data=body,
+                                                timeout=self.timeout, stream=defer_decode)
+        except Exception as e:
+            return WhiskResult(RequestOutcome.TRANSPORT_ERROR, error_message=str(e))
+        if response is None:
+            return WhiskResult(RequestOutcome.TRANSPORT_ERROR)
+
+        log.debug("  - Status code: {}", response.status_code)
+        if response.status_code != 200:
+            try:
+                return classify_response(response)
+            finally:
+                response.close()
+
+        if defer_decode:
+            spool = tempfile.TemporaryFile(prefix="whisk_body_")
+            size = 0
+            try:
+                with tracer.span("read_body"):
+                    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                        spool.write(chunk)
+                        size += len(chunk)
+            except Exception as e:
+                spool.close()
+                return WhiskResult(RequestOutcome.TRANSPORT_ERROR, error_message=str(e))
+            finally:
+                response.close()
+            RESPONSE_BYTES.inc(size, api=self.name)
+            if not size:
+                spool.close()
+                return WhiskResult(RequestOutcome.BAD_RESPONSE, status_code=200, error_message="Response rỗng")
+            spool.seek(0)
+            result = WhiskResult(RequestOutcome.SUCCESS, status_code=200)
+            result.body = spool
+            result.body_size = size
+            result.unwrap = self.unwrap
+            return result
+
+        try:
+            RESPONSE_BYTES.inc(len(response.content), api=self.name)
+            with tracer.span("json_parse"):
+                data = response.json()
+            if self.unwrap:
+                data = self.unwrap(data)
+        except Exception as e:
+            log.error("Lỗi parse JSON: {}", e)
+            return WhiskResult(RequestOutcome.BAD_RESPONSE, status_code=200, error_message=str(e))
+        log.debug("  - Response keys: {}", lambda: list(data.keys()) if isinstance(data, dict) else type(data))
+        return WhiskResult(RequestOutcome.SUCCESS, data=data, status_code=200)
+
+def _unwrap_trpc_result(result):
+    """Lấy result.data.json.result của response tRPC nếu có imagePanels"""
+    if isinstance(result, dict) and 'result' in result and 'data' in result['result']:
+        data = result['result']['data'].get('json', {})
+        if isinstance(data, dict) and 'result' in data and 'imagePanels' in data['result']:
+            return data['result']
+    return result
+
+generate_image_executor = WhiskRequestExecutor(
+    "generate_image", f"{WHISK_API_BASE_URL}/v1/whisk:generateImage",
+    BackoffPolicy(max_attempts=3))
+run_image_recipe_executor = WhiskRequestExecutor(
+    "generate_image_from_multiple_images", f"{WHISK_API_BASE_URL}/v1/whisk:runImageRecipe",
+    BackoffPolicy(max_attempts=3))
+edit_image_executor = WhiskRequestExecutor(
+    "edit_image_with_prompt", f"{LABS_BASE_URL}/fx/api/trpc/backbone.editImage",
+    BackoffPolicy(max_attempts=3), timeout=120, unwrap=_unwrap_trpc_result)
+
+DEFAULT_UPLOAD_CAPTION = "A hyperrealistic digital illustration depicts a shiny, chrome-like mouse character, standing confidently in a martial arts gi against a subtly rendered, dark background of what appears to be an arena. The character, positioned centrally in the frame, faces forward with a slight tilt of its head to the right. Its body is composed of a highly reflective, polished silver material, giving it a metallic, almost liquid sheen.\n\nThe mouse has large, round ears that match its reflective silver body. Its face is characterized by large, expressive eyes with black pupils surrounded by a thin white iris, and a faint, thin black eyebrow line above each eye. A small, dark triangular nose sits above a tiny, closed mouth. Whiskers, depicted as thin black lines, extend from its cheeks. The overall expression of the mouse is one of determination or seriousness.\n\nIt wears a dark, possibly black or very dark gray, martial arts gi. The gi consists of a wrap-around top with a V-neck opening and wide sleeves, secured at the waist by a tied belt with a knot at the front. The fabric of the gi has visible texture, with distinct lines and shading suggesting folds and creases, giving it a somewhat sketch-like or illustrated appearance in contrast to the smooth, reflective quality of the mouse's skin. The gi extends down to just above its feet. The mouse's feet are clad in simple, low-top white sneakers with dark soles, contrasting with the dark gi.\n\nThe background is dark and desaturated, creating a stark contrast with the shiny character. It suggests the interior of an arena or training dojo, with a circular, slightly elevated platform visible in the foreground where the mouse stands. The background features blurred architectural elements, possibly seating or walls, rendered in shades of dark gray and black. A faint \"SU\" logo, stylized in white, is visible in the upper right corner of the image. The lighting appears to come from the front and slightly above, accentuating the metallic sheen of the mouse and casting subtle shadows."
 
-def upload_image_to_google_labs(cookie, image_path, caption="A hyperrealistic digital illustration depicts a shiny, chrome-like mouse character, standing confidently in a martial arts gi against a subtly rendered, dark background of what appears to be an arena. The character, positioned centrally in the frame, faces forward with a slight tilt of its head to the right. Its body is composed of a highly reflective, polished silver material, giving it a metallic, almost liquid sheen.\n\nThe mouse has large, round ears that match its reflective silver body. Its face is characterized by large, expressive eyes with black pupils surrounded by a thin white iris, and a faint, thin black eyebrow line above each eye. A small, dark triangular nose sits above a tiny, closed mouth. Whiskers, depicted as thin black lines, extend from its cheeks. The overall expression of the mouse is one of determination or seriousness.\n\nIt wears a dark, possibly black or very dark gray, martial arts gi. The gi consists of a wrap-around top with a V-neck opening and wide sleeves, secured at the waist by a tied belt with a knot at the front. The fabric of the gi has visible texture, with distinct lines and shading suggesting folds and creases, giving it a somewhat sketch-like or illustrated appearance in contrast to the smooth, reflective quality of the mouse's skin. The gi extends down to just above its feet. The mouse's feet are clad in simple, low-top white sneakers with dark soles, contrasting with the dark gi.\n\nThe background is dark and desaturated, creating a stark contrast with the shiny character. It suggests the interior of an arena or training dojo, with a circular, slightly elevated platform visible in the foreground where the mouse stands. The background features blurred architectural elements, possibly seating or walls, rendered in shades of dark gray and black. A faint \"SU\" logo, stylized in white, is visible in the upper right corner of the image. The lighting appears to come from the front and slightly above, accentuating the metallic sheen of the mouse and casting subtle shadows."):
-    """Upload ảnh lên Google Labs API"""
-    url = "https://labs.google/fx/api/trpc/backbone.uploadImage"
+def _upload_image_uncached(cookie, image_path, caption=DEFAULT_UPLOAD_CAPTION, media_category="MEDIA_CATEGORY_SUBJECT"):
+    """Upload ảnh lên Google Labs API (không qua cache)"""
+    url = f"{LABS_BASE_URL}/fx/api/trpc/backbone.uploadImage"
     
     headers = browser_sim.get_api_headers(cookie=cookie)
     
@@ -756,7 +1482,7 @@ def upload_image_to_google_labs(cookie, image_path, caption="A hyperrealistic di
             # Thêm prefix data:image/jpeg;base64,
             base64_string = f"data:image/jpeg;base64,{image_data}"
     except Exception as e:
-        log_error(f"Lỗi khi đọc file ảnh {image_path}: {e}")
+        log.error("Lỗi khi đọc file ảnh {}: {}", image_path, e)
         return None
     
     # Tạo UUID cho workflowId và sessionId
@@ -770,7 +1496,7 @@ def upload_image_to_google_labs(cookie, image_path, caption="A hyperrealistic di
                 "sessionId": session_id
             },
             "uploadMediaInput": {
-                "mediaCategory": "MEDIA_CATEGORY_SUBJECT",
+                "mediaCategory": media_category,
                 "rawBytes": base64_string,
                 "caption": caption
             }
@@ -789,7 +1515,7 @@ def upload_image_to_google_labs(cookie, image_path, caption="A hyperrealistic di
             result = response.json()
             if 'result' in result and 'data' in result['result']:
                 upload_data = result['result']['data']['json']['result']
-                log_success("Upload ảnh thành công!")
+                log.success("Upload ảnh thành công!")
                 return {
                     'caption': caption,
                     'uploadMediaGenerationId': upload_data['uploadMediaGenerationId'],
@@ -798,22 +1524,167 @@ def upload_image_to_google_labs(cookie, image_path, caption="A hyperrealistic di
                 }
         else:
             if response:
-                log_error(f"Lỗi khi upload ảnh: {response.status_code}")
-                log_error(response.text)
+                log.error("Lỗi khi upload ảnh: {}", response.status_code)
+                log.error(response.text)
             return None
     except requests.exceptions.Timeout:
         spinner.stop()
-        log_error("Timeout khi upload ảnh")
+        log.error("Timeout khi upload ảnh")
         return None
     except Exception as e:
         spinner.stop()
-        log_error(f"Lỗi khi upload ảnh: {e}")
+        log.error("Lỗi khi upload ảnh: {}", e)
         return None
 
-def generate_image_from_multiple_images(access_token, upload_data_list, user_instruction, seed, image_model="IMAGEN_3_5", aspect_ratio="IMAGE_ASPECT_RATIO_LANDSCAPE", output_folder=None, max_retries=3):
-    """Tạo ảnh từ nhiều ảnh đã upload với cơ chế retry"""
-    url = "https://aisandbox-pa.googleapis.com/v1/whisk:runImageRecipe"
-    
+# ===== UPLOAD CACHE =====
+class UploadCache:
+    """Cache kết quả upload ảnh tham chiếu theo nội dung file (+ caption, media category, tài khoản)
+
+    Lưu trong RAM và trên đĩa (JSON) để dùng lại giữa các lần chạy, có TTL và loại bỏ
+    entry ít dùng nhất (LRU) khi vượt quá max_entries. Nhiều luồng cùng upload một ảnh
+    sẽ chỉ tạo một request, các luồng còn lại chờ kết quả của request đó.
+    """
+
+    def __init__(self, path="upload_cache.json", ttl=12 * 3600, max_entries=500):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = None          # Nạp từ đĩa khi dùng lần đầu
+        self._in_flight = {}          # key -> threading.Event của upload đang chạy
+        self._digests = {}            # (path, mtime, size) -> sha256, tránh đọc lại file không đổi
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _load_locked(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except Exception as e:
+                log.warning("Không đọc được upload cache {}: {}", self.path, e)
+
+    def _save_locked(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log.warning("Không ghi được upload cache {}: {}", self.path, e)
+
+    def _evict_locked(self, now):
+        expired = [key for key, entry in self._entries.items() if now - entry['created'] > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        overflow = len(self._entries) - self.max_entries
+        if overflow > 0:
+            for key in sorted(self._entries, key=lambda k: self._entries[k]['last_used'])[:overflow]:
+                del self._entries[key]
+        return bool(expired) or overflow > 0
+
+    def content_digest(self, image_path):
+        """sha256 nội dung file, nhớ theo (path, mtime, size)"""
+        stat = os.stat(image_path)
+        stat_key = (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+        digest = self._digests.get(stat_key)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(image_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(block)
+            digest = hasher.hexdigest()
+            self._digests[stat_key] = digest
+        return digest
+
+    def make_key(self, cookie, image_path, caption, media_category):
+        account = hashlib.sha1(str(cookie).encode('utf-8')).hexdigest()[:12]
+        caption_hash = hashlib.sha1(str(caption).encode('utf-8')).hexdigest()[:12]
+        return f"{account}:{self.content_digest(image_path)}:{media_category}:{caption_hash}"
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            self._load_locked()
+            entry = self._entries.get(key)
+            if entry and now - entry['created'] <= self.ttl:
+                entry['last_used'] = now
+                return dict(entry['data'])
+        return None
+
+    def get_or_upload(self, key, upload_fn):
+        """Trả về dữ liệu upload đã cache, hoặc gọi upload_fn() (gộp các request trùng đang chạy)"""
+        while True:
+            with self._lock:
+                self._load_locked()
+                now = time.time()
+                entry = self._entries.get(key)
+                if entry and now - entry['created'] <= self.ttl:
+                    entry['last_used'] = now
+                    self.hits += 1
+                    return dict(entry['data'])
+                event = self._in_flight.get(key)
+                if event is None:
+                    event = self._in_flight[key] = threading.Event()
+                    self.misses += 1
+                    break
+                self.coalesced += 1
+            # Một luồng khác đang upload cùng ảnh: chờ rồi đọc lại cache
+            event.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry:
+                    entry['last_used'] = time.time()
+                    return dict(entry['data'])
+            # Upload của luồng kia thất bại - thử lại (luồng này sẽ tự upload)
+
+        data = None
+        try:
+            data = upload_fn()
+        finally:
+            with self._lock:
+                if data:
+                    now = time.time()
+                    self._entries[key] = {'data': data, 'created': now, 'last_used': now}
+                    self._evict_locked(now)
+                    self._save_locked()
+                del self._in_flight[key]
+                event.set()
+        return dict(data) if data else None
+
+    def invalidate(self, key):
+        with self._lock:
+            self._load_locked()
+            if self._entries.pop(key, None) is not None:
+                self._save_locked()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                    'entries': len(self._entries or {})}
+
+upload_cache = UploadCache()
+
+def upload_image_to_google_labs(cookie, image_path, caption=DEFAULT_UPLOAD_CAPTION, media_category="MEDIA_CATEGORY_SUBJECT", use_cache=True):
+    """Upload ảnh lên Google Labs API, dùng lại uploadMediaGenerationId đã cache nếu ảnh không đổi"""
+    if not use_cache:
+        return _upload_image_uncached(cookie, image_path, caption, media_category)
+    try:
+        key = upload_cache.make_key(cookie, image_path, caption, media_category)
+    except OSError as e:
+        log.error("Lỗi khi đọc file ảnh {}: {}", image_path, e)
+        return None
+    return upload_cache.get_or_upload(
+        key, lambda: _upload_image_uncached(cookie, image_path, caption, media_category))
+
+def generate_image_from_multiple_images(access_token, upload_data_list, user_instruction, seed, image_model=DEFAULT_IMAGE_MODEL, aspect_ratio="IMAGE_ASPECT_RATIO_LANDSCAPE", output_folder=None, max_retries=3, limiter=None, defer_decode=False):
+    """Tạo ảnh từ nhiều ảnh đã upload, trả về WhiskResult (limiter, defer_decode: xem generate_image)"""
     headers = browser_sim.get_api_headers(access_token=access_token)
     
     # Tạo recipeMediaInputs từ upload_data_list
@@ -827,148 +1698,29 @@ def generate_image_from_multiple_images(access_token, upload_data_list, user_ins
             }
         })
     
-    for attempt in range(max_retries):
-        payload = {
-            "clientContext": {
-                "workflowId": upload_data_list[0]['workflowId'] if upload_data_list else "",
-                "tool": "BACKBONE",
-                "sessionId": upload_data_list[0]['sessionId'] if upload_data_list else ""
-            },
-            "seed": seed,
-            "imageModelSettings": {
-                "imageModel": image_model,
-                "aspectRatio": aspect_ratio
-            },
-            "userInstruction": user_instruction,
-            "recipeMediaInputs": recipe_media_inputs
-        }
-        
-        # Hiển thị loading spinner
-        if attempt == 0:
-            spinner = LoadingSpinner("Đang tạo ảnh từ nhiều ảnh với AI...", Fore.MAGENTA)
-        else:
-            spinner = LoadingSpinner(f"Đang tạo ảnh từ nhiều ảnh với AI... (Thử lại lần {attempt + 1})", Fore.MAGENTA)
-        spinner.start()
-        
-        try:
-            if attempt > 0:
-                log_info(f"🔄 Thử lại lần {attempt + 1}/{max_retries}")
-                # Delay trước khi retry
-                time.sleep(2 * attempt)
-            
-            response = browser_sim.make_request("POST", url, headers=headers, json=payload, timeout=60)
-            spinner.stop()
-            
-            if response is None:
-                log_error("API trả về None - không có kết quả")
-                if attempt < max_retries - 1:
-                    log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                    continue
-                else:
-                    return None
-            
-            if response.status_code == 200:
-                try:
-                    result = response.json()
-                    return result
-                except Exception as json_error:
-                    log_error(f"Lỗi parse JSON: {json_error}")
-                    if attempt < max_retries - 1:
-                        log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                        continue
-                    return None
-            elif response.status_code == 401:
-                log_error("Lỗi xác thực (401) - Access token có thể đã hết hạn")
-                return None
-            elif response.status_code == 403:
-                log_error("Lỗi quyền truy cập (403) - Có thể bị chặn bởi Google")
-                if attempt < max_retries - 1:
-                    log_warning("Thử đổi proxy hoặc User-Agent và thử lại...")
-                    continue
-                else:
-                    return None
-            elif response.status_code == 429:
-                # Parse error details from response
-                error_details = ""
-                try:
-                    error_data = response.json()
-                    if 'error' in error_data:
-                        error_info = error_data['error']
-                        error_code = error_info.get('code', 'Unknown')
-                        error_message = error_info.get('message', 'Unknown error')
-                        error_status = error_info.get('status', 'Unknown')
-                        
-                        # Check for specific error types
-                        if error_status == "RESOURCE_EXHAUSTED":
-                            log_error("🚫 Tài nguyên đã cạn kiệt - Quota đã hết")
-                            log_error("💡 Hướng dẫn: Chờ một lúc rồi thử lại hoặc sử dụng tài khoản khác")
-                        elif "PUBLIC_ERROR_USER_REQUESTS_THROTTLED" in str(error_info.get('details', [])):
-                            log_error("⏰ Quá nhiều request - Bị giới hạn tốc độ")
-                            log_error("💡 Hướng dẫn: Giảm số luồng hoặc chờ lâu hơn")
-                        else:
-                            log_error(f"Quá nhiều request (429) - {error_message}")
-                        
-                        error_details = f" - {error_message}"
-                    else:
-                        log_error("Quá nhiều request (429) - Bị rate limit")
-                except:
-                    log_error("Quá nhiều request (429) - Bị rate limit")
-                
-                if attempt < max_retries - 1:
-                    # Exponential backoff with jitter
-                    base_wait = 10 * (2 ** attempt)  # 10, 20, 40 seconds
-                    jitter = random.uniform(0.5, 1.5)  # Add randomness
-                    wait_time = int(base_wait * jitter)
-                    
-                    log_warning(f"⏳ Chờ {wait_time} giây rồi thử lại... (Lần {attempt + 1}/{max_retries})")
-                    log_warning("💡 Mẹo: Giảm số luồng để tránh bị rate limit")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    log_error("❌ Đã thử nhiều lần nhưng vẫn bị rate limit")
-                    log_error("🔧 Các giải pháp:")
-                    log_error("  1. Giảm số luồng xuống 1-2")
-                    log_error("  2. Chờ 5-10 phút rồi thử lại")
-                    log_error("  3. Sử dụng tài khoản khác")
-                    log_error("  4. Kiểm tra proxy có hoạt động tốt không")
-                    return None
-            elif response.status_code >= 500:
-                log_error(f"Lỗi server (5xx): {response.status_code}")
-                if attempt < max_retries - 1:
-                    wait_time = 10 * (attempt + 1)
-                    log_warning(f"Chờ {wait_time} giây rồi thử lại...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    return None
-            else:
-                log_error(f"Lỗi HTTP không xác định: {response.status_code}")
-                log_error(f"Response text: {response.text}")
-                if attempt < max_retries - 1:
-                    log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                    continue
-                return None
-        except requests.exceptions.Timeout:
-            spinner.stop()
-            log_error("Timeout khi tạo ảnh từ nhiều ảnh")
-            if attempt < max_retries - 1:
-                log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                continue
-            return None
-        except Exception as e:
-            spinner.stop()
-            log_error(f"Lỗi khi tạo ảnh từ nhiều ảnh: {e}")
-            if attempt < max_retries - 1:
-                log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                continue
-            return None
+    payload = {
+        "clientContext": {
+            "workflowId": upload_data_list[0]['workflowId'] if upload_data_list else "",
+            "tool": "BACKBONE",
+            "sessionId": upload_data_list[0]['sessionId'] if upload_data_list else ""
+        },
+        "seed": seed,
+        "imageModelSettings": {
+            "imageModel": image_model,
+            "aspectRatio": aspect_ratio
+        },
+        "userInstruction": user_instruction,
+        "recipeMediaInputs": recipe_media_inputs
+    }
     
-    log_error(f"Đã thử {max_retries} lần nhưng vẫn thất bại")
-    return None
+    with tracer.trace("generate_image_from_multiple_images", seed=seed):
+        return run_image_recipe_executor.execute(headers, payload, "Đang tạo ảnh từ nhiều ảnh với AI...",
+                                                 max_attempts=max_retries, limiter=limiter,
+                                                 defer_decode=defer_decode)
 
 def generate_image_from_image(access_token, upload_data, user_instruction, seed, image_model="IMAGEN_3_5", aspect_ratio="IMAGE_ASPECT_RATIO_LANDSCAPE"):
     """Tạo ảnh từ ảnh đã upload"""
-    url = "https://aisandbox-pa.googleapis.com/v1/whisk:runImageRecipe"
+    url = f"{WHISK_API_BASE_URL}/v1/whisk:runImageRecipe"
     
     headers = browser_sim.get_api_headers(access_token=access_token)
     
@@ -1022,16 +1774,16 @@ def generate_image_from_image(access_token, upload_data, user_instruction, seed,
             return response.json()
         else:
             if response:
-                log_error(f"Lỗi khi tạo ảnh từ ảnh: {response.status_code}")
-                log_error(response.text)
+                log.error("Lỗi khi tạo ảnh từ ảnh: {}", response.status_code)
+                log.error(response.text)
             return None
     except requests.exceptions.Timeout:
         spinner.stop()
-        log_error("Timeout khi tạo ảnh từ ảnh")
+        log.error("Timeout khi tạo ảnh từ ảnh")
         return None
     except Exception as e:
         spinner.stop()
-        log_error(f"Lỗi khi tạo ảnh từ ảnh: {e}")
+        log.error("Lỗi khi tạo ảnh từ ảnh: {}", e)
         return None
 
 def validate_edit_payload(original_media_generation_id, raw_bytes, prompt):
@@ -1057,198 +1809,53 @@ def validate_edit_payload(original_media_generation_id, raw_bytes, prompt):
     
     return errors
 
-def edit_image_with_prompt(cookie, original_media_generation_id, raw_bytes, prompt, seed=None, max_retries=3):
-    """Gọi API backbone.editImage để edit ảnh với prompt"""
-    url = "https://labs.google/fx/api/trpc/backbone.editImage"
-    
+def edit_image_with_prompt(cookie, original_media_generation_id, raw_bytes, prompt, seed=None, max_retries=3, limiter=None, defer_decode=False):
+    """Gọi API backbone.editImage để edit ảnh với prompt, trả về WhiskResult (limiter, defer_decode: xem generate_image)"""
     headers = browser_sim.get_api_headers(cookie=cookie)
     
     # Validation đầu vào
     validation_errors = validate_edit_payload(original_media_generation_id, raw_bytes, prompt)
     if validation_errors:
         for error in validation_errors:
-            log_error(f"❌ Validation error: {error}")
-        return None
-    
-    # Tạo UUID cho workflowId và sessionId
-    workflow_id = str(uuid.uuid4())  # Random workflow ID
-    session_id = f";{uuid.uuid4().int}"  # Random session ID
+            log.error("❌ Validation error: {}", error)
+        return WhiskResult(RequestOutcome.INVALID_INPUT, error_message="; ".join(validation_errors))
     
-    for attempt in range(max_retries):
-        payload = {
-            "json": {
-                "clientContext": {
-                    "workflowId": workflow_id,
-                    "tool": "BACKBONE",
-                    "sessionId": session_id
-                },
-                "imageModelSettings": {
-                    "imageModel": "GEM_PIX",
-                    "aspectRatio": None
-                },
-                "flags": {},
-                "editInput": {
-                    "caption": prompt,
-                    "userInstruction": prompt,
-                    "seed": seed,
-                    "safetyMode": None,
-                    "originalMediaGenerationId": original_media_generation_id,
-                    "mediaInput": {
-                        "mediaCategory": "MEDIA_CATEGORY_BOARD",
-                        "rawBytes": raw_bytes
-                    }
-                }
+    payload = {
+        "json": {
+            "clientContext": {
+                "workflowId": str(uuid.uuid4()),
+                "tool": "BACKBONE",
+                "sessionId": f";{uuid.uuid4().int}"
+            },
+            "imageModelSettings": {
+                "imageModel": "GEM_PIX",
+                "aspectRatio": None
             },
-            "meta": {
-                "values": {
-                    "imageModelSettings.aspectRatio": ["undefined"],
-                    "editInput.seed": ["undefined"],
-                    "editInput.safetyMode": ["undefined"]
+            "flags": {},
+            "editInput": {
+                "caption": prompt,
+                "userInstruction": prompt,
+                "seed": seed,
+                "safetyMode": None,
+                "originalMediaGenerationId": original_media_generation_id,
+                "mediaInput": {
+                    "mediaCategory": "MEDIA_CATEGORY_BOARD",
+                    "rawBytes": raw_bytes
                 }
             }
+        },
+        "meta": {
+            "values": {
+                "imageModelSettings.aspectRatio": ["undefined"],
+                "editInput.seed": ["undefined"],
+                "editInput.safetyMode": ["undefined"]
+            }
         }
-        
-        
-        # Hiển thị loading spinner
-        if attempt == 0:
-            spinner = LoadingSpinner("Đang edit ảnh với AI...", Fore.MAGENTA)
-        else:
-            spinner = LoadingSpinner(f"Đang edit ảnh với AI... (Thử lại lần {attempt + 1})", Fore.MAGENTA)
-        spinner.start()
-        
-        try:
-            if attempt > 0:
-                log_info(f"🔄 Thử lại lần {attempt + 1}/{max_retries}")
-                # Delay trước khi retry
-                time.sleep(2 * attempt)
-            
-    
-            
-            response = browser_sim.make_request("POST", url, headers=headers, json=payload)
-            spinner.stop()
-            
-            if response is None:
-                log_error("API trả về None - không có kết quả")
-                if attempt < max_retries - 1:
-                    log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                    continue
-                else:
-                    return None
-            
-
-            # Log chi tiết hơn cho lỗi 500
-            if response.status_code == 500:
-                log_error(f"🔍 Chi tiết lỗi 500:")
-              
-            
-            if response.status_code == 200:
-                try:
-                    result = response.json()
-                    log_debug(f"🔍 JSON response:")
-                    log_debug(f"  - Response keys: {list(result.keys()) if result else 'None'}")
-                    if 'result' in result and 'data' in result['result']:
-                        data = result['result']['data']['json']
-                        if 'result' in data and 'imagePanels' in data['result']:
-                            log_debug(f"  - imagePanels count: {len(data['result']['imagePanels'])}")
-                            return data['result']
-                    return result
-                except Exception as json_error:
-                    log_error(f"Lỗi parse JSON: {json_error}")
-                    log_error(f"Response text gốc: {response.text}")
-                    if attempt < max_retries - 1:
-                        log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                        continue
-                    return None
-            elif response.status_code == 401:
-                log_error("Lỗi xác thực (401) - Cookie có thể đã hết hạn")
-                return None
-            elif response.status_code == 403:
-                log_error("Lỗi quyền truy cập (403) - Có thể bị chặn bởi Google")
-                if attempt < max_retries - 1:
-                    log_warning("Thử đổi proxy hoặc User-Agent và thử lại...")
-                    continue
-                else:
-                    return None
-            elif response.status_code == 429:
-                # Parse error details from response
-                error_details = ""
-                try:
-                    error_data = response.json()
-                    if 'error' in error_data:
-                        error_info = error_data['error']
-                        error_code = error_info.get('code', 'Unknown')
-                        error_message = error_info.get('message', 'Unknown error')
-                        error_status = error_info.get('status', 'Unknown')
-                        
-                        # Check for specific error types
-                        if error_status == "RESOURCE_EXHAUSTED":
-                            log_error("🚫 Tài nguyên đã cạn kiệt - Quota đã hết")
-                            log_error("💡 Hướng dẫn: Chờ một lúc rồi thử lại hoặc sử dụng tài khoản khác")
-                        elif "PUBLIC_ERROR_USER_REQUESTS_THROTTLED" in str(error_info.get('details', [])):
-                            log_error("⏰ Quá nhiều request - Bị giới hạn tốc độ")
-                            log_error("💡 Hướng dẫn: Giảm số luồng hoặc chờ lâu hơn")
-                        else:
-                            log_error(f"Quá nhiều request (429) - {error_message}")
-                        
-                        error_details = f" - {error_message}"
-                    else:
-                        log_error("Quá nhiều request (429) - Bị rate limit")
-                except:
-                    log_error("Quá nhiều request (429) - Bị rate limit")
-                
-                if attempt < max_retries - 1:
-                    # Exponential backoff with jitter
-                    base_wait = 10 * (2 ** attempt)  # 10, 20, 40 seconds
-                    jitter = random.uniform(0.5, 1.5)  # Add randomness
-                    wait_time = int(base_wait * jitter)
-                    
-                    log_warning(f"⏳ Chờ {wait_time} giây rồi thử lại... (Lần {attempt + 1}/{max_retries})")
-                    log_warning("💡 Mẹo: Giảm số luồng để tránh bị rate limit")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    log_error("❌ Đã thử nhiều lần nhưng vẫn bị rate limit")
-                    log_error("🔧 Các giải pháp:")
-                    log_error("  1. Giảm số luồng xuống 1-2")
-                    log_error("  2. Chờ 5-10 phút rồi thử lại")
-                    log_error("  3. Sử dụng tài khoản khác")
-                    log_error("  4. Kiểm tra proxy có hoạt động tốt không")
-                    return None
-            elif response.status_code >= 500:
-                log_error(f"Lỗi server (5xx): {response.status_code}")
-
-                
-                if attempt < max_retries - 1:
-                    wait_time = 10 * (attempt + 1)  # Tăng thời gian chờ cho lỗi 500
-                    log_warning(f"Chờ {wait_time} giây rồi thử lại...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    return None
-            else:
-                log_error(f"Lỗi HTTP không xác định: {response.status_code}")
-                log_error(f"Response text: {response.text}")
-                if attempt < max_retries - 1:
-                    log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                    continue
-                return None
-        except requests.exceptions.Timeout:
-            spinner.stop()
-            log_error("Timeout khi edit ảnh")
-            if attempt < max_retries - 1:
-                log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                continue
-            return None
-        except Exception as e:
-            spinner.stop()
-            log_error(f"Lỗi khi edit ảnh: {e}")
-            if attempt < max_retries - 1:
-                log_warning(f"Sẽ thử lại sau {2 * (attempt + 1)} giây...")
-                continue
-            return None
+    }
     
-    log_error(f"Đã thử {max_retries} lần nhưng vẫn thất bại")
-    return None
+    with tracer.trace("edit_image_with_prompt", seed=seed):
+        return edit_image_executor.execute(headers, payload, "Đang edit ảnh với AI...",
+                                           max_attempts=max_retries, limiter=limiter, defer_decode=defer_decode)
 
 def sanitize_filename(stt_value, prompt_text, max_prompt_length=80):
     """Tạo tên file an toàn cho Windows: STT_PROMPT.jpg"""
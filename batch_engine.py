@@ -0,0 +1,1354 @@
+"""Engine chạy batch không phụ thuộc GUI - dùng chung cho các tab Qt và chế độ dòng lệnh
+
+Chạy không cần màn hình (cron, server Linux):
+    python -m batch_engine excel --account ten_tai_khoan --excel prompts.xlsx --output ./out --threads 4
+    python -m batch_engine text2img --account ten_tai_khoan --prompt "..." --count 4 --output ./out
+    python -m batch_engine sync --account ten_tai_khoan --image goc.jpg --excel edit.xlsx --output ./out
+    python -m batch_engine retry --account ten_tai_khoan --image goc.jpg --excel edit.xlsx --output ./out
+Mọi lệnh chạy qua pipeline network -> decode -> disk (image_pipeline);
+--threads là số request đồng thời, --decode-workers/--disk-workers là số luồng giải mã/ghi file.
+Thêm --json để in tiến độ dạng JSON Lines (mỗi dòng một event) ra stdout.
+Cuối mỗi lượt chạy, số liệu (metrics) được ghi ra <output>/whisk_metrics_<thời gian>.json;
+--metrics-port (hoặc biến môi trường WHISK_METRICS_PORT) bật endpoint Prometheus http://127.0.0.1:<port>/metrics.
+--trace-rate 0.05 (hoặc WHISK_TRACE_RATE) ghi trace từng giai đoạn của 5% số ảnh ra <output>/whisk_trace_*.json
+(Chrome trace-event, mở bằng chrome://tracing hoặc ui.perfetto.dev).
+--postprocess "webp,webp@256" (hoặc WHISK_POSTPROCESS) chuyển mỗi ảnh vừa lưu sang WebP và tạo thumbnail
+256px trong process pool riêng (postprocess.py), vd: <output>/webp_256/STT_PROMPT.webp.
+excel/text2img dùng lại ảnh đã tạo ở lần chạy trước (result_cache) khi cùng prompt, seed, model, tỷ lệ;
+--force-regenerate để luôn gọi API, --no-result-cache để tắt hẳn.
+Mỗi ảnh đã lưu được ghi vào catalog SQLite (catalog.py, tìm lại bằng: python -m catalog query ...);
+--no-catalog để tắt.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from api import (generate_image, generate_image_from_multiple_images,
+                 upload_image_to_google_labs, edit_image_with_prompt, sanitize_filename,
+                 all_images_target, iter_saved_images, browser_sim, log,
+                 WhiskResult, RequestOutcome, AdaptiveConcurrencyLimiter, DEFAULT_IMAGE_MODEL, upload_cache)
+from catalog import output_catalog
+from image_pipeline import ImagePipeline, DEFAULT_DECODE_WORKERS, DEFAULT_DISK_WORKERS
+from job_journal import JobJournal, journal_path_for, task_key
+from postprocess import PostProcessor, parse_specs, specs_from_env, DEFAULT_POSTPROCESS_WORKERS
+from metrics import registry as metrics_registry, start_metrics_server, write_run_summary, RESULT_CACHE_LOOKUPS
+from progress_events import TaskEvent, STAGE_QUEUED, STAGE_DONE, STAGE_FAILED, STAGE_SKIPPED
+from result_cache import result_cache as shared_result_cache, request_fingerprint
+from sheet_cache import sheet_cache
+from sheet_reader import (iter_sheet_rows, reference_path, valid_prompt, generation_mode,
+                          GenerationRow, SyncRow)
+from token_manager import token_manager
+from tracing import tracer
+
+SYNC_JOURNAL_MODE = "sync"
+MAX_PREFLIGHT_UPLOADS = 4  # Số luồng upload ảnh tham chiếu tối đa ở bước pre-flight
+SUBMIT_WINDOW_FACTOR = 2   # Số task đang xử lý tối đa = số luồng × hệ số này
+AUTH_FAILED_MESSAGE = "Không thể xác thực tài khoản - Cookie có thể đã hết hạn. Vui lòng cập nhật cookie mới."
+
+ASPECT_RATIOS = {
+    "1:1": "IMAGE_ASPECT_RATIO_SQUARE",
+    "16:9": "IMAGE_ASPECT_RATIO_LANDSCAPE",
+    "9:16": "IMAGE_ASPECT_RATIO_PORTRAIT",
+}
+
+# Mức log của message tiến độ: callback progress(message, level) nhận mức do nơi gọi truyền vào
+LOG_INFO = "info"
+LOG_SUCCESS = "success"
+LOG_WARNING = "warning"
+LOG_ERROR = "error"
+LOG_HINT = "hint"
+LOG_STATS = "stats"
+LOG_STATUS = "status"
+
+# Kích thước chuẩn của ảnh gốc cho chế độ đồng bộ (edit)
+STANDARD_IMAGE_SIZES = {
+    "16:9": (1408, 768),
+    "9:16": (768, 1408),
+    "1:1": (1024, 1024)
+}
+
+# ===== KẾT QUẢ TASK =====
+def image_saved_result(result):
+    """Trả về result nếu đã lưu được ít nhất một ảnh, ngược lại trả về WhiskResult lỗi"""
+    if result.ok and not any(True for _ in iter_saved_images(result.data)):
+        return WhiskResult(RequestOutcome.BAD_RESPONSE, status_code=result.status_code,
+                           error_message="Response không có ảnh", attempts=result.attempts)
+    return result
+
+def emit_failure_hints(progress, result, shown):
+    """Hiển thị hướng dẫn khắc phục theo loại lỗi (mỗi loại một lần mỗi lượt chạy)"""
+    outcome = getattr(result, 'outcome', None)
+    if outcome is None or outcome in shown:
+        return
+    shown.add(outcome)
+    if outcome == RequestOutcome.AUTH_ERROR:
+        progress("💡 Hướng dẫn: Vào tab 'Quản lý Tài khoản' -> Chọn tài khoản -> Click 'Checker' để kiểm tra", LOG_HINT)
+        progress("💡 Nếu vẫn lỗi, hãy thêm cookie mới từ Google Labs", LOG_HINT)
+    elif outcome == RequestOutcome.RATE_LIMITED:
+        progress("💡 Rate limit/Quota: Giảm số luồng xuống 1-2 hoặc chờ 5-10 phút rồi thử lại", LOG_HINT)
+    elif outcome == RequestOutcome.TRANSPORT_ERROR:
+        progress("💡 Lỗi kết nối: Kiểm tra mạng và proxy", LOG_HINT)
+
+# ===== JOURNAL =====
+def excel_task_identity(task_data):
+    """(STT, prompt, seed, mode) của task Excel (prompt/img2img)"""
+    return task_data[0], task_data[1], task_data[-3], task_data[-1]
+
+def sync_task_identity(task_data):
+    """(STT, prompt, seed, mode) của task đồng bộ (edit ảnh)"""
+    return task_data[0], task_data[1], task_data[5], SYNC_JOURNAL_MODE
+
+def excel_task_key(task_data):
+    return task_key(*excel_task_identity(task_data))
+
+def sync_task_key(task_data):
+    return task_key(*sync_task_identity(task_data))
+
+def iter_unjournaled_tasks(journal, tasks, identity_fn, counts, on_skip=None):
+    """Bỏ qua task đã hoàn thành trong journal, ghi pending cho task còn lại ngay khi được lấy ra
+
+    counts['submitted'] / counts['skipped'] được cập nhật dần trong lúc duyệt;
+    on_skip(key, task) được gọi cho mỗi task bị bỏ qua.
+    """
+    for task in tasks:
+        identity = identity_fn(task)
+        key = task_key(*identity)
+        if journal.is_done(key):
+            counts['skipped'] += 1
+            if on_skip:
+                on_skip(key, task)
+            continue
+        journal.mark_pending(key, *identity)
+        counts['submitted'] += 1
+        yield task
+    journal.flush()
+
+def run_journaled(journal, key, fn, task_data):
+    """Ghi trạng thái in-flight rồi chạy task (dùng trong ThreadPoolExecutor)"""
+    journal.mark_in_flight(key)
+    return fn(task_data)
+
+def journal_task_result(journal, key, result):
+    """Ghi kết quả task vào journal: done kèm đường dẫn ảnh, hoặc failed kèm lý do"""
+    if result:
+        paths = saved_paths(result)
+        journal.mark_done(key, paths[0] if paths else None, paths[1:])
+    elif isinstance(result, WhiskResult):
+        journal.mark_failed(key, result.describe())
+    else:
+        journal.mark_failed(key, "Lỗi không xác định")
+
+def first_saved_path(result):
+    return next((img['savedPath'] for img in iter_saved_images(result.data)), None)
+
+def saved_paths(result):
+    """Đường dẫn mọi ảnh (biến thể) đã lưu của một result"""
+    return [img['savedPath'] for img in iter_saved_images(result.data)]
+
+def unfinished_sync_entries(excel_path, output_folder):
+    """Các task đồng bộ lỗi/dở dang trong journal của (file Excel, thư mục output)"""
+    if not os.path.exists(journal_path_for(excel_path, output_folder)):
+        return []
+    with JobJournal.open_for(excel_path, output_folder) as journal:
+        return journal.unfinished_entries(mode=SYNC_JOURNAL_MODE)
+
+# ===== ẢNH THAM CHIẾU =====
+def task_reference_paths(task_data):
+    """Các ảnh tham chiếu (subject, scene, style) không trùng của một task img2img"""
+    paths = []
+    for value in (task_data[2], task_data[4], task_data[6]):
+        path = reference_path(value)
+        if path and path not in paths:
+            paths.append(path)
+    return paths
+
+def task_references(task_data):
+    """[(path, caption, caption mặc định, media category)] của một task img2img"""
+    return [
+        (task_data[2], task_data[3], 'Subject', 'MEDIA_CATEGORY_SUBJECT'),
+        (task_data[4], task_data[5], 'Scene', 'MEDIA_CATEGORY_SCENE'),
+        (task_data[6], task_data[7], 'Style', 'MEDIA_CATEGORY_STYLE'),
+    ]
+
+def generation_fingerprint(prompt, seed, aspect_ratio, references=None):
+    """Fingerprint của request cho result cache (references None: Prompt to Image)
+
+    Với Image to Image, ảnh tham chiếu được nhận diện theo nội dung (sha256) cùng caption và
+    media category; trả về None nếu không đọc được ảnh (task đó không dùng cache).
+    """
+    if references is None:
+        return request_fingerprint("prompt", prompt, seed, DEFAULT_IMAGE_MODEL, aspect_ratio)
+    parts = []
+    for value, caption, default_caption, media_category in references:
+        path = reference_path(value)
+        if not path:
+            continue
+        try:
+            digest = upload_cache.content_digest(path)
+        except OSError:
+            return None
+        parts.append((digest, str(caption or '').strip() or default_caption, media_category))
+    return request_fingerprint("img2img", prompt, seed, DEFAULT_IMAGE_MODEL, aspect_ratio, parts)
+
+def build_upload_data_list(cookie, references, reference_uploads=None):
+    """Tạo danh sách recipe input từ [(path, caption, caption mặc định, media category)]
+
+    reference_uploads: kết quả upload có sẵn (path -> upload_data); nếu không có thì tự upload.
+    Ảnh upload lỗi được bỏ qua.
+    """
+    upload_data_list = []
+    for value, caption, default_caption, media_category in references:
+        path = reference_path(value)
+        if not path:
+            continue
+        if reference_uploads is not None and path in reference_uploads:
+            upload_data = reference_uploads[path]
+        else:
+            upload_data = upload_image_to_google_labs(cookie, path)
+        if upload_data:
+            upload_data_list.append({
+                'caption': str(caption or '').strip() or default_caption,
+                'mediaCategory': media_category,
+                'uploadMediaGenerationId': upload_data['uploadMediaGenerationId'],
+                'workflowId': upload_data['workflowId'],
+                'sessionId': upload_data['sessionId']
+            })
+    return upload_data_list
+
+# ===== XÁC THỰC =====
+def resolve_access_token(cookie, saved_access_token=None, progress=None):
+    """Access token hợp lệ từ TokenManager dùng chung (cache trong bộ nhớ); None nếu thất bại"""
+    progress = progress or (lambda message, level=LOG_INFO: None)
+    progress("Đang xác thực tài khoản...")
+    access_token = token_manager.get_token(cookie, saved_access_token)
+    if not access_token:
+        return None
+    expires_in = token_manager.expires_in(cookie)
+    if expires_in is not None:
+        progress(f"✅ Xác thực thành công (token còn {int(expires_in // 60)} phút)", LOG_SUCCESS)
+    else:
+        progress("✅ Xác thực thành công", LOG_SUCCESS)
+    return access_token
+
+def load_account(account_name=None, cookies_file='cookies.json'):
+    """Đọc (tên, cookie, access token đã lưu) của tài khoản trong cookies.json
+
+    Không truyền tên thì dùng tài khoản duy nhất trong file.
+    """
+    with open(cookies_file, 'r', encoding='utf-8') as f:
+        cookies_data = json.load(f)
+    if account_name is None:
+        if len(cookies_data) != 1:
+            raise ValueError(f"Có {len(cookies_data)} tài khoản trong {cookies_file}, hãy chọn bằng --account")
+        account_name = next(iter(cookies_data))
+    if account_name not in cookies_data:
+        raise ValueError(f"Tài khoản không tồn tại: {account_name}")
+    cookie_data = cookies_data[account_name]
+    return account_name, cookie_data['cookie'], cookie_data.get('user_info', {}).get('access_token')
+
+# ===== ĐỌC EXCEL =====
+def iter_generation_rows(excel_path, progress=None):
+    """Đọc và validate Excel tạo ảnh: STT, PROMPT, SUBJECT, SUBJECT_CAPTION, SCENE, SCENE_CAPTION, STYLE, STYLE_CAPTION
+
+    Trả về từng GenerationRow với mode tự nhận diện là "Image to Image" (có ít nhất một ảnh)
+    hoặc "Prompt to Image". Nếu file đã được parse khi preview và chưa đổi (sheet_cache) thì
+    dùng lại kết quả đó; nếu không, file được đọc theo luồng khi scheduler cần thêm dòng.
+    """
+    progress = progress or (lambda message, level=LOG_INFO: None)
+    sheet = sheet_cache.peek(excel_path)
+    if sheet is not None:
+        progress(f"♻️ Dùng dữ liệu đã đọc khi preview ({sheet.stats['valid']} dòng hợp lệ)")
+        yield from sheet.generation_rows()
+        stats = sheet.stats
+    else:
+        stats = {'valid': 0, 'image_to_image': 0}
+        for row in iter_sheet_rows(excel_path, width=8):
+            # Kiểm tra prompt có hợp lệ không
+            if not valid_prompt(row[1]):
+                continue
+            row = GenerationRow(*row, generation_mode(row))
+            stats['valid'] += 1
+            if row.mode == "Image to Image":
+                stats['image_to_image'] += 1
+            yield row
+    valid_count, image_to_image_count = stats['valid'], stats['image_to_image']
+    progress(f"📊 Validation: {valid_count} dòng hợp lệ ({valid_count - image_to_image_count} Prompt to Image, {image_to_image_count} Image to Image)", LOG_STATS)
+
+def iter_sync_rows(excel_path):
+    """Đọc Excel đồng bộ (STT, PROMPT) từng dòng, bỏ qua dòng không có prompt"""
+    sheet = sheet_cache.peek(excel_path)
+    if sheet is not None:
+        yield from sheet.sync_rows()
+        return
+    for row in iter_sheet_rows(excel_path, width=2):
+        if valid_prompt(row[1]):
+            yield SyncRow(*row)
+
+# ===== ẢNH GỐC CHO CHẾ ĐỘ ĐỒNG BỘ =====
+def check_image_size(image_path, aspect_ratio="16:9"):
+    """
+    Kiểm tra kích thước ảnh có chuẩn không
+    Args:
+        image_path: Đường dẫn ảnh gốc
+        aspect_ratio: Tỷ lệ khung hình ("16:9", "9:16", "1:1")
+    Returns:
+        tuple: (is_correct_size, current_size, target_size)
+    """
+    from PIL import Image
+
+    target_size = STANDARD_IMAGE_SIZES.get(aspect_ratio, STANDARD_IMAGE_SIZES["16:9"])
+
+    try:
+        # Mở ảnh gốc
+        with Image.open(image_path) as img:
+            current_size = img.size
+            is_correct = current_size == target_size
+            return is_correct, current_size, target_size
+
+    except Exception as e:
+        log.error("Lỗi khi kiểm tra kích thước ảnh: {}", e)
+        return False, (0, 0), target_size
+
+def resize_image_to_standard_size(image_path, aspect_ratio="16:9"):
+    """
+    Resize ảnh theo kích thước chuẩn (chỉ khi cần thiết)
+    Args:
+        image_path: Đường dẫn ảnh gốc
+        aspect_ratio: Tỷ lệ khung hình ("16:9", "9:16", "1:1")
+    Returns:
+        str: Đường dẫn ảnh (gốc nếu đã đúng kích thước, hoặc đã resize)
+    """
+    from PIL import Image
+
+    if aspect_ratio not in STANDARD_IMAGE_SIZES:
+        aspect_ratio = "16:9"  # Mặc định
+
+    try:
+        # Kiểm tra kích thước hiện tại
+        is_correct, current_size, target_size = check_image_size(image_path, aspect_ratio)
+
+        if is_correct:
+            return image_path  # Trả về đường dẫn gốc
+
+        # Mở ảnh gốc
+        with Image.open(image_path) as img:
+            # Chuyển sang RGB nếu cần
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            # Resize ảnh với thuật toán LANCZOS để đảm bảo chất lượng
+            resized_img = img.resize(target_size, Image.Resampling.LANCZOS)
+
+            # Tạo đường dẫn file mới
+            base_name = os.path.splitext(image_path)[0]
+            extension = os.path.splitext(image_path)[1]
+            resized_path = f"{base_name}_resized_{aspect_ratio.replace(':', 'x')}{extension}"
+
+            # Lưu ảnh đã resize
+            resized_img.save(resized_path, 'JPEG', quality=95)
+
+            return resized_path
+
+    except Exception as e:
+        log.error("Lỗi khi resize ảnh: {}", e)
+        return image_path  # Trả về đường dẫn gốc nếu có lỗi
+
+def prepare_sync_source(cookie, image_path, aspect_ratio="16:9", progress=None):
+    """Resize (nếu cần) và upload ảnh gốc; trả về (media_generation_id, raw_bytes) hoặc None"""
+    progress = progress or (lambda message, level=LOG_INFO: None)
+    progress("🔍 Đang kiểm tra kích thước ảnh...", LOG_HINT)
+
+    is_correct, current_size, target_size = check_image_size(image_path, aspect_ratio)
+    if is_correct:
+        progress(f"✅ Ảnh đã đúng kích thước {aspect_ratio} ({current_size[0]}x{current_size[1]})", LOG_SUCCESS)
+        resized_image_path = image_path  # Sử dụng ảnh gốc
+    else:
+        progress(f"🔄 Ảnh cần resize từ {current_size[0]}x{current_size[1]} thành {target_size[0]}x{target_size[1]}", LOG_STATUS)
+        progress("Đang resize ảnh theo kích thước chuẩn...")
+        resized_image_path = resize_image_to_standard_size(image_path, aspect_ratio)
+        progress(f"✅ Đã resize ảnh thành {target_size[0]}x{target_size[1]}", LOG_SUCCESS)
+
+    progress("Đang upload ảnh lên Google Labs...")
+    upload_data = upload_image_to_google_labs(cookie, resized_image_path)
+    if not upload_data:
+        progress("❌ Upload ảnh thất bại", LOG_ERROR)
+        return None
+
+    progress("✅ Upload ảnh thành công!", LOG_SUCCESS)
+    with open(resized_image_path, 'rb') as image_file:
+        raw_bytes = f"data:image/jpeg;base64,{base64.b64encode(image_file.read()).decode('utf-8')}"
+    return upload_data['uploadMediaGenerationId'], raw_bytes
+
+# ===== RUNNERS =====
+class BatchOutcome:
+    """Kết quả một lượt chạy batch"""
+
+    def __init__(self, success, message, succeeded=0, failed=0, skipped=0):
+        self.success = success
+        self.message = message
+        self.succeeded = succeeded
+        self.failed = failed
+        self.skipped = skipped
+
+    def to_dict(self):
+        return {'success': self.success, 'message': self.message, 'succeeded': self.succeeded,
+                'failed': self.failed, 'skipped': self.skipped}
+
+class BatchRunner:
+    """Phần dùng chung của các runner: báo tiến độ (text + event + TaskEvent), limiter, thống kê"""
+
+    def __init__(self, cookie, output_folder, thread_count=1, progress=None, on_event=None, on_task_event=None):
+        self.cookie = cookie
+        self.output_folder = output_folder
+        self.thread_count = max(1, int(thread_count))
+        self.progress = progress or (lambda message, level=LOG_INFO: None)
+        self.on_event = on_event
+        self.on_task_event = on_task_event  # Nhận TaskEvent khi task chuyển giai đoạn (vd: RunStats.handle)
+        self.access_token = None
+        self.limiter = None
+        self.journal = None
+        self.decode_workers = DEFAULT_DECODE_WORKERS
+        self.disk_workers = DEFAULT_DISK_WORKERS
+        self._pool_start = None
+        self._metrics_start = None
+        self.run_started_at = None
+        self.result_cache = None        # ResultCache dùng chung giữa các lần chạy (None: tắt)
+        self.force_regenerate = False   # True: luôn gọi API, ảnh mới ghi đè entry cũ trong cache
+        self._fingerprints = {}         # task -> fingerprint của task đã gọi API (chờ lưu vào cache)
+        self.cache_hits = 0
+        self.images_saved = 0           # Tổng số file ảnh đã lưu (mỗi request có thể trả nhiều biến thể)
+        self.catalog = None             # OutputCatalog nhận một dòng cho mỗi ảnh đã lưu (None: tắt)
+        self.postprocess_specs = specs_from_env()  # Output hậu xử lý (WebP, thumbnail...); rỗng: tắt
+        self.postprocess_workers = DEFAULT_POSTPROCESS_WORKERS
+        self.postprocessor = None       # PostProcessor của pipeline đang chạy
+        self.account = None             # Tên tài khoản ghi vào catalog (None: dùng hash của cookie)
+        self.begin_metrics()
+        self.shown_hints = set()
+        self.last_failure = None
+        self.success_count = 0
+        self.error_count = 0
+
+    def event(self, name, **fields):
+        """Gửi event dạng dict (dùng cho đầu ra máy đọc được)"""
+        if self.on_event:
+            fields['event'] = name
+            fields['ts'] = round(time.time(), 3)
+            self.on_event(fields)
+
+    def task_event(self, task, stt, stage, duration=None, nbytes=None, error=None):
+        """Gửi TaskEvent (task là id duy nhất trong lượt chạy, thường là khóa journal)"""
+        if self.on_task_event:
+            self.on_task_event(TaskEvent(task, stt, stage, duration, nbytes, error, time.time()))
+
+    def stage_reporter(self, task, stt):
+        """Callback on_stage cho ImagePipeline.submit, None nếu không ai nhận TaskEvent"""
+        if not self.on_task_event:
+            return None
+        return lambda stage, duration, nbytes: self.task_event(task, stt, stage, duration, nbytes)
+
+    def skip_reporter(self):
+        """Callback on_skip cho iter_unjournaled_tasks"""
+        if not self.on_task_event:
+            return None
+        return lambda key, task: self.task_event(key, task[0], STAGE_SKIPPED)
+
+    def create_limiter(self):
+        """Tạo limiter AIMD cho một lượt chạy; số luồng là mức trần"""
+        def on_change(limit, reason):
+            self.progress(f"⚙️ Số request đồng thời: {limit}/{self.thread_count} ({reason})")
+            self.event('limit_changed', limit=limit, max_limit=self.thread_count, reason=reason)
+        self.limiter = AdaptiveConcurrencyLimiter(self.thread_count, on_change=on_change)
+        # Pool HTTP giữ đủ session keep-alive cho số worker của lượt chạy
+        browser_sim.configure_pool(self.thread_count)
+        self._pool_start = browser_sim.pool_stats()
+        self.begin_metrics()
+        return self.limiter
+
+    def report_http_pool(self):
+        """Gửi event số liệu tái sử dụng session/kết nối HTTP trong lượt chạy"""
+        if self._pool_start is None:
+            return
+        stats = browser_sim.pool_stats()
+        delta = {key: stats[key] - self._pool_start[key] for key in ('hits', 'misses', 'connections', 'requests', 'reused')}
+        log.debug("HTTP pool: {} request, {} kết nối mới, {} lần dùng lại kết nối, session hit/miss {}/{}",
+                  delta['requests'], delta['connections'], delta['reused'], delta['hits'], delta['misses'])
+        self.event('http_pool', sessions=stats['sessions'], **delta)
+
+    def begin_metrics(self):
+        """Chụp mốc metrics đầu lượt chạy (summary cuối lượt chỉ tính phần tăng thêm)"""
+        self._metrics_start = metrics_registry.snapshot()
+        self.run_started_at = time.time()
+
+    def report_metrics(self, kind, skipped=0):
+        """Ghi tóm tắt metrics của lượt chạy ra thư mục output, trả về đường dẫn file (None nếu lỗi)"""
+        finished = time.time()
+        summary = {
+            'kind': kind,
+            'started_at': self.run_started_at,
+            'finished_at': finished,
+            'duration': round(finished - self.run_started_at, 3),
+            'succeeded': self.success_count,
+            'failed': self.error_count,
+            'skipped': skipped,
+            'cache_hits': self.cache_hits,
+            'images_saved': self.images_saved,
+            'metrics': metrics_registry.summary(since=self._metrics_start),
+        }
+        try:
+            path = write_run_summary(self.output_folder, summary)
+        except OSError as e:
+            log.warning("Không ghi được file metrics: {}", e)
+            return None
+        log.debug("Đã ghi metrics lượt chạy: {}", path)
+        self.event('metrics_summary', path=path)
+        return path
+
+    def report_saved_images(self):
+        """Báo số ảnh lấy từ result cache và số biến thể thêm đã lưu trong lượt chạy; chờ catalog ghi xong"""
+        if self.catalog is not None:
+            self.catalog.flush()
+        if self.cache_hits:
+            self.progress(f"♻️ {self.cache_hits} ảnh lấy từ result cache (không gọi API)")
+        extra = self.images_saved - self.success_count
+        if extra > 0:
+            self.progress(f"🖼️ Đã lưu {self.images_saved} file ảnh, gồm {extra} biến thể thêm (STT_PROMPT_v2.jpg, ...)")
+
+    def report_trace(self):
+        """Ghi các trace đã lấy mẫu trong lượt chạy ra thư mục output (không làm gì nếu tracing tắt)"""
+        if not tracer.enabled:
+            return None
+        try:
+            path = tracer.write(self.output_folder)
+        except OSError as e:
+            log.warning("Không ghi được file trace: {}", e)
+            return None
+        if path:
+            self.progress(f"🧭 Trace: {path}")
+            self.event('trace_written', path=path)
+        return path
+
+    def cached_generation(self, task, stt, fingerprint, image_path_for, generate):
+        """Lấy ảnh từ result cache nếu có (không gọi API), ngược lại gọi generate()
+
+        Task gọi API được nhớ fingerprint để record_result đưa ảnh vừa lưu vào cache.
+        """
+        if self.result_cache is None or fingerprint is None:
+            return generate()
+        if not self.force_regenerate:
+            data = self.result_cache.materialize(fingerprint, image_path_for)
+            RESULT_CACHE_LOOKUPS.inc(outcome="hit" if data else "miss")
+            if data:
+                self.progress(f"♻️ STT {stt}: dùng lại ảnh đã tạo trước đó (không gọi API)")
+                result = WhiskResult(RequestOutcome.SUCCESS, data=data, status_code=200)
+                result.from_cache = True
+                return result
+        self._fingerprints[task] = fingerprint
+        return generate()
+
+    def create_pipeline(self):
+        """Pipeline network -> decode -> disk: thread_count worker network, decode/disk có pool nhỏ riêng
+
+        Khi có postprocess_specs, pipeline kèm thêm giai đoạn hậu xử lý chạy trong process pool.
+        """
+        self.postprocessor = None
+        if self.postprocess_specs:
+            self.postprocessor = PostProcessor(self.postprocess_specs, self.postprocess_workers)
+        return ImagePipeline(self.thread_count, self.decode_workers, self.disk_workers,
+                             postprocessor=self.postprocessor)
+
+    def report_pipeline(self, pipeline):
+        """Gửi event thời gian bận/bị chặn của từng giai đoạn pipeline"""
+        stages = pipeline.stats_dict()
+        log.debug("Pipeline: {}", stages)
+        self.event('pipeline_stats', stages=stages)
+        if pipeline.postprocessor is not None:
+            stats = pipeline.postprocessor.stats_dict()
+            self.event('postprocess_stats', **stats)
+            self.progress(f"🖼️ Hậu xử lý: {stats['processed']} ảnh -> {stats['outputs']} file "
+                          f"({stats['deferred']} ảnh xử lý sau khi tải xong)")
+            if stats['failed']:
+                self.progress(f"⚠️ Hậu xử lý lỗi {stats['failed']} ảnh: {'; '.join(stats['errors'])}", LOG_WARNING)
+
+    def finish_task_result(self, stt, filename, result, label=""):
+        """Kiểm tra result cuối cùng của pipeline (đã ghi file) và báo tiến độ"""
+        if not isinstance(result, WhiskResult):
+            return result
+        result = image_saved_result(result)
+        if result.ok:
+            self.progress(f"✅ Đã lưu thành công{label}: {filename}", LOG_SUCCESS)
+            log.success("Đã lưu thành công: {}", filename)
+        else:
+            self.progress(f"❌ Lỗi STT {stt}{label} - {result.describe()}", LOG_ERROR)
+            log.error("Lỗi STT {}: {}", stt, result.describe())
+        return result
+
+    def ensure_output_folder(self):
+        if not self.output_folder:
+            raise ValueError("Không có thư mục lưu ảnh được chỉ định")
+        os.makedirs(self.output_folder, exist_ok=True)
+
+    def catalog_images(self, stt, result, prompt, seed, mode, aspect_ratio=None, model=None):
+        """Đưa mọi ảnh (biến thể) đã lưu của result vào catalog (ghi ở thread nền của catalog)"""
+        if self.catalog is None or not isinstance(result, WhiskResult) or not result:
+            return
+        account = self.account or hashlib.sha1(str(self.cookie).encode('utf-8')).hexdigest()[:12]
+        source = 'cache' if result.from_cache else 'api'
+        for variant, image in enumerate(iter_saved_images(result.data), start=1):
+            self.catalog.record(image['savedPath'], stt=stt, prompt=prompt, seed=seed, model=model,
+                                aspect_ratio=aspect_ratio, account=account, mode=mode, variant=variant,
+                                bytes=image.get('savedBytes'), sha256=image.get('savedSha256'),
+                                request_seconds=round(result.elapsed, 4),
+                                attempts=result.attempts, source=source)
+
+    def record_result(self, stt, result, key=None, **task_info):
+        """Cập nhật thống kê, journal, catalog và event cho kết quả một task
+
+        task_info: prompt, seed, mode, aspect_ratio, model của task (để ghi catalog)
+        """
+        if key is not None and self.journal is not None:
+            journal_task_result(self.journal, key, result)
+        fingerprint = self._fingerprints.pop(stt if key is None else key, None)
+        if result and getattr(result, 'from_cache', False):
+            self.cache_hits += 1
+            if self.postprocessor is not None:
+                # Ảnh lấy từ cache không qua giai đoạn disk: hậu xử lý từ file vừa tạo
+                for path in saved_paths(result):
+                    self.postprocessor.submit(path)
+        elif result and fingerprint:
+            self.result_cache.store(fingerprint, result.data)
+        if result:
+            self.success_count += 1
+            if isinstance(result, WhiskResult):
+                self.images_saved += len(saved_paths(result))
+                if task_info:
+                    self.catalog_images(stt, result, **task_info)
+        else:
+            self.error_count += 1
+            emit_failure_hints(self.progress, result, self.shown_hints)
+            if isinstance(result, WhiskResult):
+                self.last_failure = result
+        self.event('task_finished', stt=stt, ok=bool(result),
+                   outcome=getattr(result, 'outcome', 'exception'),
+                   reason=None if result else getattr(result, 'describe', lambda: "Lỗi không xác định")(),
+                   path=first_saved_path(result) if result else None,
+                   paths=saved_paths(result) if result else [],
+                   attempts=getattr(result, 'attempts', 0),
+                   cached=getattr(result, 'from_cache', False),
+                   elapsed=round(getattr(result, 'elapsed', 0.0), 4))
+        self.task_event(stt if key is None else key, stt, STAGE_DONE if result else STAGE_FAILED,
+                        getattr(result, 'elapsed', None),
+                        error=None if result else getattr(result, 'outcome', 'exception'))
+
+    def record_exception(self, stt, error, key=None):
+        if key is not None and self.journal is not None:
+            self.journal.mark_failed(key, str(error))
+        self._fingerprints.pop(stt if key is None else key, None)
+        self.error_count += 1
+        self.event('task_finished', stt=stt, ok=False, outcome='exception', reason=str(error), path=None, attempts=0,
+                   elapsed=0.0)
+        self.task_event(stt if key is None else key, stt, STAGE_FAILED, error=type(error).__name__)
+
+    def with_access_token(self, stt, call):
+        """Gọi call(access_token) với token hiện tại của tài khoản
+
+        Nếu bị 401, token được làm mới một lần (dùng chung cho mọi worker) và task được chạy lại.
+        """
+        access_token = token_manager.get_token(self.cookie, self.access_token) or self.access_token
+        result = call(access_token)
+        if isinstance(result, WhiskResult) and result.is_auth_error:
+            new_token = token_manager.refresh_after_auth_error(self.cookie, access_token)
+            if new_token:
+                self.progress(f"🔑 STT {stt}: token hết hạn giữa chừng - đã lấy token mới, đang chạy lại", LOG_STATUS)
+                result = call(new_token)
+        return result
+
+    def failure_reason(self):
+        return self.last_failure.describe() if self.last_failure else "Không rõ nguyên nhân"
+
+class ExcelBatchRunner(BatchRunner):
+    """Tạo ảnh từ Excel (Prompt to Image / Image to Image tự nhận diện theo dòng)"""
+
+    def __init__(self, cookie, access_token, excel_path, output_folder, seed, thread_count,
+                 aspect_ratio="IMAGE_ASPECT_RATIO_LANDSCAPE", progress=None, on_event=None,
+                 decode_workers=None, disk_workers=None, on_task_event=None, result_cache=None,
+                 force_regenerate=False, catalog=None, account=None):
+        super().__init__(cookie, output_folder, thread_count, progress, on_event, on_task_event)
+        self.result_cache = result_cache
+        self.force_regenerate = force_regenerate
+        self.catalog = catalog
+        self.account = account
+        self.access_token = access_token
+        self.decode_workers = decode_workers or self.decode_workers
+        self.disk_workers = disk_workers or self.disk_workers
+        self.excel_path = excel_path
+        self.seed = seed
+        self.aspect_ratio = aspect_ratio
+
+    def build_tasks(self, excel_data):
+        """Tạo task từ từng dòng Excel (generator - không giữ toàn bộ danh sách task)"""
+        for i, data in enumerate(excel_data):
+            stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, mode = data
+            if mode == "Image to Image":
+                yield (stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption,
+                       self.access_token, self.cookie, self.output_folder, self.seed + i, self.aspect_ratio, "img2img")
+            else:
+                yield (stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption,
+                       self.access_token, self.output_folder, self.seed + i, self.aspect_ratio, "prompt")
+
+    def run(self):
+        self.ensure_output_folder()
+
+        # Đọc dữ liệu Excel theo từng dòng khi scheduler cần
+        self.progress("Đang đọc file Excel...")
+        excel_data = iter_generation_rows(self.excel_path, self.progress)
+        self.progress(f"Bắt đầu tạo ảnh với tối đa {self.thread_count} luồng...")
+        self.create_limiter()
+
+        # Journal: bỏ qua các dòng đã hoàn thành ở lần chạy trước (cùng file Excel và thư mục output)
+        self.journal = JobJournal.open_for(self.excel_path, self.output_folder)
+        counts = {'submitted': 0, 'skipped': 0}
+        try:
+            self.event('run_started', kind='excel')
+            self.run_tasks(iter_unjournaled_tasks(self.journal, self.build_tasks(excel_data),
+                                                  excel_task_identity, counts, self.skip_reporter()))
+        finally:
+            self.journal.close()
+        self.report_http_pool()
+        total, skipped_count = counts['submitted'], counts['skipped']
+        self.report_metrics('excel', skipped_count)
+        self.report_trace()
+        if skipped_count:
+            self.progress(f"⏭️ Đã bỏ qua {skipped_count} dòng đã hoàn thành ở lần chạy trước", LOG_STATUS)
+        self.report_saved_images()
+
+        if self.success_count > 0:
+            message = f"Tạo thành công {self.success_count}/{total} ảnh trong thư mục '{self.output_folder}'"
+            return BatchOutcome(True, message, self.success_count, self.error_count, skipped_count)
+        if not total and skipped_count:
+            message = f"Tất cả {skipped_count} dòng đã hoàn thành trước đó trong thư mục '{self.output_folder}'"
+            return BatchOutcome(True, message, 0, 0, skipped_count)
+        if not total:
+            return BatchOutcome(False, "Không có dữ liệu trong file Excel")
+        return BatchOutcome(False, f"Không tạo được ảnh nào - {self.failure_reason()}", 0, self.error_count, skipped_count)
+
+    def run_tasks(self, tasks):
+        """Chạy task theo cửa sổ: lấy dần từ iterator, tối đa thread_count × SUBMIT_WINDOW_FACTOR task đang xử lý
+
+        Mỗi ảnh tham chiếu chỉ upload một lần, song song có giới hạn; dòng img2img được chạy
+        ngay khi các ảnh của chính nó upload xong (dòng đang chờ upload cũng tính vào cửa sổ).
+        """
+        tasks = iter(tasks)
+        window = self.thread_count * SUBMIT_WINDOW_FACTOR
+        reference_uploads = {}    # path -> upload_data (None nếu upload lỗi)
+        path_futures = {}         # future upload -> path
+        waiting_by_path = {}      # path -> các [task, số ảnh chưa upload xong] đang chờ ảnh đó
+        future_to_task = {}
+        state = {'waiting': 0, 'uploads': 0}
+        upload_workers = max(1, min(self.thread_count, MAX_PREFLIGHT_UPLOADS))
+
+        with ThreadPoolExecutor(max_workers=upload_workers) as upload_executor, \
+                self.create_pipeline() as pipeline:
+
+            def fill_window():
+                while len(future_to_task) + state['waiting'] < window:
+                    task = next(tasks, None)
+                    if task is None:
+                        return
+                    # Lấy mode từ task data (phần tử cuối cùng)
+                    paths = task_reference_paths(task) if task[-1] == "img2img" else []
+                    paths = [path for path in paths if path not in reference_uploads]
+                    if not paths:
+                        future_to_task[self.submit_generation(pipeline, task, reference_uploads)] = task
+                        continue
+                    waiting = [task, len(paths)]
+                    state['waiting'] += 1
+                    for path in paths:
+                        if path not in waiting_by_path:
+                            waiting_by_path[path] = []
+                            path_futures[upload_executor.submit(upload_image_to_google_labs, self.cookie, path)] = path
+                            if state['uploads'] == 0:
+                                self.progress(f"📤 Upload ảnh tham chiếu (không trùng) với {upload_workers} luồng...")
+                            state['uploads'] += 1
+                        waiting_by_path[path].append(waiting)
+
+            # Xử lý upload và kết quả tạo ảnh khi hoàn thành, bổ sung task mới vào cửa sổ
+            fill_window()
+            while future_to_task or path_futures:
+                done, _ = wait(set(future_to_task) | set(path_futures), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in path_futures:
+                        path = path_futures.pop(future)
+                        try:
+                            reference_uploads[path] = future.result()
+                        except Exception as e:
+                            log.error("Lỗi upload {}: {}", path, e)
+                            reference_uploads[path] = None
+                        if reference_uploads[path] is None:
+                            self.progress(f"❌ Upload thất bại: {os.path.basename(path)}", LOG_ERROR)
+                        self.event('reference_uploaded', path=path, ok=reference_uploads[path] is not None)
+                        for waiting in waiting_by_path.pop(path):
+                            waiting[1] -= 1
+                            if waiting[1] == 0:
+                                state['waiting'] -= 1
+                                future_to_task[self.submit_generation(pipeline, waiting[0], reference_uploads)] = waiting[0]
+                        continue
+
+                    task = future_to_task.pop(future)
+                    stt = task[0]
+
+                    try:
+                        label = " img2img" if task[-1] == "img2img" else ""
+                        result = self.finish_task_result(stt, sanitize_filename(stt, task[1]), future.result(), label)
+                        if result:
+                            self.progress(f"✅ Hoàn thành STT {stt}", LOG_SUCCESS)
+                        self.record_result(stt, result, excel_task_key(task), prompt=task[1], seed=task[-3],
+                                           mode=task[-1], aspect_ratio=task[-2], model=DEFAULT_IMAGE_MODEL)
+                    except Exception as e:
+                        self.record_exception(stt, e, excel_task_key(task))
+                        self.progress(f"❌ Exception STT {stt}: {str(e)}", LOG_ERROR)
+                        if "401" in str(e) or "authentication" in str(e).lower():
+                            self.progress("💡 Lỗi xác thực - Vui lòng cập nhật cookie mới", LOG_HINT)
+                fill_window()
+            if state['uploads']:
+                self.progress(f"📤 Đã upload {state['uploads']} ảnh tham chiếu (không trùng)")
+        self.report_pipeline(pipeline)
+
+    def submit_generation(self, pipeline, task, reference_uploads):
+        """Submit task tạo ảnh (prompt/img2img) vào pipeline, có ghi journal"""
+        if task[-1] == "img2img":
+            process = lambda task_data: self.process_single_img2img_task(task_data, reference_uploads)
+        else:
+            process = self.process_single_image_task
+        # Ảnh được lưu vào output_folder/STT_PROMPT.jpg (biến thể thêm: STT_PROMPT_v2.jpg, ...) ở giai đoạn disk
+        image_path_for = all_images_target(task[-4], sanitize_filename(task[0], task[1]))
+        key = excel_task_key(task)
+        fingerprint = self.task_fingerprint(task)
+        generate = lambda task_data: self.cached_generation(key, task_data[0], fingerprint, image_path_for,
+                                                            lambda: process(task_data))
+        self.task_event(key, task[0], STAGE_QUEUED)
+        return pipeline.submit(lambda: run_journaled(self.journal, key, generate, task), image_path_for,
+                               self.stage_reporter(key, task[0]), tracer.begin("image", stt=task[0], task=key))
+
+    def task_fingerprint(self, task):
+        """Fingerprint result cache của task Excel (None nếu cache tắt)"""
+        if self.result_cache is None:
+            return None
+        references = task_references(task) if task[-1] == "img2img" else None
+        return generation_fingerprint(task[1], task[-3], task[-2], references)
+
+    def process_single_image_task(self, task_data):
+        """Giai đoạn network của task tạo ảnh: gọi API và trả về response thô (chưa decode)"""
+        try:
+            # Kiểm tra mode để unpack đúng số lượng phần tử
+            task_mode = task_data[-1]  # Lấy mode từ phần tử cuối
+
+            if task_mode == "img2img":
+                stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, access_token, cookie, output_folder, seed, aspect_ratio, task_mode = task_data
+            else:
+                stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, access_token, output_folder, seed, aspect_ratio, task_mode = task_data
+
+            # Gọi API tạo ảnh (chỉ dùng prompt); decode và ghi file do pipeline đảm nhận
+            return self.with_access_token(stt, lambda token: generate_image(
+                token, prompt, seed, aspect_ratio, output_folder=output_folder,
+                limiter=self.limiter, defer_decode=True))
+
+        except Exception as e:
+            # Log lỗi chi tiết để debug
+            import traceback
+            self.progress(f"❌ Exception trong process_single_image_task: {str(e)}", LOG_ERROR)
+            log.error("Exception trong process_single_image_task: {}", e)
+            self.progress(f"❌ Traceback: {traceback.format_exc()}", LOG_ERROR)
+            log.error("Traceback: {}", traceback.format_exc())
+            return False
+
+    def process_single_img2img_task(self, task_data, reference_uploads=None):
+        """Giai đoạn network của task tạo ảnh từ nhiều ảnh: gọi API và trả về response thô (chưa decode)
+
+        reference_uploads: kết quả upload từ bước pre-flight (path -> upload_data); nếu không có thì tự upload.
+        """
+        stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, access_token, cookie, output_folder, seed, aspect_ratio, task_mode = task_data
+
+        try:
+            upload_data_list = build_upload_data_list(cookie, task_references(task_data), reference_uploads)
+
+            if upload_data_list:
+                return self.with_access_token(stt, lambda token: generate_image_from_multiple_images(
+                    token, upload_data_list, prompt, seed, DEFAULT_IMAGE_MODEL, aspect_ratio, output_folder,
+                    limiter=self.limiter, defer_decode=True))
+            return WhiskResult(RequestOutcome.INVALID_INPUT, error_message="Không upload được ảnh tham chiếu")
+
+        except Exception as e:
+            # Log lỗi chi tiết để debug (thường là lỗi đọc/upload ảnh tham chiếu trước khi gửi request)
+            import traceback
+            self.progress(f"❌ Exception trong process_single_img2img_task: {str(e)}", LOG_ERROR)
+            log.error("Exception trong process_single_img2img_task: {}", e)
+            self.progress(f"❌ Traceback: {traceback.format_exc()}", LOG_ERROR)
+            log.error("Traceback: {}", traceback.format_exc())
+            return WhiskResult(RequestOutcome.INVALID_INPUT, error_message=str(e))
+
+class SinglePromptRunner(BatchRunner):
+    """Tạo nhiều ảnh từ một prompt (Prompt to Image hoặc Image to Image với subject/scene/style)"""
+
+    def __init__(self, cookie, access_token, prompt, mode, subject_path=None, scene_path=None, style_path=None,
+                 subject_caption="", scene_caption="", style_caption="", seed=0, count=1,
+                 aspect_ratio="IMAGE_ASPECT_RATIO_LANDSCAPE", output_folder=None, progress=None, on_event=None,
+                 on_task_event=None, result_cache=None, force_regenerate=False, catalog=None, account=None,
+                 thread_count=1):
+        super().__init__(cookie, output_folder, thread_count, progress, on_event, on_task_event)
+        self.result_cache = result_cache
+        self.force_regenerate = force_regenerate
+        self.catalog = catalog
+        self.account = account
+        self.access_token = access_token
+        self.prompt = prompt
+        self.mode = mode
+        self.references = [
+            (subject_path, subject_caption, 'Subject', 'MEDIA_CATEGORY_SUBJECT'),
+            (scene_path, scene_caption, 'Scene', 'MEDIA_CATEGORY_SCENE'),
+            (style_path, style_caption, 'Style', 'MEDIA_CATEGORY_STYLE'),
+        ]
+        self.seed = seed
+        self.count = count
+        self.aspect_ratio = aspect_ratio
+        self._upload_lock = threading.Lock()
+        self._upload_data_list = None  # Recipe input của ảnh tham chiếu, upload khi ảnh đầu tiên cần gọi API
+
+    def run(self):
+        self.ensure_output_folder()
+        if self.mode not in ("Prompt to Image", "Image to Image"):
+            return BatchOutcome(False, f"Mode không hợp lệ: {self.mode}")
+        kind = 'text2img' if self.mode == "Prompt to Image" else 'img2img'
+        self.event('run_started', kind=kind, total=self.count, skipped=0)
+        self.progress(f"Bắt đầu tạo {self.count} ảnh với tối đa {self.thread_count} luồng...")
+        self.create_limiter()
+
+        self.run_tasks()
+        self.report_http_pool()
+        self.report_metrics(kind)
+        self.report_trace()
+        self.report_saved_images()
+        if self.success_count > 0:
+            return BatchOutcome(True, f"Tạo thành công {self.success_count} ảnh trong thư mục '{self.output_folder}'",
+                                self.success_count, self.error_count)
+        return BatchOutcome(False, f"Không tạo được ảnh nào - {self.failure_reason()}", 0, self.error_count)
+
+    def run_tasks(self):
+        """Chạy count ảnh qua pipeline như ExcelBatchRunner: tối đa thread_count × SUBMIT_WINDOW_FACTOR ảnh đang xử lý
+
+        Prompt to Image dừng submit ảnh mới khi gặp lỗi xác thực/rate limit (tránh spam lỗi).
+        """
+        indexes = iter(range(self.count))
+        window = self.thread_count * SUBMIT_WINDOW_FACTOR
+        state = {'stopped': False}
+        with self.create_pipeline() as pipeline:
+            future_to_index = {}
+
+            def fill_window():
+                while not state['stopped'] and len(future_to_index) < window:
+                    i = next(indexes, None)
+                    if i is None:
+                        return
+                    future_to_index[self.submit_image(pipeline, i)] = i
+
+            # Xử lý kết quả khi hoàn thành, bổ sung ảnh mới vào cửa sổ
+            fill_window()
+            while future_to_index:
+                done, _ = wait(set(future_to_index), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stt = future_to_index.pop(future) + 1
+                    try:
+                        result = self.finish_task_result(stt, sanitize_filename(stt, self.prompt), future.result())
+                        self.record_result(stt, result, prompt=self.prompt, seed=self.seed + stt - 1,
+                                           mode="prompt" if self.mode == "Prompt to Image" else "img2img",
+                                           aspect_ratio=self.aspect_ratio, model=DEFAULT_IMAGE_MODEL)
+                    except Exception as e:
+                        self.record_exception(stt, e)
+                        self.progress(f"❌ Exception ảnh {stt}: {str(e)}", LOG_ERROR)
+                        continue
+                    if (self.mode == "Prompt to Image" and isinstance(result, WhiskResult)
+                            and (result.is_auth_error or result.is_rate_limited)):
+                        state['stopped'] = True
+                fill_window()
+        self.report_pipeline(pipeline)
+
+    def submit_image(self, pipeline, i):
+        """Submit ảnh thứ i vào pipeline (lấy từ result cache nếu có)"""
+        stt = i + 1
+        # Ảnh được lưu vào output_folder/STT_PROMPT.jpg (biến thể thêm: STT_PROMPT_v2.jpg, ...) ở giai đoạn disk
+        image_path_for = all_images_target(self.output_folder, sanitize_filename(stt, self.prompt))
+        fingerprint = self.image_fingerprint(i, self.references if self.mode == "Image to Image" else None)
+        self.task_event(stt, stt, STAGE_QUEUED)
+        return pipeline.submit(lambda: self.cached_generation(stt, stt, fingerprint, image_path_for,
+                                                              lambda: self.request_image(i)),
+                               image_path_for, self.stage_reporter(stt, stt), tracer.begin("image", stt=stt))
+
+    def image_fingerprint(self, i, references=None):
+        """Fingerprint result cache của ảnh thứ i (None nếu cache tắt)"""
+        if self.result_cache is None:
+            return None
+        return generation_fingerprint(self.prompt, self.seed + i, self.aspect_ratio, references)
+
+    def request_image(self, i):
+        """Giai đoạn network của ảnh thứ i: gọi API và trả về response thô (chưa decode)"""
+        if self.mode == "Prompt to Image":
+            return self.with_access_token(i + 1, lambda token: generate_image(
+                token, self.prompt, self.seed + i, self.aspect_ratio, output_folder=self.output_folder,
+                limiter=self.limiter, defer_decode=True))
+        upload_data_list = self.reference_upload_list()
+        if not upload_data_list:
+            return WhiskResult(RequestOutcome.INVALID_INPUT, error_message="Không upload được ảnh tham chiếu")
+        return self.with_access_token(i + 1, lambda token: generate_image_from_multiple_images(
+            token, upload_data_list, self.prompt, self.seed + i, DEFAULT_IMAGE_MODEL, self.aspect_ratio,
+            self.output_folder, limiter=self.limiter, defer_decode=True))
+
+    def reference_upload_list(self):
+        """Upload ảnh tham chiếu một lần cho cả lượt chạy; mọi seed dùng lại cùng media ID
+
+        Worker đầu tiên cần gọi API sẽ upload, các worker khác chờ rồi dùng lại kết quả (kể cả khi lỗi).
+        Ảnh nào cũng lấy được từ result cache thì không upload gì cả.
+        """
+        with self._upload_lock:
+            if self._upload_data_list is None:
+                self.progress("Đang upload ảnh...")
+                self._upload_data_list = build_upload_data_list(self.cookie, self.references)
+                if self._upload_data_list:
+                    self.progress(f"✅ Upload thành công {len(self._upload_data_list)} ảnh tham chiếu", LOG_SUCCESS)
+                else:
+                    self.progress("❌ Không có ảnh nào được upload thành công", LOG_ERROR)
+            return self._upload_data_list
+
+class SyncBatchRunner(BatchRunner):
+    """Đồng bộ: edit một ảnh gốc theo từng prompt trong Excel, hoặc retry các task lỗi trong journal"""
+
+    def __init__(self, cookie, media_generation_id, raw_bytes, excel_path, seed, thread_count, output_folder,
+                 progress=None, on_event=None, decode_workers=None, disk_workers=None, on_task_event=None,
+                 catalog=None, account=None):
+        super().__init__(cookie, output_folder, thread_count, progress, on_event, on_task_event)
+        self.catalog = catalog
+        self.account = account
+        self.decode_workers = decode_workers or self.decode_workers
+        self.disk_workers = disk_workers or self.disk_workers
+        self.media_generation_id = media_generation_id
+        self.raw_bytes = raw_bytes
+        self.excel_path = excel_path
+        self.seed = seed
+        self.failed_tasks = []  # Danh sách các task thất bại trong lượt chạy này
+
+    def run(self):
+        self.ensure_output_folder()
+
+        # Đọc dữ liệu Excel theo từng dòng khi scheduler cần
+        self.progress("Đang đọc file Excel...")
+        self.progress(f"Bắt đầu edit ảnh với tối đa {self.thread_count} luồng...")
+        self.create_limiter()
+
+        # Journal: bỏ qua các dòng đã hoàn thành ở lần chạy trước (cùng file Excel và thư mục output)
+        self.journal = JobJournal.open_for(self.excel_path, self.output_folder)
+        counts = {'submitted': 0, 'skipped': 0}
+        try:
+            self.event('run_started', kind='sync')
+            self.run_tasks(iter_unjournaled_tasks(self.journal, self.build_tasks(iter_sync_rows(self.excel_path)),
+                                                  sync_task_identity, counts, self.skip_reporter()),
+                           "Hoàn thành", "Thất bại")
+        finally:
+            self.journal.close()
+        self.report_http_pool()
+        total, skipped_count = counts['submitted'], counts['skipped']
+        self.report_metrics('sync', skipped_count)
+        self.report_trace()
+        self.report_saved_images()
+        if not total and not skipped_count:
+            return BatchOutcome(False, "Không có dữ liệu hợp lệ trong file Excel")
+        if skipped_count:
+            self.progress(f"⏭️ Đã bỏ qua {skipped_count} dòng đã hoàn thành ở lần chạy trước", LOG_STATUS)
+
+        # Hiển thị thống kê chi tiết
+        self.progress("📊 THỐNG KÊ KẾT QUẢ:", LOG_STATS)
+        self.progress(f"✅ Thành công: {self.success_count}/{total} ảnh", LOG_SUCCESS)
+        self.progress(f"❌ Thất bại: {self.error_count}/{total} ảnh", LOG_ERROR)
+
+        if self.failed_tasks:
+            self.progress(f"🔄 Có {len(self.failed_tasks)} ảnh thất bại có thể retry", LOG_STATUS)
+            self.progress("💡 Nhấn nút 'Retry Lỗi' để chạy lại các ảnh thất bại", LOG_HINT)
+
+        if self.success_count > 0:
+            message = f"Đồng bộ thành công {self.success_count}/{total} ảnh trong thư mục '{self.output_folder}'"
+            return BatchOutcome(True, message, self.success_count, self.error_count, skipped_count)
+        if not total:
+            message = f"Tất cả {skipped_count} dòng đã hoàn thành trước đó trong thư mục '{self.output_folder}'"
+            return BatchOutcome(True, message, 0, 0, skipped_count)
+        return BatchOutcome(False, f"Không edit được ảnh nào. Tổng lỗi: {self.error_count}", 0, self.error_count, skipped_count)
+
+    def build_tasks(self, valid_data):
+        """Tạo task từ từng dòng (STT, PROMPT) (generator - không giữ toàn bộ danh sách task)"""
+        for i, (stt, prompt) in enumerate(valid_data):
+            yield (stt, prompt, self.cookie, self.media_generation_id,
+                   self.raw_bytes, self.seed + i, self.output_folder)
+
+    def retry_tasks_from_journal(self):
+        """Tạo lại task từ các entry lỗi/dở dang trong journal với ảnh gốc và cookie hiện tại"""
+        return [(entry['stt'], entry['prompt'], self.cookie, self.media_generation_id,
+                 self.raw_bytes, entry['seed'], self.output_folder)
+                for entry in unfinished_sync_entries(self.excel_path, self.output_folder)]
+
+    def retry(self, tasks=None):
+        """Chạy lại các task thất bại (mặc định: đọc từ journal)"""
+        if tasks is None:
+            tasks = self.retry_tasks_from_journal()
+        if not tasks:
+            return BatchOutcome(True, "Không có task nào để retry")
+        self.progress(f"🔄 Bắt đầu retry {len(tasks)} ảnh thất bại...", LOG_STATUS)
+        self.create_limiter()
+        self.journal = JobJournal.open_for(self.excel_path, self.output_folder)
+        try:
+            self.event('run_started', kind='retry', total=len(tasks))
+            self.run_tasks(tasks, "Retry thành công", "Retry thất bại")
+        finally:
+            self.journal.close()
+        self.report_http_pool()
+        self.report_metrics('retry')
+        self.report_trace()
+        self.report_saved_images()
+
+        # Hiển thị thống kê chi tiết
+        self.progress("📊 THỐNG KÊ RETRY:", LOG_STATS)
+        self.progress(f"✅ Thành công: {self.success_count}/{len(tasks)} ảnh", LOG_SUCCESS)
+        self.progress(f"❌ Vẫn thất bại: {self.error_count}/{len(tasks)} ảnh", LOG_ERROR)
+
+        if self.failed_tasks:
+            self.progress(f"🔄 Còn {len(self.failed_tasks)} ảnh thất bại có thể retry tiếp", LOG_STATUS)
+        else:
+            self.progress("🎉 Đã retry thành công tất cả ảnh!", LOG_SUCCESS)
+
+        if self.success_count > 0:
+            return BatchOutcome(True, f"Retry thành công {self.success_count}/{len(tasks)} ảnh", self.success_count, self.error_count)
+        return BatchOutcome(False, f"Retry thất bại tất cả {len(tasks)} ảnh", 0, self.error_count)
+
+    def run_tasks(self, tasks, success_label, failure_label):
+        # Pipeline network -> decode -> disk: worker network không phải chờ giải mã/ghi file.
+        # Task được lấy dần từ iterator, tối đa thread_count × SUBMIT_WINDOW_FACTOR task đang xử lý
+        tasks = iter(tasks)
+        window = self.thread_count * SUBMIT_WINDOW_FACTOR
+        with self.create_pipeline() as pipeline:
+            future_to_task = {}
+
+            def fill_window():
+                while len(future_to_task) < window:
+                    task = next(tasks, None)
+                    if task is None:
+                        return
+                    key = sync_task_key(task)
+                    request = lambda task=task, key=key: run_journaled(self.journal, key,
+                                                                       self.process_single_sync_task, task)
+                    image_path_for = all_images_target(task[6], sanitize_filename(task[0], task[1]))
+                    self.task_event(key, task[0], STAGE_QUEUED)
+                    future = pipeline.submit(request, image_path_for, self.stage_reporter(key, task[0]),
+                                             tracer.begin("image", stt=task[0], task=key))
+                    future_to_task[future] = task
+
+            # Xử lý kết quả khi hoàn thành, bổ sung task mới vào cửa sổ
+            fill_window()
+            while future_to_task:
+                done, _ = wait(set(future_to_task), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = future_to_task.pop(future)
+                    stt = task[0]
+                    prompt = task[1]
+
+                    try:
+                        result = self.finish_task_result(stt, sanitize_filename(stt, prompt), future.result())
+                        if result:
+                            self.progress(f"✅ {success_label} STT {stt}", LOG_SUCCESS)
+                        else:
+                            self.progress(f"❌ {failure_label} STT {stt}", LOG_ERROR)
+                            self.progress(f"🔍 Prompt: {prompt[:50]}...", LOG_HINT)
+                            self.failed_tasks.append(task)
+                        self.record_result(stt, result, sync_task_key(task), prompt=prompt, seed=task[5],
+                                           mode=SYNC_JOURNAL_MODE)
+                    except Exception as e:
+                        self.progress(f"❌ Exception STT {stt}: {str(e)}", LOG_ERROR)
+                        self.progress(f"🔍 Prompt: {prompt[:50]}...", LOG_HINT)
+                        self.failed_tasks.append(task)
+                        self.record_exception(stt, e, sync_task_key(task))
+                fill_window()
+        self.report_pipeline(pipeline)
+
+    def process_single_sync_task(self, task_data):
+        """Giai đoạn network của task edit ảnh: gọi API và trả về response thô (chưa decode)"""
+        stt, prompt, cookie, media_generation_id, raw_bytes, seed, output_folder = task_data
+
+        try:
+            # Gọi API edit image; decode và ghi file do pipeline đảm nhận
+            return edit_image_with_prompt(cookie, media_generation_id, raw_bytes, prompt, seed,
+                                          limiter=self.limiter, defer_decode=True)
+
+        except Exception as e:
+            # Log lỗi chi tiết để debug
+            import traceback
+            self.progress(f"❌ Exception STT {stt}: {str(e)}", LOG_ERROR)
+            self.progress(f"🔍 Prompt: {prompt[:50]}...", LOG_HINT)
+            self.progress(f"🔧 Traceback: {traceback.format_exc()}", LOG_HINT)
+            return False
+
+# ===== COMMAND LINE =====
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m batch_engine",
+                                     description="Chạy batch Whisk không cần GUI")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_common(sub, excel_required):
+        sub.add_argument("--account", help="Tên tài khoản trong cookies.json (bỏ trống nếu chỉ có một)")
+        sub.add_argument("--cookies-file", default="cookies.json", help="File tài khoản (mặc định: cookies.json)")
+        sub.add_argument("--output", required=True, help="Thư mục lưu ảnh")
+        sub.add_argument("--seed", type=int, default=0, help="Seed bắt đầu (mặc định: 0)")
+        sub.add_argument("--aspect-ratio", choices=sorted(ASPECT_RATIOS), default="16:9", help="Tỷ lệ khung hình")
+        sub.add_argument("--json", action="store_true", help="In tiến độ dạng JSON Lines ra stdout")
+        sub.add_argument("--metrics-port", type=int, default=None,
+                         help="Bật endpoint Prometheus /metrics trên cổng này (mặc định: biến WHISK_METRICS_PORT)")
+        sub.add_argument("--trace-rate", type=float, default=None,
+                         help="Tỷ lệ ảnh được ghi trace, 0..1 (mặc định: biến WHISK_TRACE_RATE, không có thì tắt)")
+        sub.add_argument("--postprocess", default=None,
+                         help='Output hậu xử lý, vd: "webp,webp@256:70" (mặc định: biến WHISK_POSTPROCESS, không có thì tắt)')
+        sub.add_argument("--postprocess-workers", type=int, default=DEFAULT_POSTPROCESS_WORKERS,
+                         help=f"Số process hậu xử lý (mặc định: {DEFAULT_POSTPROCESS_WORKERS})")
+        sub.add_argument("--no-catalog", action="store_true",
+                         help="Không ghi ảnh đã lưu vào catalog SQLite (mặc định: WHISK_CATALOG_PATH hoặc output_catalog.sqlite3)")
+        if excel_required:
+            sub.add_argument("--excel", required=True, help="File đầu vào (.xlsx, .csv hoặc .jsonl)")
+            sub.add_argument("--threads", type=int, default=3, help="Số luồng tối đa (mặc định: 3)")
+            sub.add_argument("--decode-workers", type=int, default=DEFAULT_DECODE_WORKERS,
+                             help=f"Số luồng giải mã ảnh (mặc định: {DEFAULT_DECODE_WORKERS})")
+            sub.add_argument("--disk-workers", type=int, default=DEFAULT_DISK_WORKERS,
+                             help=f"Số luồng ghi file (mặc định: {DEFAULT_DISK_WORKERS})")
+
+    text2img = subparsers.add_parser("text2img", help="Tạo ảnh từ một prompt (kèm ảnh tham chiếu nếu có)")
+    add_common(text2img, excel_required=False)
+    text2img.add_argument("--prompt", required=True)
+    text2img.add_argument("--count", type=int, default=1, help="Số ảnh cần tạo")
+    text2img.add_argument("--threads", type=int, default=3, help="Số ảnh tạo đồng thời tối đa (mặc định: 3)")
+    text2img.add_argument("--subject", help="Ảnh subject (chuyển sang chế độ Image to Image)")
+    text2img.add_argument("--scene", help="Ảnh scene")
+    text2img.add_argument("--style", help="Ảnh style")
+    text2img.add_argument("--subject-caption", default="")
+    text2img.add_argument("--scene-caption", default="")
+    text2img.add_argument("--style-caption", default="")
+
+    excel = subparsers.add_parser("excel", help="Tạo ảnh từ Excel (Prompt to Image / Image to Image theo từng dòng)")
+    add_common(excel, excel_required=True)
+
+    # Result cache: ảnh cùng prompt/seed/model/tỷ lệ (và ảnh tham chiếu) đã tạo ở lần chạy trước được dùng lại
+    for sub in (text2img, excel):
+        sub.add_argument("--force-regenerate", action="store_true",
+                         help="Luôn gọi API, không dùng ảnh đã có trong result cache")
+        sub.add_argument("--no-result-cache", action="store_true", help="Tắt result cache (không đọc, không ghi)")
+
+    for name, help_text in (("sync", "Edit một ảnh gốc theo từng prompt trong Excel"),
+                            ("retry", "Chạy lại các dòng đồng bộ lỗi/dở dang trong journal")):
+        sub = subparsers.add_parser(name, help=help_text)
+        add_common(sub, excel_required=True)
+        sub.add_argument("--image", required=True, help="Ảnh gốc cần edit")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # Ở chế độ --json, stdout chỉ chứa event; log/spinner của engine chuyển sang stderr
+    events_out = sys.stdout
+    if args.json:
+        sys.stdout = sys.stderr
+
+        def on_event(event):
+            events_out.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+            events_out.flush()
+
+        def progress(message, level=LOG_INFO):
+            on_event({'event': 'log', 'ts': round(time.time(), 3), 'level': level, 'message': message})
+    else:
+        on_event = None
+
+        def progress(message, level=LOG_INFO):
+            print(message, flush=True)
+
+    if args.trace_rate is not None:
+        tracer.configure(args.trace_rate)
+    try:
+        metrics_server = start_metrics_server(args.metrics_port)
+    except (OSError, ValueError) as e:
+        progress(f"⚠️ Không bật được endpoint metrics: {e}", LOG_WARNING)
+    else:
+        if metrics_server:
+            progress(f"📈 Metrics: {metrics_server.url}")
+
+    try:
+        account_name, cookie, saved_access_token = load_account(args.account, args.cookies_file)
+    except Exception as e:
+        progress(f"❌ Không thể đọc thông tin tài khoản: {e}", LOG_ERROR)
+        sys.stdout = events_out
+        return 2
+    aspect_ratio = ASPECT_RATIOS[args.aspect_ratio]
+    catalog = None if args.no_catalog else output_catalog
+    try:
+        postprocess_specs = specs_from_env() if args.postprocess is None else parse_specs(args.postprocess)
+    except ValueError as e:
+        progress(f"❌ {e}", LOG_ERROR)
+        sys.stdout = events_out
+        return 2
+
+    def configure(runner):
+        """Áp dụng cấu hình hậu xử lý của dòng lệnh cho runner"""
+        runner.postprocess_specs = postprocess_specs
+        runner.postprocess_workers = args.postprocess_workers
+        return runner
+
+    try:
+        if args.command in ("sync", "retry"):
+            source = prepare_sync_source(cookie, args.image, args.aspect_ratio, progress)
+            if not source:
+                outcome = BatchOutcome(False, "Upload ảnh thất bại")
+            else:
+                runner = configure(SyncBatchRunner(cookie, source[0], source[1], args.excel, args.seed, args.threads,
+                                                   args.output, progress, on_event, args.decode_workers, args.disk_workers,
+                                                   catalog=catalog, account=account_name))
+                outcome = runner.run() if args.command == "sync" else runner.retry()
+        else:
+            access_token = resolve_access_token(cookie, saved_access_token, progress)
+            result_cache = None if args.no_result_cache else shared_result_cache
+            if not access_token:
+                outcome = BatchOutcome(False, AUTH_FAILED_MESSAGE)
+            elif args.command == "excel":
+                outcome = configure(ExcelBatchRunner(cookie, access_token, args.excel, args.output, args.seed, args.threads,
+                                                     aspect_ratio, progress, on_event, args.decode_workers, args.disk_workers,
+                                                     result_cache=result_cache, force_regenerate=args.force_regenerate,
+                                                     catalog=catalog, account=account_name)).run()
+            else:
+                has_references = args.subject or args.scene or args.style
+                outcome = configure(SinglePromptRunner(cookie, access_token, args.prompt,
+                                                       "Image to Image" if has_references else "Prompt to Image",
+                                                       args.subject, args.scene, args.style,
+                                                       args.subject_caption, args.scene_caption, args.style_caption,
+                                                       args.seed, args.count, aspect_ratio, args.output,
+                                                       progress, on_event, result_cache=result_cache,
+                                                       force_regenerate=args.force_regenerate,
+                                                       catalog=catalog, account=account_name,
+                                                       thread_count=args.threads)).run()
+    except Exception as e:
+        outcome = BatchOutcome(False, f"Lỗi: {str(e)}")
+
+    if on_event:
+        on_event(dict(outcome.to_dict(), event='run_finished', ts=round(time.time(), 3)))
+        sys.stdout = events_out
+    else:
+        if outcome.success:
+            progress(f"✅ {outcome.message}", LOG_SUCCESS)
+        else:
+            progress(f"❌ {outcome.message}", LOG_ERROR)
+    return 0 if outcome.success else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
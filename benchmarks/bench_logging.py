@@ -0,0 +1,111 @@
+"""Micro-benchmark: chi phí logging trên mỗi request khi DEBUG = False
+
+So sánh cách log cũ (f-string được format trước khi kiểm tra level) với
+LazyLogger (đối số trì hoãn). Response giả lập có body nhiều MB và payload
+chứa rawBytes như request edit ảnh thật.
+
+Chạy: python benchmarks/bench_logging.py [số_lần_lặp]
+"""
+import base64
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+import api
+from api import log, log_config
+
+BODY_SIZE = 4 * 1024 * 1024
+
+
+def _make_response():
+    """Tạo requests.Response giả với body JSON ~4MB"""
+    encoded = base64.b64encode(os.urandom(BODY_SIZE * 3 // 4)).decode()
+    response = requests.models.Response()
+    response.status_code = 200
+    response.headers.update({"Content-Type": "application/json", "X-Request-Id": "bench"})
+    response._content = json.dumps({"imagePanels": [{"generatedImages": [{"encodedImage": encoded}]}]}).encode()
+    response.encoding = "utf-8"
+    return response
+
+
+def _make_payload():
+    raw_bytes = "data:image/jpeg;base64," + base64.b64encode(os.urandom(1024 * 1024)).decode()
+    return {"json": {"editInput": {"mediaInput": {"rawBytes": raw_bytes}}}}
+
+
+def _eager_debug(message):
+    """Mô phỏng log_debug cũ: message đã được format trước khi kiểm tra level"""
+    if log_config.DEBUG and sys.stdout is not None:
+        print(message)
+
+
+def eager_request_logging(method, url, kwargs, payload, response):
+    """Các dòng log debug của make_request + generate_image theo kiểu cũ"""
+    _eager_debug(f"  - Method: {method}")
+    _eager_debug(f"  - URL: {url}")
+    _eager_debug(f"  - Headers: {kwargs.get('headers', {})}")
+    _eager_debug(f"  - Payload: {json.dumps(payload, indent=2)}")
+    _eager_debug(f"  - Status: {response.status_code if response else 'None'}")
+    _eager_debug(f"  - Response headers: {dict(response.headers)}")
+    _eager_debug(f"  - Response text length: {len(response.text) if response.text else 0}")
+    _eager_debug(f"  - Response text: {response.text[:500]}...")
+
+
+def lazy_request_logging(method, url, kwargs, payload, response):
+    """Cùng các dòng log trên nhưng qua LazyLogger"""
+    log.debug("  - Method: {}", method)
+    log.debug("  - URL: {}", url)
+    log.debug("  - Headers: {}", lambda: kwargs.get('headers', {}))
+    log.debug("  - Payload: {}", lambda: json.dumps(payload, indent=2))
+    log.debug("  - Status: {}", lambda: response.status_code if response else 'None')
+    log.debug("  - Response headers: {}", lambda: dict(response.headers))
+    log.debug("  - Response text length: {}", lambda: len(response.text) if response.text else 0)
+    log.debug("  - Response text: {}...", lambda: response.text[:500])
+
+
+def bench_make_request(iterations):
+    """Đo toàn bộ make_request với session và random_delay được thay bằng bản không I/O"""
+    response = _make_response()
+    sim = api.BrowserSimulator()
+    sim.random_delay = lambda *args, **kwargs: 0
+    session = requests.Session()
+    session.request = lambda *args, **kwargs: response
+    sim.session_pool.acquire = lambda: session
+    sim.session_pool.release = lambda s: None
+    timer = timeit.Timer(lambda: sim.make_request("POST", "https://example.invalid/v1/whisk:generateImage", timeout=60))
+    return min(timer.repeat(repeat=3, number=iterations)) / iterations
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    log_config.DEBUG = False
+
+    args = ("POST", "https://example.invalid/v1/whisk:generateImage",
+            {"headers": api.browser_sim.get_api_headers(access_token="bench")}, _make_payload())
+
+    def per_call(func):
+        # Tạo response mới mỗi vòng để response.text không được cache giữa các lần gọi
+        responses = [_make_response() for _ in range(iterations)]
+        it = iter(responses)
+        timer = timeit.Timer(lambda: func(*args, next(it)))
+        return timer.timeit(number=iterations) / iterations
+
+    eager = per_call(eager_request_logging)
+    lazy = per_call(lazy_request_logging)
+    full = bench_make_request(iterations)
+
+    print(f"Body: {BODY_SIZE // 1024} KB, payload rawBytes: 1024 KB, {iterations} lần lặp, DEBUG=False")
+    print(f"  Log kiểu cũ (eager f-string): {eager * 1e6:10.1f} µs/request")
+    print(f"  LazyLogger:                   {lazy * 1e6:10.1f} µs/request")
+    print(f"  make_request (LazyLogger):    {full * 1e6:10.1f} µs/request")
+    if lazy:
+        print(f"  Tăng tốc phần logging: x{eager / lazy:,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Benchmark đọc sheet lớn: pandas.read_excel (cách cũ) so với sheet_reader đọc theo luồng
+
+Tạo file 100k dòng (xlsx, csv, jsonl) cùng định dạng với app rồi đo, mỗi cách đọc trong một
+tiến trình con riêng (để peak RSS không bị ảnh hưởng lẫn nhau):
+    pandas-xlsx  - pd.read_excel cả file rồi validate từng dòng (đường đọc trước đây)
+    stream-xlsx  - batch_engine.iter_generation_rows với file .xlsx (openpyxl read-only)
+    stream-csv   - như trên với file .csv
+    stream-jsonl - như trên với file .jsonl
+
+Báo cáo thời gian tới task đầu tiên, thời gian đọc hết, số dòng hợp lệ và peak RSS.
+
+Chạy: python benchmarks/bench_sheet_reader.py [--rows 100000] [--data-dir ./sheet_data]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from bench_throughput import RssSampler, current_rss
+
+METHODS = ("pandas-xlsx", "stream-xlsx", "stream-csv", "stream-jsonl")
+COLUMNS = ["STT", "PROMPT", "SUBJECT", "SUBJECT_CAPTION", "SCENE", "SCENE_CAPTION", "STYLE", "STYLE_CAPTION"]
+
+
+# ===== DỮ LIỆU ĐẦU VÀO =====
+def sample_rows(rows):
+    """Dòng giống sheet thật: phần lớn chỉ có prompt, 1/4 có ảnh tham chiếu, thỉnh thoảng dòng trống"""
+    for index in range(rows):
+        prompt = f"benchmark prompt {index}: a chrome mouse in a martial arts gi, cinematic lighting, 35mm"
+        if index % 97 == 0:
+            prompt = ""
+        subject = f"C:\\refs\\subject_{index % 50}.jpg" if index % 4 == 0 else None
+        yield [index + 1, prompt, subject, "Subject" if subject else None, None, None, None, None]
+
+
+def write_inputs(folder, rows):
+    """Ghi cùng dữ liệu ra sheet.xlsx, sheet.csv, sheet.jsonl (bỏ qua nếu đã có đủ số dòng)"""
+    import csv
+    from openpyxl import Workbook
+
+    marker = os.path.join(folder, "rows.txt")
+    paths = {ext: os.path.join(folder, f"sheet.{ext}") for ext in ("xlsx", "csv", "jsonl")}
+    if os.path.exists(marker) and open(marker).read().strip() == str(rows) and all(map(os.path.exists, paths.values())):
+        return paths
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    worksheet.append(COLUMNS)
+    with open(paths["csv"], "w", encoding="utf-8", newline="") as csv_file, \
+            open(paths["jsonl"], "w", encoding="utf-8") as jsonl_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(COLUMNS)
+        for row in sample_rows(rows):
+            worksheet.append(row)
+            writer.writerow(["" if value is None else value for value in row])
+            jsonl_file.write(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n")
+    workbook.save(paths["xlsx"])
+    with open(marker, "w") as f:
+        f.write(str(rows))
+    return paths
+
+
+# ===== CÁCH ĐỌC =====
+def pandas_generation_rows(excel_path):
+    """Đường đọc trước đây: pd.read_excel toàn bộ file, tolist()/fillna từng cột rồi validate"""
+    import pandas as pd
+    from batch_engine import reference_path
+
+    df = pd.read_excel(excel_path)
+    stt_list = df.iloc[:, 0].tolist()
+    prompt_list = df.iloc[:, 1].tolist()
+    columns = [df.iloc[:, index].fillna("").tolist() if len(df.columns) > index else [""] * len(stt_list)
+               for index in range(2, 8)]
+    for stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption in zip(stt_list, prompt_list, *columns):
+        if not str(prompt).strip() or str(prompt).strip().lower() == 'nan':
+            continue
+        if reference_path(subject) or reference_path(scene) or reference_path(style):
+            mode = "Image to Image"
+        else:
+            mode = "Prompt to Image"
+        yield (stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, mode)
+
+
+def run_child(method, path):
+    """Chạy trong tiến trình con: đọc hết file, in kết quả dạng JSON"""
+    from batch_engine import iter_generation_rows  # Import app trước khi bấm giờ (như khi app đang chạy)
+
+    baseline_rss = current_rss()
+    with RssSampler(interval=0.01) as sampler:
+        started = time.perf_counter()
+        rows = pandas_generation_rows(path) if method == "pandas-xlsx" else iter_generation_rows(path)
+        first_task = None
+        count = 0
+        for _ in rows:
+            if first_task is None:
+                first_task = time.perf_counter() - started
+            count += 1
+        total = time.perf_counter() - started
+    peak_rss = sampler.peak
+    try:
+        import resource
+        # ru_maxrss: KB trên Linux, bytes trên macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss = max(peak_rss or 0, max_rss if sys.platform == "darwin" else max_rss * 1024)
+    except ImportError:
+        pass
+    print(json.dumps({"method": method, "rows": count, "first_task_s": first_task, "total_s": total,
+                      "peak_rss_mb": peak_rss / 1e6 if peak_rss else None,
+                      "baseline_rss_mb": baseline_rss / 1e6 if baseline_rss else None}))
+
+
+def measure(method, path):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", method, path],
+                            capture_output=True, text=True, cwd=REPO_DIR)
+    lines = [line for line in output.stdout.splitlines() if line.startswith("{")]
+    if output.returncode != 0 or not lines:
+        return {"method": method, "error": (output.stderr.strip().splitlines() or ["?"])[-1]}
+    return json.loads(lines[-1])
+
+
+def format_mb(value):
+    return f"{value:8.1f}" if value is not None else "       -"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark đọc sheet lớn: pandas so với sheet_reader")
+    parser.add_argument("--rows", type=int, default=100000, help="Số dòng dữ liệu (mặc định: 100000)")
+    parser.add_argument("--methods", default=",".join(METHODS), help=f"Các cách đọc, cách nhau bởi dấu phẩy ({', '.join(METHODS)})")
+    parser.add_argument("--data-dir", help="Thư mục giữ file sinh ra để dùng lại giữa các lần chạy")
+    parser.add_argument("--child", nargs=2, metavar=("METHOD", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return 0
+
+    folder = args.data_dir or tempfile.mkdtemp(prefix="bench_sheet_")
+    os.makedirs(folder, exist_ok=True)
+    try:
+        started = time.perf_counter()
+        paths = write_inputs(folder, args.rows)
+        print(f"Dữ liệu: {args.rows} dòng trong {folder} ({time.perf_counter() - started:.1f}s để tạo/kiểm tra)")
+        print(f"{'Cách đọc':<14} {'Dòng':>7} {'Task đầu (s)':>13} {'Đọc hết (s)':>12} {'Peak RSS MB':>12} {'Nền MB':>8}")
+        for method in args.methods.split(","):
+            method = method.strip()
+            if method not in METHODS:
+                print(f"{method:<14} bỏ qua (không có cách đọc này)")
+                continue
+            result = measure(method, paths[method.split("-", 1)[1]])
+            if "error" in result:
+                print(f"{method:<14} lỗi: {result['error']}")
+                continue
+            print(f"{method:<14} {result['rows']:>7} {result['first_task_s']:>13.3f} {result['total_s']:>12.3f} "
+                  f"{format_mb(result['peak_rss_mb']):>12} {format_mb(result['baseline_rss_mb'])}")
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(folder, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,347 @@
+"""Benchmark end-to-end: thông lượng batch qua server giả lập Whisk
+
+Khởi động mock_whisk_server.py ở tiến trình con (để CPU/RAM của server không bị tính vào app),
+trỏ api sang server đó rồi chạy code batch thật của batch_engine:
+    prompt  - ExcelBatchRunner, chỉ có prompt (whisk:generateImage)
+    img2img - ExcelBatchRunner với ảnh tham chiếu (backbone.uploadImage + whisk:runImageRecipe)
+    sync    - prepare_sync_source + SyncBatchRunner (backbone.editImage)
+
+Báo cáo ảnh/phút, latency p50/p95/p99 mỗi ảnh, peak RSS và CPU mỗi ảnh. Mỗi lần chạy được ghi thêm
+vào benchmarks/results/throughput.jsonl (kèm commit git) và so sánh với lần chạy trước cùng cấu hình.
+
+Chạy: python benchmarks/bench_throughput.py [--scenario all] [--rows 40] [--threads 4] [--rate-429 0.05]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from mock_whisk_server import STATS_PATH, add_config_arguments
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+DEFAULT_RESULTS_FILE = os.path.join(BENCH_DIR, "results", "throughput.jsonl")
+SCENARIOS = ("prompt", "img2img", "sync")
+
+
+# ===== ĐO TÀI NGUYÊN =====
+def current_rss():
+    """RSS hiện tại của tiến trình (bytes), None nếu không đọc được"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RssSampler:
+    """Lấy mẫu RSS định kỳ trong thread nền để tìm peak của riêng một kịch bản"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def percentile(values, fraction):
+    """Percentile theo nearest-rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                  capture_output=True, text=True, timeout=10).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True, timeout=10).stdout.strip()
+        return revision + ("-dirty" if dirty else "") if revision else None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# ===== SERVER GIẢ LẬP =====
+def start_mock_server(args):
+    """Chạy mock_whisk_server.py ở tiến trình con, trả về (process, url)"""
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_whisk_server.py"), "--port", "0",
+               "--latency", str(args.latency), "--jitter", str(args.jitter),
+               "--upload-latency", str(args.upload_latency), "--rate-429", str(args.rate_429),
+               "--rate-5xx", str(args.rate_5xx), "--retry-after", str(args.retry_after),
+               "--images-per-request", str(args.images_per_request), "--image-kb", str(args.image_kb),
+               "--mock-seed", str(args.mock_seed)]
+    if args.quota is not None:
+        command += ["--quota", str(args.quota)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline().strip()
+    if not line.startswith("READY "):
+        process.kill()
+        raise RuntimeError(f"Server giả lập không khởi động được: {line}")
+    return process, line.split(" ", 1)[1]
+
+
+def fetch_server_stats(url):
+    import requests
+
+    try:
+        return requests.get(url + STATS_PATH, timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def stop_mock_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# ===== DỮ LIỆU ĐẦU VÀO =====
+def write_reference_images(folder, count, size=(512, 512)):
+    from PIL import Image
+
+    paths = []
+    for index in range(count):
+        path = os.path.join(folder, f"ref_{index}.jpg")
+        Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3)).save(path, "JPEG", quality=85)
+        paths.append(path)
+    return paths
+
+
+def write_excel(path, rows, references=None):
+    """Excel cùng định dạng với app: STT, PROMPT, SUBJECT, SUBJECT_CAPTION, SCENE, SCENE_CAPTION, STYLE, STYLE_CAPTION"""
+    import pandas as pd
+
+    data = []
+    for index in range(rows):
+        prompt = f"benchmark prompt {index}: a chrome mouse in a martial arts gi, cinematic lighting"
+        subject = references[index % len(references)] if references else ""
+        scene = references[(index + 1) % len(references)] if references and len(references) > 1 else ""
+        data.append([index + 1, prompt, subject, "", scene, "", "", ""])
+    columns = ["STT", "PROMPT", "SUBJECT", "SUBJECT_CAPTION", "SCENE", "SCENE_CAPTION", "STYLE", "STYLE_CAPTION"]
+    pd.DataFrame(data, columns=columns).to_excel(path, index=False)
+    return path
+
+
+# ===== KỊCH BẢN =====
+def run_scenario(name, args, workdir):
+    import api
+    import batch_engine
+
+    # Cache upload riêng cho mỗi kịch bản, không đụng tới upload_cache.json của người dùng
+    api.upload_cache = api.UploadCache(path=os.path.join(workdir, "upload_cache.json"))
+    output_folder = os.path.join(workdir, "out")
+    events = []
+    events_lock = threading.Lock()
+
+    def on_event(event):
+        with events_lock:
+            events.append(event)
+
+    cookie = "mock-cookie"
+    if name == "sync":
+        source_image = write_reference_images(workdir, 1, size=(1408, 768))[0]
+        excel_path = write_excel(os.path.join(workdir, "sync.xlsx"), args.rows)
+    else:
+        references = write_reference_images(workdir, args.references) if name == "img2img" else None
+        excel_path = write_excel(os.path.join(workdir, f"{name}.xlsx"), args.rows, references)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    with RssSampler() as sampler:
+        if name == "sync":
+            media_generation_id, raw_bytes = batch_engine.prepare_sync_source(cookie, source_image, "16:9")
+            runner = batch_engine.SyncBatchRunner(cookie, media_generation_id, raw_bytes, excel_path, 0,
+                                                  args.threads, output_folder, on_event=on_event)
+        else:
+            access_token = batch_engine.resolve_access_token(cookie)
+            runner = batch_engine.ExcelBatchRunner(cookie, access_token, excel_path, output_folder, 0,
+                                                   args.threads, on_event=on_event)
+        outcome = runner.run()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    finished = [event for event in events if event['event'] == 'task_finished']
+    latencies = [event['elapsed'] for event in finished if event['ok']]
+    pool = next((event for event in events if event['event'] == 'http_pool'), {})
+    succeeded = len(latencies)
+    return {
+        'scenario': name,
+        'success': outcome.success,
+        'tasks': len(finished),
+        'images': succeeded,
+        'failed': len(finished) - succeeded,
+        'wall_seconds': round(wall, 3),
+        'images_per_min': round(succeeded / wall * 60, 2) if wall > 0 else None,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'peak_rss_mb': round(sampler.peak / 1024 / 1024, 1) if sampler.peak else None,
+        'cpu_seconds': round(cpu, 3),
+        'cpu_ms_per_image': round(cpu / succeeded * 1000, 2) if succeeded else None,
+        'attempts': sum(event.get('attempts', 0) for event in finished),
+        'limit_changes': sum(1 for event in events if event['event'] == 'limit_changed'),
+        'http_connections': pool.get('connections'),
+        'http_reused': pool.get('reused'),
+    }
+
+
+# ===== KẾT QUẢ =====
+def config_signature(args):
+    """Các tham số ảnh hưởng tới kết quả - chỉ so sánh các lần chạy cùng cấu hình"""
+    return {name: getattr(args, name) for name in (
+        'rows', 'threads', 'references', 'latency', 'jitter', 'upload_latency', 'rate_429', 'rate_5xx',
+        'quota', 'retry_after', 'images_per_request', 'image_kb', 'browser_delay')}
+
+
+def load_previous(results_file, scenario, config):
+    previous = None
+    if not os.path.exists(results_file):
+        return None
+    with open(results_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('scenario') == scenario and record.get('config') == config:
+                previous = record
+    return previous
+
+
+def format_delta(current, previous, higher_is_better):
+    if current is None or not previous:
+        return ""
+    change = (current - previous) / previous * 100
+    better = change > 0 if higher_is_better else change < 0
+    return f" ({change:+.1f}% {'tốt hơn' if better else 'kém hơn'})" if abs(change) >= 0.05 else " (=)"
+
+
+def print_result(result, previous):
+    def fmt(value, unit=""):
+        return "-" if value is None else f"{value:.3f}{unit}" if isinstance(value, float) else f"{value}{unit}"
+
+    metrics = previous.get('metrics', {}) if previous else {}
+    print(f"\n[{result['scenario']}] {result['images']}/{result['tasks']} ảnh trong {result['wall_seconds']:.2f}s"
+          f" ({result['attempts']} lần gọi API, {result['limit_changes']} lần đổi limit)")
+    print(f"  Kết nối HTTP:   {fmt(result['http_connections'])} mới, {fmt(result['http_reused'])} lần dùng lại")
+    print(f"  Ảnh/phút:       {fmt(result['images_per_min'])}"
+          f"{format_delta(result['images_per_min'], metrics.get('images_per_min'), True)}")
+    for key in ('latency_p50', 'latency_p95', 'latency_p99'):
+        print(f"  {key:15s} {fmt(result[key], 's')}{format_delta(result[key], metrics.get(key), False)}")
+    print(f"  Peak RSS:       {fmt(result['peak_rss_mb'], ' MB')}"
+          f"{format_delta(result['peak_rss_mb'], metrics.get('peak_rss_mb'), False)}")
+    print(f"  CPU/ảnh:        {fmt(result['cpu_ms_per_image'], ' ms')}"
+          f"{format_delta(result['cpu_ms_per_image'], metrics.get('cpu_ms_per_image'), False)}")
+    if previous:
+        print(f"  So với: {previous.get('revision') or '?'} lúc {previous.get('timestamp')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thông lượng batch qua server Whisk giả lập")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--rows", type=int, default=40, help="Số dòng Excel mỗi kịch bản")
+    parser.add_argument("--threads", type=int, default=4, help="Số luồng tối đa (như trên GUI)")
+    parser.add_argument("--references", type=int, default=4, help="Số ảnh tham chiếu khác nhau (img2img)")
+    parser.add_argument("--browser-delay", action="store_true",
+                        help="Giữ random delay 1-3 giây của BrowserSimulator (mặc định tắt khi benchmark)")
+    parser.add_argument("--label", default="", help="Ghi chú cho lần chạy")
+    parser.add_argument("--results-file", default=DEFAULT_RESULTS_FILE)
+    parser.add_argument("--no-save", action="store_true", help="Không ghi kết quả")
+    parser.add_argument("--verbose", action="store_true", help="Hiện log/spinner của app")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    process, url = start_mock_server(args)
+    # api đọc địa chỉ endpoint lúc import nên phải đặt biến môi trường trước khi import
+    os.environ["WHISK_LABS_BASE_URL"] = url
+    os.environ["WHISK_API_BASE_URL"] = url
+    import api
+
+    if not args.browser_delay:
+        api.browser_sim.random_delay = lambda *a, **k: 0.0
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    revision = git_revision()
+    config = config_signature(args)
+    print(f"Server giả lập: {url} | {args.rows} dòng, {args.threads} luồng, latency {args.latency}s, "
+          f"429 {args.rate_429:.0%}, 5xx {args.rate_5xx:.0%}, ảnh {args.image_kb} KB | commit {revision or '?'}")
+
+    results = []
+    real_stdout = sys.stdout
+    try:
+        for name in scenarios:
+            workdir = tempfile.mkdtemp(prefix=f"whisk_bench_{name}_")
+            devnull = None
+            try:
+                if not args.verbose:
+                    devnull = open(os.devnull, 'w', encoding='utf-8')
+                    sys.stdout = devnull  # Spinner và log của app ghi ra stdout
+                result = run_scenario(name, args, workdir)
+            finally:
+                sys.stdout = real_stdout
+                if devnull:
+                    devnull.close()
+                shutil.rmtree(workdir, ignore_errors=True)
+            previous = load_previous(args.results_file, name, config)
+            print_result(result, previous)
+            results.append(result)
+        server_stats = fetch_server_stats(url)
+    finally:
+        stop_mock_server(process)
+
+    if server_stats:
+        print(f"\nServer: tối đa {server_stats['max_in_flight']} request đồng thời, "
+              f"{server_stats['bytes_sent'] / 1024 / 1024:.1f} MB đã gửi, response: {server_stats['responses']}")
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.results_file)), exist_ok=True)
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with open(args.results_file, 'a', encoding='utf-8') as f:
+            for result in results:
+                record = {
+                    'timestamp': timestamp, 'revision': revision, 'label': args.label,
+                    'python': platform.python_version(), 'platform': platform.platform(),
+                    'scenario': result['scenario'], 'config': config,
+                    'metrics': {key: value for key, value in result.items() if key != 'scenario'},
+                }
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"Đã lưu kết quả vào {args.results_file}")
+
+
+if __name__ == "__main__":
+    main()
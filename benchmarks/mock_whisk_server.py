@@ -0,0 +1,363 @@
+"""Server HTTP giả lập Whisk/Google Labs để đo hiệu năng mà không tốn quota thật
+
+Các endpoint được giả lập (cùng đường dẫn với API thật):
+    GET  /fx/api/auth/session              -> access token
+    POST /v1/whisk:generateImage           -> imagePanels với encodedImage nhiều MB
+    POST /v1/whisk:runImageRecipe          -> như trên
+    POST /fx/api/trpc/backbone.uploadImage -> uploadMediaGenerationId (tRPC)
+    POST /fx/api/trpc/backbone.editImage   -> imagePanels bọc trong tRPC
+
+Có thể cấu hình độ trễ, tỷ lệ lỗi 429/5xx và quota theo access token.
+Thống kê request (số request, response theo mã, số request đồng thời tối đa) ở GET /__mock/stats.
+
+Chạy riêng:
+    python benchmarks/mock_whisk_server.py --port 8765 --latency 0.5 --rate-429 0.05
+Rồi trỏ app sang server giả lập:
+    WHISK_LABS_BASE_URL=http://127.0.0.1:8765 WHISK_API_BASE_URL=http://127.0.0.1:8765 python -m batch_engine ...
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WRITE_CHUNK_SIZE = 256 * 1024
+STATS_PATH = "/__mock/stats"  # Thống kê của server (không có trên API thật)
+
+IMAGE_SIZES = {
+    "IMAGE_ASPECT_RATIO_LANDSCAPE": (1408, 768),
+    "IMAGE_ASPECT_RATIO_PORTRAIT": (768, 1408),
+    "IMAGE_ASPECT_RATIO_SQUARE": (1024, 1024),
+}
+
+
+class MockConfig:
+    """Cấu hình hành vi của server giả lập"""
+
+    def __init__(self, latency=0.3, jitter=0.1, upload_latency=0.1, rate_429=0.0, rate_5xx=0.0,
+                 quota=None, retry_after=1.0, images_per_request=1, image_kb=1500, seed=1234):
+        self.latency = latency                        # Độ trễ trung bình (giây) của request tạo/edit ảnh
+        self.jitter = jitter                          # Độ lệch ngẫu nhiên ±jitter (giây)
+        self.upload_latency = upload_latency          # Độ trễ của upload và auth/session
+        self.rate_429 = rate_429                      # Xác suất trả 429 rate limit
+        self.rate_5xx = rate_5xx                      # Xác suất trả 503
+        self.quota = quota                            # Số ảnh tối đa mỗi access token (None = không giới hạn)
+        self.retry_after = retry_after                # Giá trị header Retry-After khi 429/503
+        self.images_per_request = images_per_request  # Số ảnh trong mỗi response
+        self.image_kb = image_kb                      # Kích thước (KB) xấp xỉ mỗi ảnh JPEG trước base64
+        self.seed = seed
+
+
+def _make_image_b64(size, image_kb, rng):
+    """Ảnh JPEG nhiễu (kích thước thật của Whisk) được encode base64 một lần và dùng lại"""
+    try:
+        from PIL import Image
+        image = Image.frombytes("RGB", size, rng.randbytes(size[0] * size[1] * 3))
+        buffer = io.BytesIO()
+        # Ảnh nhiễu nén rất kém - chọn quality để gần với image_kb
+        for quality in (95, 85, 75, 60, 45, 30):
+            buffer.seek(0)
+            buffer.truncate()
+            image.save(buffer, "JPEG", quality=quality)
+            if buffer.tell() <= image_kb * 1024:
+                break
+        data = buffer.getvalue()
+    except ImportError:
+        data = b"\xff\xd8\xff\xe0" + rng.randbytes(image_kb * 1024)
+    return base64.b64encode(data)
+
+
+class MockWhiskServer:
+    """Server giả lập chạy trong thread nền; .url là địa chỉ gốc cho cả LABS và WHISK API"""
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockConfig()
+        self._rng = random.Random(self.config.seed)
+        self._rng_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._images = {}          # aspect ratio -> base64 bytes
+        self._quota_used = {}      # access token -> số ảnh đã tạo
+        self.stats = {'requests': {}, 'responses': {}, 'in_flight': 0, 'max_in_flight': 0, 'bytes_sent': 0}
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    # ----- Trạng thái dùng chung giữa các request -----
+    def random(self):
+        with self._rng_lock:
+            return self._rng.random()
+
+    def image_b64(self, aspect_ratio):
+        size = IMAGE_SIZES.get(aspect_ratio, IMAGE_SIZES["IMAGE_ASPECT_RATIO_LANDSCAPE"])
+        with self._lock:
+            if size not in self._images:
+                with self._rng_lock:
+                    self._images[size] = _make_image_b64(size, self.config.image_kb, self._rng)
+            return self._images[size]
+
+    def take_quota(self, token, count):
+        """Trừ quota của token; False nếu đã hết"""
+        if self.config.quota is None:
+            return True
+        with self._lock:
+            used = self._quota_used.get(token, 0)
+            if used + count > self.config.quota:
+                return False
+            self._quota_used[token] = used + count
+            return True
+
+    def count(self, kind, key):
+        with self._lock:
+            self.stats[kind][key] = self.stats[kind].get(key, 0) + 1
+
+    def track_in_flight(self, delta):
+        with self._lock:
+            self.stats['in_flight'] += delta
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+
+    def add_bytes_sent(self, count):
+        with self._lock:
+            self.stats['bytes_sent'] += count
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.stats))
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(MockWhiskHandler):
+            mock = server
+
+        return Handler
+
+
+class MockWhiskHandler(BaseHTTPRequestHandler):
+    """Xử lý request theo đường dẫn; mock là MockWhiskServer sở hữu handler"""
+    mock = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # Không in access log để không ảnh hưởng kết quả đo
+
+    # ----- Routing -----
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/fx/api/auth/session":
+            self._handle(self._auth_session, generation=False)
+        elif path == STATS_PATH:
+            self._send_json(200, self.mock.snapshot())
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+
+    def do_POST(self):
+        routes = {
+            "/v1/whisk:generateImage": (self._generate, True),
+            "/v1/whisk:runImageRecipe": (self._generate, True),
+            "/fx/api/trpc/backbone.editImage": (self._edit, True),
+            "/fx/api/trpc/backbone.uploadImage": (self._upload, False),
+        }
+        route = routes.get(self.path.split("?")[0])
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if route is None:
+            self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            return
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"code": 400, "message": "Invalid JSON", "status": "INVALID_ARGUMENT"}})
+            return
+        handler, generation = route
+        self._handle(lambda: handler(payload), generation)
+
+    def _handle(self, handler, generation):
+        mock = self.mock
+        config = mock.config
+        mock.count('requests', self.path)
+        mock.track_in_flight(1)
+        try:
+            base = config.latency if generation else config.upload_latency
+            delay = max(0.0, base + (mock.random() * 2 - 1) * config.jitter) if base else 0.0
+            if delay:
+                time.sleep(delay)
+            if generation:
+                roll = mock.random()
+                if roll < config.rate_429:
+                    return self._send_error(429, "Resource has been exhausted (e.g. check quota).", "RESOURCE_EXHAUSTED")
+                if roll < config.rate_429 + config.rate_5xx:
+                    return self._send_error(503, "The service is currently unavailable.", "UNAVAILABLE")
+            handler()
+        finally:
+            mock.track_in_flight(-1)
+
+    # ----- Endpoint -----
+    def _auth_session(self):
+        expires = (datetime.utcnow() + timedelta(hours=12)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        self._send_json(200, {
+            "user": {"name": "Mock User", "email": "mock@example.com", "image": ""},
+            "expires": expires,
+            "access_token": "mock-token-" + uuid.uuid4().hex[:12],
+        })
+
+    def _generate(self, payload):
+        if not self._check_quota():
+            return
+        settings = payload.get("imageModelSettings", {})
+        prompt = payload.get("userInstruction") or payload.get("prompt", "")
+        self._send_images(self._image_panels(prompt, payload.get("seed"), settings.get("aspectRatio"),
+                                             settings.get("imageModel", "IMAGEN_3_5")),
+                          {"workflowId": payload.get("clientContext", {}).get("workflowId") or str(uuid.uuid4())})
+
+    def _edit(self, payload):
+        if not self._check_quota():
+            return
+        edit_input = payload.get("json", {}).get("editInput", {})
+        self._send_images(self._image_panels(edit_input.get("userInstruction", ""), edit_input.get("seed"),
+                                             "IMAGE_ASPECT_RATIO_LANDSCAPE", "GEM_PIX"),
+                          None, trpc=True)
+
+    def _upload(self, payload):
+        upload_input = payload.get("json", {}).get("uploadMediaInput", {})
+        if not upload_input.get("rawBytes"):
+            self._send_json(400, [{"error": {"json": {"message": "Missing rawBytes", "code": -32600}}}])
+            return
+        self._send_json(200, {"result": {"data": {"json": {"result": {
+            "uploadMediaGenerationId": "mock-upload-" + uuid.uuid4().hex}}}}})
+
+    # ----- Helpers -----
+    def _check_quota(self):
+        token = self.headers.get("Authorization", "") or self.headers.get("Cookie", "")
+        if self.mock.take_quota(token, self.mock.config.images_per_request):
+            return True
+        self._send_error(429, "Resource has been exhausted (e.g. check quota).", "RESOURCE_EXHAUSTED", retry_after=False)
+        return False
+
+    def _image_panels(self, prompt, seed, aspect_ratio, image_model):
+        images = []
+        for _ in range(self.mock.config.images_per_request):
+            images.append({
+                "mediaGenerationId": "mock-media-" + uuid.uuid4().hex,
+                "prompt": prompt,
+                "seed": seed,
+                "imageModel": image_model,
+                "aspectRatio": aspect_ratio or "IMAGE_ASPECT_RATIO_LANDSCAPE",
+            })
+        return [{"prompt": prompt, "generatedImages": images}]
+
+    def _send_images(self, panels, extra, trpc=False):
+        """Gửi JSON có encodedImage nhiều MB theo từng chunk (không ghép toàn bộ body trong RAM)"""
+        encoded = self.mock.image_b64(panels[0]["generatedImages"][0]["aspectRatio"])
+        # Đặt placeholder rồi tách body quanh nó để chèn base64 khi ghi
+        marker = "__MOCK_ENCODED_IMAGE__"
+        for panel in panels:
+            for image in panel["generatedImages"]:
+                image["encodedImage"] = marker
+        document = {"imagePanels": panels}
+        if extra:
+            document.update(extra)
+        if trpc:
+            document = {"result": {"data": {"json": {"result": document}}}}
+        parts = json.dumps(document).encode("utf-8").split(marker.encode("utf-8"))
+        length = sum(len(part) for part in parts) + len(encoded) * (len(parts) - 1)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        for index, part in enumerate(parts):
+            self.wfile.write(part)
+            if index < len(parts) - 1:
+                for start in range(0, len(encoded), WRITE_CHUNK_SIZE):
+                    self.wfile.write(encoded[start:start + WRITE_CHUNK_SIZE])
+        self.mock.add_bytes_sent(length)
+        self.mock.count('responses', 200)
+
+    def _send_error(self, status, message, error_status, retry_after=True):
+        headers = {}
+        if retry_after and self.mock.config.retry_after is not None:
+            headers["Retry-After"] = f"{self.mock.config.retry_after:g}"
+        self._send_json(status, {"error": {"code": status, "message": message, "status": error_status}}, headers)
+
+    def _send_json(self, status, document, headers=None):
+        body = json.dumps(document).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.mock.add_bytes_sent(len(body))
+        self.mock.count('responses', status)
+
+
+def add_config_arguments(parser):
+    """Thêm các tham số cấu hình server (dùng chung với bench_throughput.py)"""
+    parser.add_argument("--latency", type=float, default=0.3, help="Độ trễ trung bình (giây) của request tạo/edit ảnh")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Độ lệch ngẫu nhiên của độ trễ (giây)")
+    parser.add_argument("--upload-latency", type=float, default=0.1, help="Độ trễ của upload/auth (giây)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Xác suất trả 429 (0-1)")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="Xác suất trả 503 (0-1)")
+    parser.add_argument("--quota", type=int, default=None, help="Số ảnh tối đa mỗi access token")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Header Retry-After (giây) khi 429/503")
+    parser.add_argument("--images-per-request", type=int, default=1, help="Số ảnh trong mỗi response")
+    parser.add_argument("--image-kb", type=int, default=1500, help="Kích thước mỗi ảnh JPEG (KB, trước base64)")
+    parser.add_argument("--mock-seed", type=int, default=1234, help="Seed ngẫu nhiên của server")
+
+
+def config_from_args(args):
+    return MockConfig(latency=args.latency, jitter=args.jitter, upload_latency=args.upload_latency,
+                      rate_429=args.rate_429, rate_5xx=args.rate_5xx, quota=args.quota,
+                      retry_after=args.retry_after, images_per_request=args.images_per_request,
+                      image_kb=args.image_kb, seed=args.mock_seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server giả lập Whisk API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="0 = chọn cổng trống")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockWhiskServer(config_from_args(args), args.host, args.port)
+    server.image_b64("IMAGE_ASPECT_RATIO_LANDSCAPE")  # Tạo sẵn ảnh để request đầu không bị chậm
+    # Dòng READY cho tiến trình cha (bench_throughput.py) biết địa chỉ server
+    print(f"READY {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+"""Catalog SQLite của mọi ảnh đã tạo: tìm ảnh theo prompt, seed, STT, tài khoản... mà không cần quét thư mục
+
+Mỗi ảnh runner lưu thành công được ghi một dòng (đường dẫn, STT, prompt, seed, model, tỷ lệ, tài khoản,
+mode, biến thể, dung lượng, sha256, thời gian request, số lần thử). Ghi qua một thread nền: record()
+chỉ đưa vào queue, thread nền tính sha256 và insert theo lô trong một transaction.
+
+Dòng lệnh:
+    python -m catalog rebuild ./out --workers 8        # Quét lại thư mục (song song) và cập nhật catalog
+    python -m catalog query --prompt "con mèo" --seed 12
+    python -m catalog query --sha256 <hash> --json
+Đường dẫn catalog mặc định: output_catalog.sqlite3 (đổi bằng biến môi trường WHISK_CATALOG_PATH).
+"""
+import argparse
+import glob
+import json
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api import log
+from job_journal import JOURNAL_PREFIX, read_journal_entries
+from result_cache import file_sha256
+
+CATALOG_PATH_ENV = "WHISK_CATALOG_PATH"
+DEFAULT_CATALOG_PATH = "output_catalog.sqlite3"
+BATCH_SIZE = 500          # Số dòng tối đa mỗi transaction
+FLUSH_INTERVAL = 1.0      # Số giây tối đa một dòng nằm trong queue trước khi được ghi
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+COLUMNS = ('path', 'folder', 'stt', 'prompt', 'seed', 'model', 'aspect_ratio', 'account', 'mode', 'variant',
+           'bytes', 'sha256', 'request_seconds', 'attempts', 'source', 'created_at')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    folder TEXT,
+    stt TEXT,
+    prompt TEXT,
+    seed INTEGER,
+    model TEXT,
+    aspect_ratio TEXT,
+    account TEXT,
+    mode TEXT,
+    variant INTEGER,
+    bytes INTEGER,
+    sha256 TEXT,
+    request_seconds REAL,
+    attempts INTEGER,
+    source TEXT,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_images_prompt ON images(prompt);
+CREATE INDEX IF NOT EXISTS idx_images_seed ON images(seed);
+CREATE INDEX IF NOT EXISTS idx_images_stt ON images(stt);
+CREATE INDEX IF NOT EXISTS idx_images_folder ON images(folder);
+CREATE INDEX IF NOT EXISTS idx_images_sha256 ON images(sha256);
+CREATE INDEX IF NOT EXISTS idx_images_account ON images(account);
+"""
+
+# Tên file do sanitize_filename tạo: STT_PROMPT.jpg, biến thể: STT_PROMPT_v2.jpg
+FILENAME_PATTERN = re.compile(r"^(?P<stt>[^_]+)_(?P<prompt>.*?)(?:_v(?P<variant>\d+))?\.[A-Za-z]+$")
+
+_FLUSH = object()  # Đánh dấu trong queue: ghi ngay lô đang gom
+
+def default_catalog_path():
+    return os.environ.get(CATALOG_PATH_ENV) or DEFAULT_CATALOG_PATH
+
+def connect(path):
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")  # Đọc (query) không bị chặn khi thread nền đang ghi
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+class OutputCatalog:
+    """Catalog ảnh đã tạo trên SQLite; ghi theo lô qua thread nền, đọc bằng find()/get()"""
+
+    def __init__(self, path=None):
+        self.path = path or default_catalog_path()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._writer = None
+        self._reader = None
+        self.written = 0
+        self.errors = 0
+
+    # ----- Ghi -----
+    def record(self, path, **fields):
+        """Đưa một ảnh vào queue ghi (không chặn); sha256/bytes được tính ở thread nền nếu chưa có"""
+        fields['path'] = os.path.abspath(path)
+        self._ensure_writer()
+        self._queue.put(fields)
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="catalog-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        connection = None
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE and batch[-1] is not _FLUSH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                rows = [fields for fields in batch if fields is not _FLUSH]
+                if rows:
+                    if connection is None:
+                        connection = connect(self.path)
+                    self._insert_batch(connection, rows)
+            except sqlite3.Error as e:
+                self.errors += len(batch)
+                log.warning("Không ghi được catalog {}: {}", self.path, e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _insert_batch(self, connection, batch):
+        rows = []
+        for fields in batch:
+            try:
+                rows.append(self._row(fields))
+            except OSError as e:
+                self.errors += 1
+                log.warning("Catalog bỏ qua {}: {}", fields.get('path'), e)
+        if not rows:
+            return
+        placeholders = ", ".join("?" for _ in COLUMNS)
+        with connection:  # Một transaction cho cả lô
+            connection.executemany(
+                f"INSERT OR REPLACE INTO images ({', '.join(COLUMNS)}) VALUES ({placeholders})", rows)
+        self.written += len(rows)
+
+    @staticmethod
+    def _row(fields):
+        path = fields['path']
+        if fields.get('sha256') is None:
+            fields['sha256'] = file_sha256(path)
+        if fields.get('bytes') is None:
+            fields['bytes'] = os.path.getsize(path)
+        fields.setdefault('folder', os.path.dirname(path))
+        fields.setdefault('created_at', time.time())
+        if fields.get('stt') is not None:
+            fields['stt'] = str(fields['stt'])
+        return tuple(fields.get(column) for column in COLUMNS)
+
+    def flush(self):
+        """Chờ mọi dòng trong queue được ghi xong (lô đang gom được ghi ngay, không chờ FLUSH_INTERVAL)"""
+        if self._writer is not None:
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    # ----- Đọc -----
+    def _read_connection(self):
+        with self._lock:
+            if self._reader is None:
+                self._reader = connect(self.path)
+            return self._reader
+
+    def find(self, prompt=None, prompt_like=None, seed=None, stt=None, folder=None, account=None, mode=None,
+             sha256=None, limit=100):
+        """Tìm ảnh theo các điều kiện (AND); prompt_like dùng LIKE (vd: "%con mèo%"). Trả về list dict"""
+        conditions, params = [], []
+        for column, value in (('prompt', prompt), ('seed', seed), ('stt', stt), ('account', account),
+                              ('mode', mode), ('sha256', sha256)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(str(value) if column == 'stt' else value)
+        if prompt_like is not None:
+            conditions.append("prompt LIKE ?")
+            params.append(prompt_like)
+        if folder is not None:
+            conditions.append("folder = ?")
+            params.append(os.path.abspath(folder))
+        sql = "SELECT * FROM images"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY created_at DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        connection = self._read_connection()
+        with self._lock:
+            return [dict(row) for row in connection.execute(sql, params)]
+
+    def get(self, path):
+        """Dòng catalog của một file ảnh (None nếu chưa có)"""
+        connection = self._read_connection()
+        with self._lock:
+            row = connection.execute("SELECT * FROM images WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return dict(row) if row else None
+
+    def count(self):
+        connection = self._read_connection()
+        with self._lock:
+            return connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    # ----- Dựng lại từ thư mục -----
+    def rebuild_from_folder(self, folder, workers=8, progress=None):
+        """Quét folder (đệ quy) và ghi mọi file ảnh vào catalog, trả về số file đã đưa vào
+
+        sha256/kích thước được tính song song bởi workers luồng. Seed, mode, prompt gốc lấy từ journal
+        trong thư mục (nếu có); STT/prompt/biến thể còn lại suy ra từ tên file STT_PROMPT(_vN).jpg.
+        """
+        progress = progress or (lambda message: None)
+        journal_info = {}
+        for journal_path in glob.glob(os.path.join(glob.escape(folder), "**", f"{JOURNAL_PREFIX}*.jsonl"), recursive=True):
+            for entry in read_journal_entries(journal_path).values():
+                paths = [entry.get('saved_path')] + list(entry.get('variant_paths') or [])
+                for variant, path in enumerate(paths, start=1):
+                    if path:
+                        journal_info[os.path.abspath(path)] = (entry, variant)
+        files = [os.path.join(root, name)
+                 for root, _, names in os.walk(folder)
+                 for name in names if name.lower().endswith(IMAGE_EXTENSIONS)]
+        progress(f"🔎 Tìm thấy {len(files)} file ảnh, {len(journal_info)} ảnh có trong journal")
+
+        def describe(path):
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            fields = {'path': path, 'bytes': stat.st_size, 'sha256': file_sha256(path),
+                      'created_at': stat.st_mtime, 'source': 'rebuild'}
+            match = FILENAME_PATTERN.match(os.path.basename(path))
+            if match:
+                fields['stt'] = match.group('stt')
+                fields['prompt'] = match.group('prompt')
+                fields['variant'] = int(match.group('variant') or 1)
+            if path in journal_info:
+                entry, variant = journal_info[path]
+                fields.update(stt=entry.get('stt'), prompt=entry.get('prompt'), seed=entry.get('seed'),
+                              mode=entry.get('mode'), variant=variant)
+            return fields
+
+        added = 0
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for fields in executor.map(describe, files):
+                self.record(**fields)
+                added += 1
+                if added % 1000 == 0:
+                    progress(f"... {added}/{len(files)}")
+        self.flush()
+        return added
+
+# Catalog dùng chung cho toàn tiến trình (GUI + runner)
+output_catalog = OutputCatalog()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="catalog", description="Catalog SQLite của ảnh đã tạo")
+    parser.add_argument("--db", default=None, help=f"File catalog (mặc định: {CATALOG_PATH_ENV} hoặc {DEFAULT_CATALOG_PATH})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser("rebuild", help="Quét thư mục output và cập nhật catalog")
+    rebuild.add_argument("folders", nargs="+")
+    rebuild.add_argument("--workers", type=int, default=8, help="Số luồng đọc/hash file (mặc định: 8)")
+
+    query = subparsers.add_parser("query", help="Tìm ảnh trong catalog")
+    query.add_argument("--prompt", help="Prompt chính xác")
+    query.add_argument("--prompt-like", help="Prompt chứa chuỗi này")
+    query.add_argument("--seed", type=int)
+    query.add_argument("--stt")
+    query.add_argument("--folder")
+    query.add_argument("--account")
+    query.add_argument("--mode")
+    query.add_argument("--sha256")
+    query.add_argument("--limit", type=int, default=100)
+    query.add_argument("--json", action="store_true", help="In kết quả dạng JSON Lines")
+    args = parser.parse_args(argv)
+
+    catalog = OutputCatalog(args.db)
+    if args.command == "rebuild":
+        for folder in args.folders:
+            started = time.monotonic()
+            added = catalog.rebuild_from_folder(folder, args.workers, progress=print)
+            print(f"✅ {folder}: {added} ảnh trong {time.monotonic() - started:.1f} giây")
+        print(f"📚 Catalog {catalog.path}: {catalog.count()} ảnh")
+    else:
+        rows = catalog.find(prompt=args.prompt, prompt_like=f"%{args.prompt_like}%" if args.prompt_like else None,
+                            seed=args.seed, stt=args.stt, folder=args.folder, account=args.account,
+                            mode=args.mode, sha256=args.sha256, limit=args.limit)
+        for row in rows:
+            if args.json:
+                print(json.dumps(row, ensure_ascii=False))
+            else:
+                print(f"{row['path']}  (STT {row['stt']}, seed {row['seed']}, {row['mode'] or '?'})")
+        if not args.json:
+            print(f"{len(rows)} ảnh")
+    catalog.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,269 @@
+"""Pipeline tạo ảnh theo giai đoạn: network -> decode -> disk
+
+Mỗi giai đoạn có số worker riêng và nối với giai đoạn sau bằng queue có giới hạn:
+- network: gửi request (chiếm slot của limiter), đọc response dạng stream vào file tạm rồi chuyển tiếp ngay
+- decode: parse JSON, giải mã base64 theo chunk thẳng ra file .part (CPU)
+- disk: đổi tên file .part thành file ảnh, hậu xử lý
+
+Khi decode/disk không theo kịp, queue đầy làm worker network chờ (backpressure), nhờ đó số response
+thô đang chờ luôn có giới hạn; ngược lại một ảnh lớn hay ổ đĩa chậm không còn giữ slot network.
+Body bị cắt ngang/JSON hỏng (BAD_RESPONSE ở giai đoạn decode) được gửi lại giai đoạn network để thử lại,
+tối đa MAX_DECODE_RETRIES lần, giống retry BAD_RESPONSE của WhiskRequestExecutor; thời gian chờ trước
+mỗi lần gửi lại do timer đếm nên không giữ worker network.
+Task được lấy mẫu trace (tracing) mang trace của nó qua cả ba giai đoạn, kèm span thời gian chờ queue.
+Giữa các giai đoạn chỉ truyền đường dẫn file, không truyền nội dung ảnh, nên bộ nhớ mỗi task không phụ
+thuộc kích thước ảnh. Nếu có postprocessor (postprocess.PostProcessor), ảnh vừa lưu được chuyển sang
+hậu xử lý theo đường dẫn; việc này không chặn worker disk.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from api import decode_deferred_body, write_image_file, discard_part_file, iter_saved_images, log, RequestOutcome
+from progress_events import STAGE_NETWORK, STAGE_DECODE, STAGE_DISK
+from tracing import tracer, now_us
+
+DEFAULT_DECODE_WORKERS = max(1, min(2, os.cpu_count() or 1))
+DEFAULT_DISK_WORKERS = 1
+MAX_DECODE_RETRIES = 2      # Số lần gọi lại request khi body không giải mã được
+DECODE_RETRY_DELAY = 2.0    # Giây chờ trước lần gọi lại thứ n: DECODE_RETRY_DELAY * n
+
+_STOP = object()
+
+class StageStats:
+    """Số liệu của một giai đoạn: số item đã xử lý, thời gian bận và thời gian bị chặn do queue đầy"""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0   # Thời gian chờ đưa item vào queue của giai đoạn sau
+        self.max_queue = 0           # Độ dài queue đầu vào lớn nhất đã gặp
+        self._lock = threading.Lock()
+
+    def add(self, busy, blocked=0.0, queue_size=0):
+        with self._lock:
+            self.processed += 1
+            self.busy_seconds += busy
+            self.blocked_seconds += blocked
+            self.max_queue = max(self.max_queue, queue_size)
+
+    def to_dict(self):
+        return {'workers': self.workers, 'processed': self.processed, 'busy': round(self.busy_seconds, 4),
+                'blocked': round(self.blocked_seconds, 4), 'max_queue': self.max_queue}
+
+class ImagePipeline:
+    """Chạy request tạo ảnh qua ba giai đoạn network -> decode -> disk
+
+    submit() trả về Future nhận WhiskResult cuối cùng (đã ghi file) nên có thể dùng với
+    concurrent.futures.wait như ThreadPoolExecutor thông thường.
+    """
+
+    def __init__(self, network_workers, decode_workers=DEFAULT_DECODE_WORKERS, disk_workers=DEFAULT_DISK_WORKERS,
+                 queue_size=None, postprocessor=None):
+        self.network_workers = max(1, int(network_workers))
+        self._pending = set()  # Future chưa hoàn tất (close() chờ hết trước khi dừng worker)
+        self._pending_lock = threading.Lock()
+        self.decode_retries = 0
+        self.decode_workers = max(1, int(decode_workers))
+        self.disk_workers = max(1, int(disk_workers))
+        self.postprocessor = postprocessor  # Được đóng cùng pipeline (close() chờ hậu xử lý xong)
+        # Mặc định mỗi worker decode/disk có tối đa 2 response đang chờ
+        self._decode_queue = queue.Queue(maxsize=queue_size or 2 * self.decode_workers)
+        self._disk_queue = queue.Queue(maxsize=queue_size or 2 * self.disk_workers)
+        self.stats = {
+            'network': StageStats('network', self.network_workers),
+            'decode': StageStats('decode', self.decode_workers),
+            'disk': StageStats('disk', self.disk_workers),
+        }
+        self._network = ThreadPoolExecutor(max_workers=self.network_workers, thread_name_prefix="net")
+        self._threads = []
+        for i in range(self.decode_workers):
+            self._start_worker(f"decode-{i}", self._decode_loop)
+        for i in range(self.disk_workers):
+            self._start_worker(f"disk-{i}", self._disk_loop)
+        self._closed = False
+
+    def _start_worker(self, name, target):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def submit(self, request_fn, image_path_for, on_stage=None, trace=None):
+        """Chạy request_fn() ở giai đoạn network
+
+        request_fn phải trả về WhiskResult lấy bằng defer_decode=True; result lỗi (hoặc giá trị
+        khác WhiskResult) được trả thẳng về Future mà không qua decode/disk.
+        on_stage(stage, duration, nbytes) được gọi khi task bắt đầu một giai đoạn (network/decode/disk),
+        duration là số giây của giai đoạn trước đó.
+        trace (tracing.Trace, None nếu task không được lấy mẫu) được gắn vào thread ở từng giai đoạn
+        và kết thúc khi Future hoàn tất.
+        """
+        future = Future()
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard_pending)
+        if trace is not None:
+            future.add_done_callback(lambda f: tracer.end(trace))
+        self._network.submit(self._network_task, future, request_fn, image_path_for, on_stage, trace,
+                             time.monotonic(), now_us())
+        return future
+
+    def _discard_pending(self, future):
+        with self._pending_lock:
+            self._pending.discard(future)
+
+    def _network_task(self, future, request_fn, image_path_for, on_stage, trace, submitted, submitted_us,
+                      retries=0, prior_attempts=0):
+        if retries == 0 and not future.set_running_or_notify_cancel():
+            return
+        started = time.monotonic()
+        tracer.record(trace, "wait_network", submitted_us, now_us())
+        if on_stage:
+            on_stage(STAGE_NETWORK, started - submitted, None)
+        previous = tracer.activate(trace)
+        try:
+            result = request_fn()
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        finally:
+            tracer.activate(previous)
+        if prior_attempts and hasattr(result, 'attempts'):
+            result.attempts += prior_attempts
+        busy = time.monotonic() - started
+        if not result or getattr(result, 'body', None) is None:
+            self.stats['network'].add(busy)
+            future.set_result(result)
+            return
+        if on_stage:
+            on_stage(STAGE_DECODE, busy, result.body_size)
+        blocked = self._put(self._decode_queue, (future, result, request_fn, image_path_for, on_stage, trace,
+                                                 now_us(), retries))
+        self.stats['network'].add(busy, blocked)
+
+    def _resubmit(self, future, request_fn, image_path_for, on_stage, trace, wait_started_us, retries,
+                  prior_attempts):
+        """Gửi lại task vào giai đoạn network sau thời gian chờ retry (chạy trên thread của timer)"""
+        tracer.record(trace, "retry_wait", wait_started_us, now_us())
+        self._network.submit(self._network_task, future, request_fn, image_path_for, on_stage, trace,
+                             time.monotonic(), now_us(), retries, prior_attempts)
+
+    def _decode_loop(self):
+        while True:
+            item = self._decode_queue.get()
+            if item is _STOP:
+                return
+            future, result, request_fn, image_path_for, on_stage, trace, enqueued_us, retries = item
+            queue_size = self._decode_queue.qsize() + 1
+            started = time.monotonic()
+            tracer.record(trace, "wait_decode", enqueued_us, now_us())
+            previous = tracer.activate(trace)
+            try:
+                images = decode_deferred_body(result, image_path_for)
+            except BaseException as e:
+                future.set_exception(e)
+                continue
+            finally:
+                tracer.activate(previous)
+            busy = time.monotonic() - started
+            if result.outcome == RequestOutcome.BAD_RESPONSE and retries < MAX_DECODE_RETRIES:
+                # Body hỏng: gọi lại request ở giai đoạn network (không chặn worker decode)
+                self.stats['decode'].add(busy, 0.0, queue_size)
+                self.decode_retries += 1
+                delay = DECODE_RETRY_DELAY * (retries + 1)
+                log.warning("Body không giải mã được ({}) - gửi lại request sau {:.1f} giây (lần {}/{})",
+                            result.error_message, delay, retries + 1, MAX_DECODE_RETRIES)
+                # Chờ bằng timer, chỉ chiếm worker network khi hết thời gian chờ
+                timer = threading.Timer(delay, self._resubmit, args=(future, request_fn, image_path_for, on_stage,
+                                                                     trace, now_us(), retries + 1, result.attempts))
+                timer.daemon = True
+                timer.start()
+                continue
+            if not result.ok or not images:
+                self.stats['decode'].add(busy, 0.0, queue_size)
+                future.set_result(result)
+                continue
+            if on_stage:
+                on_stage(STAGE_DISK, busy, sum(image.size for image in images))
+            blocked = self._put(self._disk_queue, (future, result, images, trace, now_us()))
+            self.stats['decode'].add(busy, blocked, queue_size)
+
+    def _disk_loop(self):
+        while True:
+            item = self._disk_queue.get()
+            if item is _STOP:
+                return
+            future, result, images, trace, enqueued_us = item
+            queue_size = self._disk_queue.qsize() + 1
+            started = time.monotonic()
+            tracer.record(trace, "wait_disk", enqueued_us, now_us())
+            previous = tracer.activate(trace)
+            hashes = {}
+            try:
+                for done, image in enumerate(images):
+                    hashes[image.full_path] = write_image_file(image)
+                    if self.postprocessor is not None:
+                        self.postprocessor.submit(image.full_path)
+            except Exception as e:
+                log.error("Lỗi khi lưu ảnh {}: {}", image.full_path, e)
+                for remaining in images[done + 1:]:
+                    discard_part_file(remaining.part_path)
+                future.set_exception(e)
+                continue
+            finally:
+                tracer.activate(previous)
+                self.stats['disk'].add(time.monotonic() - started, 0.0, queue_size)
+            # sha256 đi kèm savedPath để catalog/result cache không phải đọc lại file
+            for saved in iter_saved_images(result.data):
+                if saved['savedPath'] in hashes:
+                    saved['savedSha256'] = hashes[saved['savedPath']]
+            future.set_result(result)
+
+    def _put(self, target_queue, item):
+        """Đưa item vào queue của giai đoạn sau, trả về số giây phải chờ vì queue đầy"""
+        try:
+            target_queue.put_nowait(item)
+            return 0.0
+        except queue.Full:
+            started = time.monotonic()
+            target_queue.put(item)
+            return time.monotonic() - started
+
+    def stats_dict(self):
+        stages = {name: stage.to_dict() for name, stage in self.stats.items()}
+        stages['decode']['retries'] = self.decode_retries
+        return stages
+
+    def close(self):
+        """Chờ mọi request đã submit đi hết các giai đoạn rồi dừng worker"""
+        if self._closed:
+            return
+        self._closed = True
+        # Chờ mọi task xong trước: giai đoạn decode có thể gửi task lại giai đoạn network để thử lại
+        with self._pending_lock:
+            pending = list(self._pending)
+        wait(pending)
+        self._network.shutdown(wait=True)
+        decode_threads = self._threads[:self.decode_workers]
+        disk_threads = self._threads[self.decode_workers:]
+        for _ in decode_threads:
+            self._decode_queue.put(_STOP)
+        for thread in decode_threads:
+            thread.join()
+        for _ in disk_threads:
+            self._disk_queue.put(_STOP)
+        for thread in disk_threads:
+            thread.join()
+        if self.postprocessor is not None:
+            self.postprocessor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,183 @@
+import json
+import os
+import time
+import hashlib
+import threading
+
+# Trạng thái của một task trong journal
+STATE_PENDING = "pending"
+STATE_IN_FLIGHT = "in_flight"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+JOURNAL_PREFIX = ".whisk_journal_"
+
+def prompt_hash(prompt):
+    """Hash ngắn của prompt (để nhận biết dòng Excel đã đổi nội dung)"""
+    return hashlib.sha1(str(prompt).encode('utf-8')).hexdigest()[:16]
+
+def task_key(stt, prompt, seed, mode):
+    """Khóa của task: STT + hash prompt + seed + mode"""
+    return f"{mode}|{stt}|{seed}|{prompt_hash(prompt)}"
+
+def _json_default(value):
+    """Chuyển kiểu numpy/pandas (vd: STT đọc từ Excel) sang kiểu JSON"""
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+def journal_path_for(source_path, output_folder):
+    """Đường dẫn journal cho cặp (file Excel, thư mục output) - nằm trong thư mục output"""
+    source_id = hashlib.sha1(os.path.abspath(source_path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(output_folder, f"{JOURNAL_PREFIX}{source_id}.jsonl")
+
+def _read_records(path):
+    """Trạng thái mới nhất của mỗi key trong file journal, kèm số dòng đã đọc"""
+    entries = {}
+    line_count = 0
+    if not os.path.exists(path):
+        return entries, 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line_count += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Dòng ghi dở khi crash
+            key = record.get('key')
+            if key:
+                entry = entries.setdefault(key, {})
+                entry.update(record)
+    return entries, line_count
+
+def read_journal_entries(path):
+    """Đọc journal ở chế độ chỉ đọc (không mở để ghi, không compact): key -> entry"""
+    return _read_records(path)[0]
+
+class JobJournal:
+    """Journal append-only (JSONL) ghi trạng thái từng task, fsync theo lô để chịu được crash
+
+    Mỗi dòng là một bản ghi {"key", "state", ...}; khi mở lại, bản ghi sau cùng của mỗi key
+    là trạng thái hiện tại. Dòng cuối bị cắt dở (app chết khi đang ghi) được bỏ qua.
+    """
+
+    def __init__(self, path, fsync_every=20, fsync_interval=2.0):
+        self.path = path
+        self.fsync_every = fsync_every          # fsync sau mỗi N bản ghi
+        self.fsync_interval = fsync_interval    # ... hoặc sau N giây kể từ lần fsync trước
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        line_count = self._load()
+        if line_count > 2 * len(self._entries) + 100:
+            self._compact()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._file.tell() > 0 and not self._ends_with_newline():
+            self._file.write("\n")  # Tách dòng ghi dở khỏi các bản ghi mới
+
+    @classmethod
+    def open_for(cls, source_path, output_folder, **kwargs):
+        """Mở journal của cặp (file Excel, thư mục output)"""
+        os.makedirs(output_folder, exist_ok=True)
+        return cls(journal_path_for(source_path, output_folder), **kwargs)
+
+    def _load(self):
+        """Đọc lại journal, trả về số dòng đã đọc"""
+        self._entries, line_count = _read_records(self.path)
+        return line_count
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _compact(self):
+        """Ghi lại journal chỉ với trạng thái mới nhất của mỗi key"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False, default=_json_default) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _append(self, record):
+        with self._lock:
+            entry = self._entries.setdefault(record['key'], {})
+            entry.update(record)
+            self._file.write(json.dumps(record, ensure_ascii=False, default=_json_default) + "\n")
+            self._unsynced += 1
+            now = time.monotonic()
+            if self._unsynced >= self.fsync_every or now - self._last_sync >= self.fsync_interval:
+                self._sync_locked(now)
+
+    def _sync_locked(self, now=None):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = now if now is not None else time.monotonic()
+
+    def state_of(self, key):
+        entry = self._entries.get(key)
+        return entry.get('state') if entry else None
+
+    def is_done(self, key):
+        return self.state_of(key) == STATE_DONE
+
+    def mark_pending(self, key, stt, prompt, seed, mode):
+        """Ghi nhận task mới (giữ lại prompt để có thể retry sau khi mở lại app)"""
+        self._append({
+            'key': key, 'state': STATE_PENDING, 'stt': stt, 'prompt': prompt,
+            'prompt_hash': prompt_hash(prompt), 'seed': seed, 'mode': mode, 'ts': time.time()
+        })
+
+    def mark_in_flight(self, key):
+        self._append({'key': key, 'state': STATE_IN_FLIGHT, 'ts': time.time()})
+
+    def mark_done(self, key, saved_path=None, variant_paths=None):
+        """Task hoàn thành; saved_path là ảnh chính, variant_paths là các biến thể thêm (nếu có)"""
+        record = {'key': key, 'state': STATE_DONE, 'reason': None, 'ts': time.time()}
+        if saved_path:
+            record['saved_path'] = saved_path
+            record['variant_paths'] = list(variant_paths or [])
+        self._append(record)
+
+    def mark_failed(self, key, reason):
+        self._append({'key': key, 'state': STATE_FAILED, 'reason': reason, 'ts': time.time()})
+
+    def entries(self, states=None, mode=None):
+        """Danh sách entry (bản sao) theo trạng thái/mode"""
+        with self._lock:
+            return [dict(entry) for entry in self._entries.values()
+                    if (states is None or entry.get('state') in states)
+                    and (mode is None or entry.get('mode') == mode)]
+
+    def unfinished_entries(self, mode=None):
+        """Task thất bại hoặc dở dang (pending/in-flight khi app bị tắt) - dùng cho Retry"""
+        return self.entries((STATE_FAILED, STATE_PENDING, STATE_IN_FLIGHT), mode)
+
+    def counts(self):
+        counts = {}
+        with self._lock:
+            for entry in self._entries.values():
+                counts[entry.get('state')] = counts.get(entry.get('state'), 0) + 1
+        return counts
+
+    def flush(self):
+        with self._lock:
+            if self._unsynced:
+                self._sync_locked()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync_locked()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,22 +1,396 @@
 import sys
 import json
 import os
+import multiprocessing
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QTabWidget, QWidget, 
                              QVBoxLayout, QHBoxLayout, QPushButton, QTableWidget, 
                              QTableWidgetItem, QDialog, QTextEdit, QLabel, 
                              QLineEdit, QFileDialog, QMessageBox, QProgressBar,
                              QGroupBox, QGridLayout, QComboBox, QSpinBox,
-                             QTextBrowser, QSplitter, QCheckBox)
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
-from PyQt5.QtGui import QFont
+                             QTextBrowser, QSplitter, QCheckBox, QTableView, QHeaderView)
+from PyQt5.QtCore import (Qt, QThread, pyqtSignal, QObject, QTimer, QFileSystemWatcher,
+                          QAbstractTableModel, QModelIndex)
+from PyQt5.QtGui import QFont, QTextCursor
+from collections import deque
 from datetime import datetime
-from PIL import Image
+import html
 
-from api import (get_access_token, generate_image, 
-                generate_image_from_multiple_images,
-                 upload_image_to_google_labs, save_base64_image, sanitize_filename,
-                 edit_image_with_prompt)
-import api  # Import module để truy cập biến global
+from api import log
+from batch_engine import (ExcelBatchRunner, SinglePromptRunner, SyncBatchRunner,
+                          resolve_access_token, prepare_sync_source, unfinished_sync_entries,
+                          AUTH_FAILED_MESSAGE, LOG_INFO, LOG_SUCCESS, LOG_WARNING,
+                          LOG_ERROR, LOG_HINT, LOG_STATS, LOG_STATUS)
+from token_manager import token_manager
+from sheet_cache import sheet_cache
+from progress_events import RunStats
+from metrics import start_metrics_server
+from catalog import output_catalog
+from result_cache import result_cache
+from sheet_reader import MissingColumnsError, SHEET_FILE_FILTER, COLUMN_NAMES
+
+class ExcelFileWatcher(QObject):
+    """Theo dõi file Excel đang chọn, chỉ báo sheet_changed khi file thực sự đổi
+
+    QFileSystemWatcher có thể báo nhiều lần cho một lần lưu, nên các sự kiện được gom lại
+    và mtime/size được so với bản đã parse trong sheet_cache trước khi đọc lại.
+    """
+    sheet_changed = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.path = None
+        self._watcher = QFileSystemWatcher(self)
+        self._watcher.fileChanged.connect(lambda path: self._timer.start())
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(300)
+        self._timer.timeout.connect(self._check)
+
+    def watch(self, path):
+        """Chuyển sang theo dõi path (None để ngừng theo dõi)"""
+        files = self._watcher.files()
+        if files:
+            self._watcher.removePaths(files)
+        self.path = path
+        if path and os.path.exists(path):
+            self._watcher.addPath(path)
+
+    def _check(self):
+        path = self.path
+        if not path or not os.path.exists(path):
+            return
+        # Excel lưu bằng cách ghi file mới rồi đổi tên, khiến watcher mất file - thêm lại
+        if path not in self._watcher.files():
+            self._watcher.addPath(path)
+        if sheet_cache.is_current(path):
+            return
+        sheet_cache.invalidate(path)
+        self.sheet_changed.emit(path)
+
+class SheetLoadCancelled(Exception):
+    """Lượt parse preview bị hủy vì đã chọn file khác"""
+
+class SheetLoadThread(QThread):
+    """Parse sheet ngoài GUI thread, gửi dần từng đợt dòng để bảng preview hiện ngay"""
+    rows_loaded = pyqtSignal(object)  # list các dòng vừa đọc
+    loaded = pyqtSignal(object)       # ParsedSheet hoàn chỉnh (đã nằm trong sheet_cache)
+    failed = pyqtSignal(str, bool)    # message, True nếu file thiếu cột
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        try:
+            sheet = sheet_cache.get(self.path, on_rows=self._emit_rows)
+        except SheetLoadCancelled:
+            return
+        except MissingColumnsError as e:
+            self.failed.emit(str(e), True)
+            return
+        except Exception as e:
+            self.failed.emit(str(e), False)
+            return
+        if not self._cancelled:
+            self.loaded.emit(sheet)
+
+    def _emit_rows(self, rows):
+        if self._cancelled:
+            raise SheetLoadCancelled()
+        self.rows_loaded.emit(rows)
+
+class SheetTableModel(QAbstractTableModel):
+    """Model cho bảng preview: giữ tuple các dòng của sheet, chỉ tạo text khi view cần vẽ ô
+
+    columns là chỉ số cột trong dòng 8 cột (STT, PROMPT, SUBJECT, ...). load() parse file
+    trong SheetLoadThread và thêm dòng vào model theo từng đợt.
+    """
+    rows_loading = pyqtSignal(int)  # Số dòng đã đọc được tới lúc này
+    loaded = pyqtSignal(object)     # ParsedSheet
+    failed = pyqtSignal(str, bool)  # message, True nếu file thiếu cột
+
+    def __init__(self, columns, parent=None):
+        super().__init__(parent)
+        self.columns = tuple(columns)
+        self._rows = []
+        self._loader = None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        column = self.columns[index.column()]
+        if role == Qt.DisplayRole:
+            return str(self._rows[index.row()][column])
+        if role == Qt.TextAlignmentRole and column == 0:
+            return Qt.AlignCenter
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return COLUMN_NAMES[self.columns[section]]
+        return super().headerData(section, orientation, role)
+
+    def load(self, path):
+        """Xóa dữ liệu cũ và bắt đầu parse path (lượt đang chạy, nếu có, bị hủy)"""
+        self.clear()
+        loader = SheetLoadThread(path, self)
+        loader.rows_loaded.connect(lambda rows: self._on_rows_loaded(loader, rows))
+        loader.loaded.connect(lambda sheet: self._on_loaded(loader, sheet))
+        loader.failed.connect(lambda message, missing: self._on_failed(loader, message, missing))
+        loader.finished.connect(loader.deleteLater)
+        self._loader = loader
+        loader.start()
+
+    def clear(self):
+        if self._loader is not None:
+            self._loader.cancel()
+            self._loader = None
+        self.beginResetModel()
+        self._rows = []
+        self.endResetModel()
+
+    def _on_rows_loaded(self, loader, rows):
+        if loader is not self._loader:
+            return
+        start = len(self._rows)
+        self.beginInsertRows(QModelIndex(), start, start + len(rows) - 1)
+        self._rows.extend(rows)
+        self.endInsertRows()
+        self.rows_loading.emit(len(self._rows))
+
+    def _on_loaded(self, loader, sheet):
+        if loader is not self._loader:
+            return
+        self._loader = None
+        if len(sheet.rows) == len(self._rows):
+            self._rows = sheet.rows  # Cùng dữ liệu - dùng chung list của cache
+        else:
+            # Lấy từ cache (không qua rows_loaded)
+            self.beginResetModel()
+            self._rows = sheet.rows
+            self.endResetModel()
+        self.loaded.emit(sheet)
+
+    def _on_failed(self, loader, message, missing_columns):
+        if loader is not self._loader:
+            return
+        self._loader = None
+        self.beginResetModel()
+        self._rows = []
+        self.endResetModel()
+        self.failed.emit(message, missing_columns)
+
+def create_sheet_table(model):
+    """QTableView cho preview sheet (dòng cao cố định để view không phải đo từng dòng)"""
+    table = QTableView()
+    table.setModel(model)
+    table.setStyleSheet("""
+        QTableView {
+            background-color: white;
+            border-radius: 3px;
+            gridline-color: #f0f0f0;
+            font-family: "Open Sans";
+            border: none;
+        }
+        QHeaderView::section {
+            background-color: #f8f9fa;
+            padding: 8px;
+            border: none;
+            border-right: 1px solid #f0f0f0;
+            border-bottom: 1px solid #e0e0e0;
+            font-weight: bold;
+            font-size: 12px;
+            font-family: "Open Sans";
+            color: #333;
+        }
+        QHeaderView::section:first {
+            border-left: none;
+        }
+        QHeaderView::section:last {
+            border-right: none;
+        }
+    """)
+    table.setAlternatingRowColors(True)
+    table.horizontalHeader().setStretchLastSection(True)
+    table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+    table.verticalHeader().setDefaultSectionSize(35)
+    
+    # Căn giữa header
+    table.horizontalHeader().setDefaultAlignment(Qt.AlignCenter)
+    return table
+
+# Màu của từng mức log trong khung nhật ký
+LOG_COLORS = {
+    LOG_SUCCESS: "#4CAF50",  # Xanh lá
+    LOG_ERROR: "#F44336",    # Đỏ
+    LOG_WARNING: "#FF9800",  # Cam
+    LOG_HINT: "#2196F3",     # Xanh dương
+    LOG_STATS: "#9C27B0",    # Tím
+    LOG_STATUS: "#00BCD4",   # Cyan
+    LOG_INFO: "#FFFFFF",     # Trắng mặc định
+}
+LOG_MAX_LINES = 5000        # Số dòng nhật ký giữ lại tối đa (dòng cũ nhất bị xóa trước)
+LOG_FLUSH_INTERVAL_MS = 100  # Message được gom lại và ghi ra theo lô sau mỗi khoảng này
+
+class LogConsole(QTextBrowser):
+    """Khung nhật ký dạng ring buffer
+
+    Message được đưa vào hàng đợi và ghi ra theo lô mỗi LOG_FLUSH_INTERVAL_MS, document chỉ giữ
+    max_lines dòng gần nhất nên lượt chạy dài (nhiều traceback) không làm GUI chậm dần.
+    """
+
+    def __init__(self, max_lines=LOG_MAX_LINES, flush_interval=LOG_FLUSH_INTERVAL_MS, parent=None):
+        super().__init__(parent)
+        self.document().setMaximumBlockCount(max_lines)
+        self._pending = deque(maxlen=max_lines)
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(flush_interval)
+        self._timer.timeout.connect(self.flush)
+
+    def append_message(self, message, level=LOG_INFO):
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        self._pending.append((timestamp, message, level))
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def flush(self):
+        """Ghi các message đang chờ vào document; chỉ cuộn xuống cuối nếu đang ở cuối"""
+        if not self._pending:
+            return
+        scrollbar = self.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum() - 4
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.beginEditBlock()
+        first = self.document().isEmpty()
+        while self._pending:
+            timestamp, message, level = self._pending.popleft()
+            if not first:
+                cursor.insertBlock()
+            first = False
+            color = LOG_COLORS.get(level, LOG_COLORS[LOG_INFO])
+            text = html.escape(f"[{timestamp}] {message}").replace("\n", "<br>")
+            cursor.insertHtml(f'<span style="color: {color};">{text}</span>')
+        cursor.endEditBlock()
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
+
+    def clear(self):
+        self._pending.clear()
+        super().clear()
+
+class WorkerThread(QThread):
+    """QThread chạy engine: message tiến độ được gửi kèm mức log do runner truyền vào progress(message, level)
+
+    TaskEvent của runner được gom vào run_stats (không qua signal) để dashboard đọc theo nhịp riêng.
+    """
+    progress = pyqtSignal(str, str)  # message, level
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.run_stats = RunStats()
+
+    def report(self, message, level=LOG_INFO):
+        self.progress.emit(message, level)
+
+DASHBOARD_REFRESH_MS = 250  # Dashboard cập nhật 4 lần/giây, không phụ thuộc số event
+
+def expected_task_count(excel_path):
+    """Số dòng hợp lệ của sheet nếu đã parse (preview), None nếu chưa biết"""
+    sheet = sheet_cache.peek(excel_path) if excel_path else None
+    return sheet.stats['valid'] if sheet is not None else None
+
+def format_duration(seconds):
+    """Số giây -> "1h02m", "3m05s", "12s" ("-" nếu chưa biết)"""
+    if seconds is None:
+        return "-"
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+def format_latency(seconds):
+    return "-" if seconds is None else f"{seconds:.1f}s"
+
+class RunDashboard(QGroupBox):
+    """Bảng số liệu lượt chạy: ảnh/phút, đang xử lý, hàng đợi, ETA, độ trễ p50/p95
+
+    Đọc RunStats.snapshot() theo timer (DASHBOARD_REFRESH_MS) và cập nhật progress bar theo
+    số task đã xong nếu biết tổng số task.
+    """
+
+    FIELDS = (
+        ('rate', "Ảnh/phút"),
+        ('in_flight', "Đang xử lý"),
+        ('queue', "Hàng đợi"),
+        ('eta', "ETA"),
+        ('latency', "Độ trễ p50/p95"),
+        ('counts', "Xong/Lỗi/Bỏ qua"),
+    )
+
+    def __init__(self, progress_bar=None, parent=None):
+        super().__init__("Tiến độ", parent)
+        self.progress_bar = progress_bar
+        self.stats = None
+        layout = QGridLayout()
+        layout.setContentsMargins(8, 4, 8, 4)
+        self.value_labels = {}
+        for index, (key, title) in enumerate(self.FIELDS):
+            title_label = QLabel(title)
+            title_label.setStyleSheet("color: #666; font-size: 11px;")
+            value_label = QLabel("-")
+            value_label.setStyleSheet("font-weight: bold; font-size: 13px;")
+            layout.addWidget(title_label, (index // 3) * 2, index % 3)
+            layout.addWidget(value_label, (index // 3) * 2 + 1, index % 3)
+            self.value_labels[key] = value_label
+        self.setLayout(layout)
+        self._timer = QTimer(self)
+        self._timer.setInterval(DASHBOARD_REFRESH_MS)
+        self._timer.timeout.connect(self.refresh)
+
+    def track(self, stats, total=None):
+        """Bắt đầu hiển thị RunStats của lượt chạy mới (total: số task dự kiến nếu biết)"""
+        self.stats = stats
+        if total is not None:
+            stats.total = total
+        if self.progress_bar is not None:
+            self.progress_bar.setRange(0, 0 if total is None else max(1, total))
+            self.progress_bar.setValue(0)
+        self.refresh()
+        self._timer.start()
+
+    def stop(self):
+        """Dừng cập nhật (giữ số liệu cuối cùng trên màn hình)"""
+        self._timer.stop()
+        self.refresh()
+
+    def refresh(self):
+        if self.stats is None:
+            return
+        snapshot = self.stats.snapshot()
+        stages = snapshot['stages']
+        self.value_labels['rate'].setText(f"{snapshot['images_per_min']:.1f}")
+        self.value_labels['in_flight'].setText(
+            f"{snapshot['in_flight']} (net {stages['network']} / dec {stages['decode']} / disk {stages['disk']})")
+        self.value_labels['queue'].setText(str(snapshot['queue_depth']))
+        self.value_labels['eta'].setText(format_duration(snapshot['eta']))
+        self.value_labels['latency'].setText(f"{format_latency(snapshot['p50'])} / {format_latency(snapshot['p95'])}")
+        self.value_labels['counts'].setText(f"{snapshot['done']} / {snapshot['failed']} / {snapshot['skipped']}")
+        if self.progress_bar is not None and snapshot['total'] is not None:
+            self.progress_bar.setValue(min(snapshot['total'], snapshot['done'] + snapshot['failed'] + snapshot['skipped']))
 
 class CookieDialog(QDialog):
     """Dialog để thêm cookie mới"""
@@ -134,8 +508,8 @@ class CookieTestThread(QThread):
     
     def run(self):
         try:
-            # Lấy access token mới từ cookie
-            access_data = get_access_token(self.cookie)
+            # Lấy access token mới từ cookie (và cập nhật token dùng chung cho các tab tạo ảnh)
+            access_data = token_manager.refresh(self.cookie)
             if access_data and access_data.get('access_token'):
                 user_info = access_data.get('user', {})
                 name = user_info.get('name', 'Unknown')
@@ -407,7 +781,7 @@ class AccountManagementTab(QWidget):
             
             # Test cookie một lần nữa để lấy user_info
             try:
-                access_data = get_access_token(cookie_data['cookie'])
+                access_data = token_manager.refresh(cookie_data['cookie'])
                 if access_data and access_data.get('access_token'):
                     user_info = access_data.get('user', {})
                     user_info['access_token'] = access_data.get('access_token')
@@ -576,6 +950,9 @@ class ImageGenerationTab(QWidget):
         self.selected_scene_path = None
         self.selected_style_path = None
         self.output_folder_path = None
+        # Đọc lại preview khi file Excel đang chọn bị sửa
+        self.excel_watcher = ExcelFileWatcher(self)
+        self.excel_watcher.sheet_changed.connect(self.on_excel_file_changed)
         self.init_ui()
     
     def init_ui(self):
@@ -646,43 +1023,12 @@ class ImageGenerationTab(QWidget):
         self.excel_preview_label.setWordWrap(True)
         excel_layout.addWidget(self.excel_preview_label)
         
-        # Excel data table
-        self.excel_table = QTableWidget()
-        self.excel_table.setColumnCount(8)
-        self.excel_table.setHorizontalHeaderLabels(["STT", "PROMPT", "SUBJECT", "SUBJECT_CAPTION", "SCENE", "SCENE_CAPTION", "STYLE", "STYLE_CAPTION"])
-        self.excel_table.setStyleSheet("""
-            QTableWidget {
-                background-color: white;
-                border-radius: 3px;
-                gridline-color: #f0f0f0;
-                font-family: "Open Sans";
-                border: none;
-            }
-            QHeaderView::section {
-                background-color: #f8f9fa;
-                padding: 8px;
-                border: none;
-                border-right: 1px solid #f0f0f0;
-                border-bottom: 1px solid #e0e0e0;
-                font-weight: bold;
-                font-size: 12px;
-                font-family: "Open Sans";
-                color: #333;
-            }
-            QHeaderView::section:first {
-                border-left: none;
-            }
-            QHeaderView::section:last {
-                border-right: none;
-            }
-        """)
-        self.excel_table.setAlternatingRowColors(True)
-        self.excel_table.horizontalHeader().setStretchLastSection(True)
-        self.excel_table.verticalHeader().setDefaultSectionSize(35)
-        
-        # Căn giữa header
-        header = self.excel_table.horizontalHeader()
-        header.setDefaultAlignment(Qt.AlignCenter)
+        # Excel data table (model/view: chỉ vẽ các dòng đang hiển thị)
+        self.excel_model = SheetTableModel(range(8), self)
+        self.excel_model.rows_loading.connect(self.on_sheet_rows_loading)
+        self.excel_model.loaded.connect(self.on_sheet_loaded)
+        self.excel_model.failed.connect(self.on_sheet_load_failed)
+        self.excel_table = create_sheet_table(self.excel_model)
         
         excel_layout.addWidget(self.excel_table)
         
@@ -768,13 +1114,17 @@ class ImageGenerationTab(QWidget):
         self.count_spinbox.setValue(1)
         settings_layout.addWidget(self.count_spinbox, 1, 1)
         
-        # Thread count cho Excel mode
+        # Số luồng cho cả Excel mode và tạo nhiều ảnh từ một prompt
         settings_layout.addWidget(QLabel("Số luồng:"), 2, 0)
         self.thread_spinbox = QSpinBox()
         self.thread_spinbox.setRange(1, 5)  # Tối đa 5 luồng
         self.thread_spinbox.setValue(5)     # Mặc định 5 luồng
         settings_layout.addWidget(self.thread_spinbox, 2, 1)
         
+        # Ảnh cùng prompt/seed/tỷ lệ đã tạo trước đó được lấy từ result cache, trừ khi chọn tạo lại
+        self.force_regenerate_checkbox = QCheckBox("Tạo lại ảnh đã có trong cache")
+        self.force_regenerate_checkbox.setToolTip("Luôn gọi API, không dùng lại ảnh cùng prompt/seed/tỷ lệ đã tạo trước đó")
+        settings_layout.addWidget(self.force_regenerate_checkbox, 3, 0, 1, 2)
         
         # Aspect ratio
         settings_layout.addWidget(QLabel("Tỷ lệ:"), 4, 0)
@@ -868,11 +1218,15 @@ class ImageGenerationTab(QWidget):
         right_panel = QWidget()
         right_layout = QVBoxLayout()
         
+        # Dashboard tiến độ (ảnh/phút, ETA, độ trễ...) của lượt chạy hiện tại
+        self.dashboard = RunDashboard(self.progress_bar)
+        right_layout.addWidget(self.dashboard)
+        
         log_label = QLabel("Nhật ký")
         log_label.setStyleSheet("font-weight: bold;")
         right_layout.addWidget(log_label)
         
-        self.log_text = QTextBrowser()
+        self.log_text = LogConsole()
         self.log_text.setStyleSheet("""
             QTextBrowser {
                 background-color: #1e1e1e;
@@ -981,7 +1335,7 @@ class ImageGenerationTab(QWidget):
                         
                         self.account_combo.addItem(display_text, account_name)
         except Exception as e:
-            self.log_message(f"Lỗi khi load tài khoản: {str(e)}")
+            self.log_message(f"Lỗi khi load tài khoản: {str(e)}", LOG_ERROR)
     
     def on_mode_changed(self, mode):
         """Xử lý khi thay đổi chế độ"""
@@ -996,12 +1350,10 @@ class ImageGenerationTab(QWidget):
         # Reset data khi thay đổi mode
         if not is_excel_mode:
             self.selected_excel_path = None
+            self.excel_watcher.watch(None)
             self.excel_path_label.setText("Chưa chọn file Excel")
             self.excel_preview_label.setText("")
-            self.excel_table.setRowCount(0)
-            # Reset về 8 cột cho Image to Image mode
-            self.excel_table.setColumnCount(8)
-            self.excel_table.setHorizontalHeaderLabels(["STT", "PROMPT", "SUBJECT", "SUBJECT_CAPTION", "SCENE", "SCENE_CAPTION", "STYLE", "STYLE_CAPTION"])
+            self.excel_model.clear()
         
         if not is_img2img_mode:
             self.selected_subject_path = None
@@ -1045,100 +1397,52 @@ class ImageGenerationTab(QWidget):
     def select_excel_file(self):
         """Chọn file Excel"""
         file_path, _ = QFileDialog.getOpenFileName(
-            self, "Chọn file Excel", "", "Excel Files (*.xlsx *.xls)")
+            self, "Chọn file Excel", "", SHEET_FILE_FILTER)
         
         if file_path:
             self.selected_excel_path = file_path
             self.excel_path_label.setText(os.path.basename(file_path))
             self.excel_path_label.setStyleSheet("color: black;")
+            self.excel_watcher.watch(file_path)
             
             # Preview Excel data
             self.preview_excel_data(file_path)
     
+    def on_excel_file_changed(self, file_path):
+        """File Excel đang chọn đã được sửa: parse lại và cập nhật preview"""
+        if file_path != self.selected_excel_path:
+            return
+        self.log_message(f"🔄 File {os.path.basename(file_path)} đã thay đổi - đã đọc lại dữ liệu", LOG_STATUS)
+        self.preview_excel_data(file_path)
+    
     def preview_excel_data(self, file_path):
-        """Preview dữ liệu Excel"""
-        try:
-            import pandas as pd
-            
-            mode = self.mode_combo.currentText()
-            df = pd.read_excel(file_path)
-            
-            if "Excel" in mode:
-                # Excel: STT, PROMPT, SUBJECT, SUBJECT_CAPTION, SCENE, SCENE_CAPTION, STYLE, STYLE_CAPTION
-                if len(df.columns) >= 2:
-                    stt_list = df.iloc[:, 0].tolist()
-                    prompt_list = df.iloc[:, 1].tolist()
-                    
-                    # Lấy các cột ảnh và caption (có thể để trống)
-                    subject_list = df.iloc[:, 2].fillna("").tolist() if len(df.columns) > 2 else [""] * len(stt_list)
-                    subject_caption_list = df.iloc[:, 3].fillna("").tolist() if len(df.columns) > 3 else [""] * len(stt_list)
-                    scene_list = df.iloc[:, 4].fillna("").tolist() if len(df.columns) > 4 else [""] * len(stt_list)
-                    scene_caption_list = df.iloc[:, 5].fillna("").tolist() if len(df.columns) > 5 else [""] * len(stt_list)
-                    style_list = df.iloc[:, 6].fillna("").tolist() if len(df.columns) > 6 else [""] * len(stt_list)
-                    style_caption_list = df.iloc[:, 7].fillna("").tolist() if len(df.columns) > 7 else [""] * len(stt_list)
-                    
-                    # Tự động detect mode dựa trên dữ liệu
-                    has_images = any(
-                        str(subject).strip() and str(subject).strip().lower() != 'nan' or
-                        str(scene).strip() and str(scene).strip().lower() != 'nan' or
-                        str(style).strip() and str(style).strip().lower() != 'nan'
-                        for subject, scene, style in zip(subject_list, scene_list, style_list)
-                    )
-                    
-                    detected_mode = "Image to Image" if has_images else "Prompt to Image"
-                    preview_text = f"📊 Đã đọc {len(stt_list)} dòng dữ liệu - Tự động detect: {detected_mode}"
-                    self.excel_preview_label.setText(preview_text)
-                    
-                    # Hiển thị trong table (8 cột)
-                    self.excel_table.setColumnCount(8)
-                    self.excel_table.setHorizontalHeaderLabels(["STT", "PROMPT", "SUBJECT", "SUBJECT_CAPTION", "SCENE", "SCENE_CAPTION", "STYLE", "STYLE_CAPTION"])
-                    self.excel_table.setRowCount(len(stt_list))
-                    
-                    for i, (stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption) in enumerate(zip(
-                        stt_list, prompt_list, subject_list, subject_caption_list, 
-                        scene_list, scene_caption_list, style_list, style_caption_list)):
-                        
-                        # STT
-                        stt_item = QTableWidgetItem(str(stt))
-                        stt_item.setTextAlignment(Qt.AlignCenter)
-                        self.excel_table.setItem(i, 0, stt_item)
-                        
-                        # Prompt
-                        prompt_item = QTableWidgetItem(str(prompt))
-                        self.excel_table.setItem(i, 1, prompt_item)
-                        
-                        # Subject
-                        subject_item = QTableWidgetItem(str(subject))
-                        self.excel_table.setItem(i, 2, subject_item)
-                        
-                        # Subject Caption
-                        subject_caption_item = QTableWidgetItem(str(subject_caption))
-                        self.excel_table.setItem(i, 3, subject_caption_item)
-                        
-                        # Scene
-                        scene_item = QTableWidgetItem(str(scene))
-                        self.excel_table.setItem(i, 4, scene_item)
-                        
-                        # Scene Caption
-                        scene_caption_item = QTableWidgetItem(str(scene_caption))
-                        self.excel_table.setItem(i, 5, scene_caption_item)
-                        
-                        # Style
-                        style_item = QTableWidgetItem(str(style))
-                        self.excel_table.setItem(i, 6, style_item)
-                        
-                        # Style Caption
-                        style_caption_item = QTableWidgetItem(str(style_caption))
-                        self.excel_table.setItem(i, 7, style_caption_item)
-                else:
-                    preview_text = "❌ File Excel cần có ít nhất 2 cột: STT, PROMPT"
-                    self.excel_preview_label.setText(preview_text)
-                    self.excel_table.setRowCount(0)
-            
-        except Exception as e:
-            self.excel_preview_label.setText(f"❌ Lỗi khi đọc file Excel: {str(e)}")
-            self.excel_preview_label.setStyleSheet("color: red; font-size: 12px;")
-            self.excel_table.setRowCount(0)
+        """Preview dữ liệu Excel (parse trong thread riêng, bảng hiện dần theo từng đợt dòng)"""
+        mode = self.mode_combo.currentText()
+        
+        if "Excel" in mode:
+            # Excel: STT, PROMPT, SUBJECT, SUBJECT_CAPTION, SCENE, SCENE_CAPTION, STYLE, STYLE_CAPTION
+            # Parse một lần, dùng lại khi nhấn Generate nếu file chưa đổi
+            self.excel_preview_label.setText("⏳ Đang đọc dữ liệu...")
+            self.excel_preview_label.setStyleSheet("color: blue; font-size: 12px;")
+            self.excel_model.load(file_path)
+    
+    def on_sheet_rows_loading(self, count):
+        self.excel_preview_label.setText(f"⏳ Đang đọc dữ liệu... {count} dòng")
+    
+    def on_sheet_loaded(self, sheet):
+        # Tự động detect mode dựa trên dữ liệu
+        has_images = sheet.stats['image_to_image'] > 0
+        
+        detected_mode = "Image to Image" if has_images else "Prompt to Image"
+        preview_text = f"📊 Đã đọc {sheet.stats['rows']} dòng dữ liệu - Tự động detect: {detected_mode}"
+        self.excel_preview_label.setText(preview_text)
+    
+    def on_sheet_load_failed(self, message, missing_columns):
+        if missing_columns:
+            self.excel_preview_label.setText("❌ File Excel cần có ít nhất 2 cột: STT, PROMPT")
+        else:
+            self.excel_preview_label.setText(f"❌ Lỗi khi đọc file Excel: {message}")
+        self.excel_preview_label.setStyleSheet("color: red; font-size: 12px;")
     
     def get_aspect_ratio(self):
         """Lấy aspect ratio từ combo box"""
@@ -1150,34 +1454,9 @@ class ImageGenerationTab(QWidget):
         else:  # Landscape
             return "IMAGE_ASPECT_RATIO_LANDSCAPE"
     
-    def log_message(self, message):
-        """Thêm message vào log với màu sắc"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        
-        # Xác định màu sắc dựa trên nội dung message
-        if "✅" in message or "thành công" in message.lower():
-            color = "#4CAF50"  # Xanh lá
-        elif "❌" in message or "lỗi" in message.lower() or "error" in message.lower():
-            color = "#F44336"  # Đỏ
-        elif "⚠️" in message or "cảnh báo" in message.lower() or "warning" in message.lower():
-            color = "#FF9800"  # Cam
-        elif "🔧" in message or "hướng dẫn" in message.lower():
-            color = "#2196F3"  # Xanh dương
-        elif "📊" in message or "thống kê" in message.lower():
-            color = "#9C27B0"  # Tím
-        elif "🔄" in message or "đang" in message.lower():
-            color = "#00BCD4"  # Cyan
-        else:
-            color = "#FFFFFF"  # Trắng mặc định
-        
-        # Tạo HTML với màu sắc
-        html_message = f'<span style="color: {color};">[{timestamp}] {message}</span>'
-        self.log_text.append(html_message)
-        
-        # Scroll xuống cuối
-        self.log_text.verticalScrollBar().setValue(
-            self.log_text.verticalScrollBar().maximum()
-        )
+    def log_message(self, message, level=LOG_INFO):
+        """Thêm message vào nhật ký (màu theo mức log, hiển thị theo lô)"""
+        self.log_text.append_message(message, level)
     
     def generate_image(self):
         """Tạo ảnh"""
@@ -1240,7 +1519,7 @@ class ImageGenerationTab(QWidget):
             self.generation_thread = ExcelGenerationThread(
                 cookie, saved_access_token, mode, self.selected_excel_path, 
                 self.seed_spinbox.value(), self.thread_spinbox.value(), aspect_ratio,
-                self.output_folder_path
+                self.output_folder_path, self.force_regenerate_checkbox.isChecked(), account_name
             )
         else:
             prompt = self.prompt_text.toPlainText().strip()
@@ -1249,17 +1528,21 @@ class ImageGenerationTab(QWidget):
                 self.selected_subject_path, self.selected_scene_path, self.selected_style_path,
                 self.subject_caption_input.text(), self.scene_caption_input.text(), self.style_caption_input.text(),
                 self.seed_spinbox.value(), self.count_spinbox.value(), aspect_ratio,
-                self.output_folder_path
+                self.output_folder_path, self.force_regenerate_checkbox.isChecked(), account_name,
+                self.thread_spinbox.value()
             )
         
         self.generation_thread.progress.connect(self.log_message)
         self.generation_thread.finished.connect(self.on_generation_finished)
+        self.dashboard.track(self.generation_thread.run_stats,
+                             expected_task_count(self.selected_excel_path) if is_excel_mode else self.count_spinbox.value())
         self.generation_thread.start()
     
     def on_generation_finished(self, success, message):
         """Xử lý khi hoàn thành tạo ảnh"""
         self.generate_btn.setEnabled(True)
         self.progress_bar.setVisible(False)
+        self.dashboard.stop()
         
         if success:
             QMessageBox.information(self, "Thành công", message)
@@ -1267,12 +1550,12 @@ class ImageGenerationTab(QWidget):
             QMessageBox.warning(self, "Lỗi", message)
 
 
-class ExcelGenerationThread(QThread):
-    """Thread để tạo ảnh từ Excel"""
-    progress = pyqtSignal(str)
+class ExcelGenerationThread(WorkerThread):
+    """Thread để tạo ảnh từ Excel (chạy ExcelBatchRunner của batch_engine)"""
     finished = pyqtSignal(bool, str)
     
-    def __init__(self, cookie, saved_access_token, mode, excel_path, seed, thread_count, aspect_ratio, output_folder=None):
+    def __init__(self, cookie, saved_access_token, mode, excel_path, seed, thread_count, aspect_ratio, output_folder=None,
+                 force_regenerate=False, account_name=None):
         super().__init__()
         self.cookie = cookie
         self.saved_access_token = saved_access_token
@@ -1282,347 +1565,33 @@ class ExcelGenerationThread(QThread):
         self.thread_count = thread_count
         self.aspect_ratio = aspect_ratio
         self.output_folder = output_folder
-    
-    def test_access_token(self, access_token):
-        """Test xem access token có còn hợp lệ không"""
-        try:
-            # Kiểm tra thời gian hết hạn trước (nếu có thông tin)
-            # Đọc thông tin từ cookies.json để lấy expires_at
-            try:
-                with open('cookies.json', 'r', encoding='utf-8') as f:
-                    cookies_data = json.load(f)
-                
-                # Tìm tài khoản có access_token này
-                for account_name, data in cookies_data.items():
-                    saved_token = data.get('user_info', {}).get('access_token')
-                    if saved_token == access_token:
-                        expires_at = data.get('user_info', {}).get('expires_at')
-                        if expires_at and expires_at != 'Unknown':
-                            try:
-                                from datetime import datetime
-                                expiry_time = datetime.strptime(expires_at, "%Y-%m-%d %H:%M:%S")
-                                current_time = datetime.now()
-                                
-                                if current_time > expiry_time:
-                                    # Token đã hết hạn theo thời gian
-                                    return False
-                                else:
-                                    # Token còn hợp lệ theo thời gian, test bằng API
-                                    break
-                            except:
-                                # Lỗi parse thời gian, test bằng API
-                                break
-                        else:
-                            # Không có thông tin thời gian, test bằng API
-                            break
-            except:
-                # Lỗi đọc file, test bằng API
-                pass
-            
-            # Test bằng cách gọi API session để kiểm tra token
-            from main import browser_sim
-            url = "https://labs.google/fx/api/auth/session"
-            headers = browser_sim.get_api_headers(access_token=access_token)
-            
-            # Chỉ test với timeout ngắn
-            response = browser_sim.make_request("GET", url, headers=headers, timeout=10)
-            
-            if response and response.status_code == 200:
-                return True
-            elif response and response.status_code == 401:
-                return False
-            else:
-                # Nếu không phải 401, có thể là lỗi khác, coi như token hợp lệ
-                return True
-                
-        except Exception as e:
-            # Nếu có lỗi, coi như token không hợp lệ
-            return False
+        self.force_regenerate = force_regenerate
+        self.account_name = account_name
     
     def run(self):
         try:
-            import pandas as pd
-            from concurrent.futures import ThreadPoolExecutor, as_completed
-            
-            # Kiểm tra và lấy access token hợp lệ
-            self.progress.emit("Đang xác thực tài khoản...")
-            
-            if self.saved_access_token:
-                # Thử sử dụng access token đã lưu trước
-                self.progress.emit("Kiểm tra access token đã lưu...")
-                
-                # Test token bằng cách gọi API đơn giản
-                test_result = self.test_access_token(self.saved_access_token)
-                
-                if test_result:
-                    access_token = self.saved_access_token
-                    self.progress.emit("✅ Token đã lưu vẫn hợp lệ")
-                else:
-                    self.progress.emit("⚠️ Token đã lưu đã hết hạn, đang lấy token mới...")
-                    access_data = get_access_token(self.cookie)
-                    
-                    if not access_data or not access_data.get('access_token'):
-                        self.finished.emit(False, "Không thể xác thực tài khoản - Cookie có thể đã hết hạn. Vui lòng cập nhật cookie mới.")
-                        return
-                    
-                    access_token = access_data.get('access_token')
-                    self.progress.emit("✅ Đã lấy token mới thành công")
-            else:
-                # Lấy access token mới
-                access_data = get_access_token(self.cookie)
-                
-                if not access_data or not access_data.get('access_token'):
-                    self.finished.emit(False, "Không thể xác thực tài khoản - Cookie có thể đã hết hạn. Vui lòng cập nhật cookie mới.")
-                    return
-                
-                access_token = access_data.get('access_token')
-                self.progress.emit("✅ Xác thực thành công")
-            
-            # Sử dụng thư mục output đã được truyền vào
-            if not self.output_folder:
-                self.finished.emit(False, "Không có thư mục lưu ảnh được chỉ định")
-                return
-            
-            if not os.path.exists(self.output_folder):
-                os.makedirs(self.output_folder)
-            
-            # Đọc dữ liệu Excel
-            self.progress.emit("Đang đọc file Excel...")
-            
-            if "Excel" in self.mode:
-                # Excel: STT, PROMPT, SUBJECT, SUBJECT_CAPTION, SCENE, SCENE_CAPTION, STYLE, STYLE_CAPTION
-                df = pd.read_excel(self.excel_path)
-                if len(df.columns) < 2:
-                    self.finished.emit(False, "File Excel cần có ít nhất 2 cột: STT, PROMPT")
-                    return
-                
-                stt_list = df.iloc[:, 0].tolist()
-                prompt_list = df.iloc[:, 1].tolist()
-                
-                # Lấy các cột ảnh và caption (có thể để trống)
-                subject_list = df.iloc[:, 2].fillna("").tolist() if len(df.columns) > 2 else [""] * len(stt_list)
-                subject_caption_list = df.iloc[:, 3].fillna("").tolist() if len(df.columns) > 3 else [""] * len(stt_list)
-                scene_list = df.iloc[:, 4].fillna("").tolist() if len(df.columns) > 4 else [""] * len(stt_list)
-                scene_caption_list = df.iloc[:, 5].fillna("").tolist() if len(df.columns) > 5 else [""] * len(stt_list)
-                style_list = df.iloc[:, 6].fillna("").tolist() if len(df.columns) > 6 else [""] * len(stt_list)
-                style_caption_list = df.iloc[:, 7].fillna("").tolist() if len(df.columns) > 7 else [""] * len(stt_list)
-                
-                # Tự động detect mode và validate dữ liệu
-                valid_data = []
-                prompt_to_image_count = 0
-                image_to_image_count = 0
-                
-                for i, (stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption) in enumerate(zip(
-                    stt_list, prompt_list, subject_list, subject_caption_list, 
-                    scene_list, scene_caption_list, style_list, style_caption_list)):
-                    
-                    # Kiểm tra prompt có hợp lệ không
-                    if not str(prompt).strip() or str(prompt).strip().lower() == 'nan':
-                        continue
-                    
-                    # Kiểm tra có ảnh nào không
-                    has_images = (
-                        str(subject).strip() and str(subject).strip().lower() != 'nan' or
-                        str(scene).strip() and str(scene).strip().lower() != 'nan' or
-                        str(style).strip() and str(style).strip().lower() != 'nan'
-                    )
-                    
-                    if has_images:
-                        # Image to Image: cần ít nhất 1 ảnh
-                        image_to_image_count += 1
-                        valid_data.append((stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, "Image to Image"))
-                    else:
-                        # Prompt to Image: chỉ cần prompt
-                        prompt_to_image_count += 1
-                        valid_data.append((stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, "Prompt to Image"))
-                
-                # Thống kê
-                total_valid = len(valid_data)
-                self.progress.emit(f"📊 Validation: {total_valid} dòng hợp lệ ({prompt_to_image_count} Prompt to Image, {image_to_image_count} Image to Image)")
-                
-                excel_data = valid_data
-            
-            if not excel_data:
-                self.finished.emit(False, "Không có dữ liệu trong file Excel")
+            access_token = resolve_access_token(self.cookie, self.saved_access_token, self.report)
+            if not access_token:
+                self.finished.emit(False, AUTH_FAILED_MESSAGE)
                 return
             
-            self.progress.emit(f"✅ Đã đọc {len(excel_data)} dòng dữ liệu từ Excel")
-            self.progress.emit(f"Bắt đầu tạo ảnh với {self.thread_count} luồng...")
-            
-            # Tạo danh sách tasks
-            tasks = []
-            for i, data in enumerate(excel_data):
-                stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, mode = data
-                if mode == "Image to Image":
-                    task_data = (stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, 
-                               access_token, self.cookie, self.output_folder, self.seed + i, self.aspect_ratio, "img2img")
-                else:
-                    task_data = (stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, 
-                               access_token, self.output_folder, self.seed + i, self.aspect_ratio, "prompt")
-                tasks.append(task_data)
-            
-            success_count = 0
-            
-            # Sử dụng ThreadPoolExecutor để xử lý multi-threading
-            with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
-                # Submit tất cả tasks theo mode riêng
-                future_to_task = {}
-                for task in tasks:
-                    # Lấy mode từ task data (phần tử cuối cùng)
-                    task_mode = task[-1]
-                    if task_mode == "img2img":
-                        future_to_task[executor.submit(self.process_single_img2img_task, task)] = task
-                    else:
-                        future_to_task[executor.submit(self.process_single_image_task, task)] = task
-                
-                # Xử lý kết quả khi hoàn thành
-                for future in as_completed(future_to_task):
-                    task = future_to_task[future]
-                    stt = task[0]
-                    
-                    try:
-                        result = future.result()
-                        if result:
-                            self.progress.emit(f"✅ Hoàn thành STT {stt}")
-                            success_count += 1
-                        else:
-                            self.progress.emit(f"❌ Lỗi STT {stt} - Có thể do access token hết hạn")
-                            # Nếu có nhiều lỗi liên tiếp, có thể do token hết hạn
-                            if success_count == 0 and len(future_to_task) > 1:
-                                self.progress.emit("💡 Hướng dẫn: Vào tab 'Quản lý Tài khoản' -> Chọn tài khoản -> Click 'Checker' để kiểm tra")
-                                self.progress.emit("💡 Nếu vẫn lỗi, hãy thêm cookie mới từ Google Labs")
-                    except Exception as e:
-                        self.progress.emit(f"❌ Exception STT {stt}: {str(e)}")
-                        if "401" in str(e) or "authentication" in str(e).lower():
-                            self.progress.emit("💡 Lỗi xác thực - Vui lòng cập nhật cookie mới")
-            
-            if success_count > 0:
-                self.finished.emit(True, f"Tạo thành công {success_count}/{len(excel_data)} ảnh trong thư mục '{self.output_folder}'")
-            else:
-                self.finished.emit(False, "Không tạo được ảnh nào - Có thể do:\n• Access token hết hạn (401)\n• Quá nhiều request - Rate limit (429)\n• Tài nguyên đã cạn kiệt - Quota hết\n\n💡 Hướng dẫn khắc phục:\n1. Vào tab 'Quản lý Tài khoản' -> Chọn tài khoản -> Click 'Checker'\n2. Nếu vẫn lỗi, thêm cookie mới từ Google Labs\n3. Giảm số luồng xuống 1-2 để tránh rate limit\n4. Chờ 5-10 phút rồi thử lại")
+            runner = ExcelBatchRunner(self.cookie, access_token, self.excel_path, self.output_folder,
+                                      self.seed, self.thread_count, self.aspect_ratio, progress=self.report,
+                                      on_task_event=self.run_stats.handle, result_cache=result_cache,
+                                      force_regenerate=self.force_regenerate, catalog=output_catalog,
+                                      account=self.account_name)
+            outcome = runner.run()
+            self.finished.emit(outcome.success, outcome.message)
                 
         except Exception as e:
             self.finished.emit(False, f"Lỗi: {str(e)}")
-    
-    def process_single_image_task(self, task_data):
-        """Xử lý một task tạo ảnh trong thread"""
-        try:
-            # Kiểm tra mode để unpack đúng số lượng phần tử
-            task_mode = task_data[-1]  # Lấy mode từ phần tử cuối
-            
-            if task_mode == "img2img":
-                stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, access_token, cookie, output_folder, seed, aspect_ratio, task_mode = task_data
-            else:
-                stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, access_token, output_folder, seed, aspect_ratio, task_mode = task_data
-            
-            # Gọi API tạo ảnh (chỉ dùng prompt)
-            result = generate_image(access_token, prompt, seed, aspect_ratio, output_folder=output_folder)
-            
-            if result and 'imagePanels' in result:
-                for panel in result['imagePanels']:
-                    if 'generatedImages' in panel:
-                        for img in panel['generatedImages']:
-                            if 'encodedImage' in img:
-                                filename = sanitize_filename(stt, prompt)
-                                self.progress.emit(f"💾 Đang lưu ảnh: {filename}")
-                                print(f"💾 Đang lưu ảnh: {filename}")
-                                if save_base64_image(img['encodedImage'], filename, output_folder):
-                                    self.progress.emit(f"✅ Đã lưu thành công: {filename}")
-                                    print(f"✅ Đã lưu thành công: {filename}")
-                                    return True
-                                else:
-                                    self.progress.emit(f"❌ Lỗi khi lưu: {filename}")
-                                    print(f"❌ Lỗi khi lưu: {filename}")
-                                    return False
-            elif result is None:
-                # API trả về None - có thể do lỗi 401, 429, hoặc lỗi khác
-                self.progress.emit(f"❌ Lỗi STT {stt} - API không phản hồi")
-                self.progress.emit("💡 Có thể do: Access token hết hạn (401), Rate limit (429), hoặc Quota hết")
-                return False
-            return False
-            
-        except Exception as e:
-            # Log lỗi chi tiết để debug
-            import traceback
-            self.progress.emit(f"❌ Exception trong process_single_image_task: {str(e)}")
-            print(f"❌ Exception trong process_single_image_task: {str(e)}")
-            self.progress.emit(f"❌ Traceback: {traceback.format_exc()}")
-            print(f"❌ Traceback: {traceback.format_exc()}")
-            return False
-    
-    def process_single_img2img_task(self, task_data):
-        """Xử lý một task tạo ảnh từ nhiều ảnh trong thread"""
-        stt, prompt, subject, subject_caption, scene, scene_caption, style, style_caption, access_token, cookie, output_folder, seed, aspect_ratio, task_mode = task_data
-        
-        try:
-            # Upload các ảnh đã chọn
-            upload_data_list = []
-            
-            if subject and str(subject).strip() and str(subject).strip().lower() != 'nan':
-                upload_data = upload_image_to_google_labs(cookie, str(subject).strip())
-                if upload_data:
-                    upload_data_list.append({
-                        'caption': str(subject_caption).strip() or 'Subject',
-                        'mediaCategory': 'MEDIA_CATEGORY_SUBJECT',
-                        'uploadMediaGenerationId': upload_data['uploadMediaGenerationId'],
-                        'workflowId': upload_data['workflowId'],
-                        'sessionId': upload_data['sessionId']
-                    })
-            
-            if scene and str(scene).strip() and str(scene).strip().lower() != 'nan':
-                upload_data = upload_image_to_google_labs(cookie, str(scene).strip())
-                if upload_data:
-                    upload_data_list.append({
-                        'caption': str(scene_caption).strip() or 'Scene',
-                        'mediaCategory': 'MEDIA_CATEGORY_SCENE',
-                        'uploadMediaGenerationId': upload_data['uploadMediaGenerationId'],
-                        'workflowId': upload_data['workflowId'],
-                        'sessionId': upload_data['sessionId']
-                    })
-            
-            if style and str(style).strip() and str(style).strip().lower() != 'nan':
-                upload_data = upload_image_to_google_labs(cookie, str(style).strip())
-                if upload_data:
-                    upload_data_list.append({
-                        'caption': str(style_caption).strip() or 'Style',
-                        'mediaCategory': 'MEDIA_CATEGORY_STYLE',
-                        'uploadMediaGenerationId': upload_data['uploadMediaGenerationId'],
-                        'workflowId': upload_data['workflowId'],
-                        'sessionId': upload_data['sessionId']
-                    })
-            
-            if upload_data_list:
-                result = generate_image_from_multiple_images(access_token, upload_data_list, prompt, seed, "IMAGEN_3_5", aspect_ratio, output_folder)
-                
-                if result and 'imagePanels' in result:
-                    for panel in result['imagePanels']:
-                        if 'generatedImages' in panel:
-                            for img in panel['generatedImages']:
-                                if 'encodedImage' in img:
-                                    filename = sanitize_filename(stt, prompt)
-                                    self.progress.emit(f"💾 Đang lưu ảnh img2img: {filename}")
-                                    if save_base64_image(img['encodedImage'], filename, output_folder):
-                                        self.progress.emit(f"✅ Đã lưu thành công img2img: {filename}")
-                                        return True
-                                    else:
-                                        self.progress.emit(f"❌ Lỗi khi lưu img2img: {filename}")
-                                        return False
-                elif result is None:
-                    # API trả về None - có thể do lỗi 401, 429, hoặc lỗi khác
-                    self.progress.emit(f"❌ Lỗi STT {stt} - API không phản hồi (img2img)")
-                    self.progress.emit("💡 Có thể do: Access token hết hạn (401), Rate limit (429), hoặc Quota hết")
-                    return False
-            return False
-            
-        except Exception as e:
-            return False
 
-class ImageGenerationThread(QThread):
-    """Thread để tạo ảnh"""
-    progress = pyqtSignal(str)
+class ImageGenerationThread(WorkerThread):
+    """Thread để tạo ảnh (chạy SinglePromptRunner của batch_engine)"""
     finished = pyqtSignal(bool, str)
     
-    def __init__(self, cookie, saved_access_token, prompt, mode, subject_path, scene_path, style_path, subject_caption, scene_caption, style_caption, seed, count, aspect_ratio, output_folder=None):
+    def __init__(self, cookie, saved_access_token, prompt, mode, subject_path, scene_path, style_path, subject_caption, scene_caption, style_caption, seed, count, aspect_ratio, output_folder=None,
+                 force_regenerate=False, account_name=None, thread_count=1):
         super().__init__()
         self.cookie = cookie
         self.saved_access_token = saved_access_token
@@ -1636,209 +1605,29 @@ class ImageGenerationThread(QThread):
         self.style_caption = style_caption
         self.seed = seed
         self.count = count
+        self.thread_count = thread_count
         self.aspect_ratio = aspect_ratio
         self.output_folder = output_folder
-    
-    def test_access_token(self, access_token):
-        """Test xem access token có còn hợp lệ không"""
-        try:
-            # Kiểm tra thời gian hết hạn trước (nếu có thông tin)
-            # Đọc thông tin từ cookies.json để lấy expires_at
-            try:
-                with open('cookies.json', 'r', encoding='utf-8') as f:
-                    cookies_data = json.load(f)
-                
-                # Tìm tài khoản có access_token này
-                for account_name, data in cookies_data.items():
-                    saved_token = data.get('user_info', {}).get('access_token')
-                    if saved_token == access_token:
-                        expires_at = data.get('user_info', {}).get('expires_at')
-                        if expires_at and expires_at != 'Unknown':
-                            try:
-                                from datetime import datetime
-                                expiry_time = datetime.strptime(expires_at, "%Y-%m-%d %H:%M:%S")
-                                current_time = datetime.now()
-                                
-                                if current_time > expiry_time:
-                                    # Token đã hết hạn theo thời gian
-                                    return False
-                                else:
-                                    # Token còn hợp lệ theo thời gian, test bằng API
-                                    break
-                            except:
-                                # Lỗi parse thời gian, test bằng API
-                                break
-                        else:
-                            # Không có thông tin thời gian, test bằng API
-                            break
-            except:
-                # Lỗi đọc file, test bằng API
-                pass
-            
-            # Test bằng cách gọi API session để kiểm tra token
-            from main import browser_sim
-            url = "https://labs.google/fx/api/auth/session"
-            headers = browser_sim.get_api_headers(access_token=access_token)
-            
-            # Chỉ test với timeout ngắn
-            response = browser_sim.make_request("GET", url, headers=headers, timeout=10)
-            
-            if response and response.status_code == 200:
-                return True
-            elif response and response.status_code == 401:
-                return False
-            else:
-                # Nếu không phải 401, có thể là lỗi khác, coi như token hợp lệ
-                return True
-                
-        except Exception as e:
-            # Nếu có lỗi, coi như token không hợp lệ
-            return False
+        self.force_regenerate = force_regenerate
+        self.account_name = account_name
     
     def run(self):
         try:
-            # Kiểm tra và lấy access token hợp lệ
-            self.progress.emit("Đang xác thực tài khoản...")
-            
-            if self.saved_access_token:
-                # Thử sử dụng access token đã lưu trước
-                self.progress.emit("Kiểm tra access token đã lưu...")
-                
-                # Test token bằng cách gọi API đơn giản
-                test_result = self.test_access_token(self.saved_access_token)
-                
-                if test_result:
-                    access_token = self.saved_access_token
-                    self.progress.emit("✅ Token đã lưu vẫn hợp lệ")
-                else:
-                    self.progress.emit("⚠️ Token đã lưu đã hết hạn, đang lấy token mới...")
-                    access_data = get_access_token(self.cookie)
-                    
-                    if not access_data or not access_data.get('access_token'):
-                        self.finished.emit(False, "Không thể xác thực tài khoản - Cookie có thể đã hết hạn. Vui lòng cập nhật cookie mới.")
-                        return
-                    
-                    access_token = access_data.get('access_token')
-                    self.progress.emit("✅ Đã lấy token mới thành công")
-            else:
-                # Lấy access token mới
-                access_data = get_access_token(self.cookie)
-                
-                if not access_data or not access_data.get('access_token'):
-                    self.finished.emit(False, "Không thể xác thực tài khoản - Cookie có thể đã hết hạn. Vui lòng cập nhật cookie mới.")
-                    return
-                
-                access_token = access_data.get('access_token')
-                self.progress.emit("✅ Xác thực thành công")
-            
-            # Sử dụng thư mục output đã được truyền vào
-            if not self.output_folder:
-                self.finished.emit(False, "Không có thư mục lưu ảnh được chỉ định")
+            access_token = resolve_access_token(self.cookie, self.saved_access_token, self.report)
+            if not access_token:
+                self.finished.emit(False, AUTH_FAILED_MESSAGE)
                 return
             
-            if not os.path.exists(self.output_folder):
-                os.makedirs(self.output_folder)
-            
-            success_count = 0
-            
-            for i in range(self.count):
-                self.progress.emit(f"Đang tạo ảnh {i+1}/{self.count}...")
-                
-                if self.mode == "Prompt to Image":
-                    # Prompt to Image
-                    result = generate_image(access_token, self.prompt, self.seed + i, self.aspect_ratio, output_folder=self.output_folder)
-                    
-                    if result and 'imagePanels' in result:
-                        for panel in result['imagePanels']:
-                            if 'generatedImages' in panel:
-                                for img in panel['generatedImages']:
-                                    if 'encodedImage' in img:
-                                        filename = sanitize_filename(i+1, self.prompt)
-                                        if save_base64_image(img['encodedImage'], filename, self.output_folder):
-                                            self.progress.emit(f"✅ Đã lưu: {filename}")
-                                            success_count += 1
-                                        else:
-                                            self.progress.emit(f"❌ Lỗi khi lưu: {filename}")
-                    elif result is None:
-                        # Nếu result là None, có thể do lỗi 401 (token hết hạn) hoặc 429 (rate limit)
-                        self.progress.emit("❌ Lỗi khi tạo ảnh - Có thể do:")
-                        self.progress.emit("  • Access token hết hạn (401)")
-                        self.progress.emit("  • Quá nhiều request - Rate limit (429)")
-                        self.progress.emit("  • Tài nguyên đã cạn kiệt - Quota hết")
-                        self.progress.emit("💡 Hướng dẫn khắc phục:")
-                        self.progress.emit("  1. Vào tab 'Quản lý Tài khoản' -> Chọn tài khoản -> Click 'Checker'")
-                        self.progress.emit("  2. Nếu vẫn lỗi, thêm cookie mới từ Google Labs")
-                        self.progress.emit("  3. Giảm số luồng xuống 1-2 để tránh rate limit")
-                        self.progress.emit("  4. Chờ 5-10 phút rồi thử lại")
-                        break  # Dừng vòng lặp để tránh spam lỗi
-                
-                elif self.mode == "Image to Image":
-                    # Image to Image với 3 loại ảnh
-                    self.progress.emit("Đang upload ảnh...")
-                    
-                    # Upload các ảnh đã chọn
-                    upload_data_list = []
-                    
-                    if self.subject_path:
-                        self.progress.emit("Uploading Subject image...")
-                        subject_data = upload_image_to_google_labs(self.cookie, self.subject_path)
-                        if subject_data:
-                            upload_data_list.append({
-                                'caption': self.subject_caption or 'Subject',
-                                'mediaCategory': 'MEDIA_CATEGORY_SUBJECT',
-                                'uploadMediaGenerationId': subject_data['uploadMediaGenerationId'],
-                                'workflowId': subject_data['workflowId'],
-                                'sessionId': subject_data['sessionId']
-                            })
-                    
-                    if self.scene_path:
-                        self.progress.emit("Uploading Scene image...")
-                        scene_data = upload_image_to_google_labs(self.cookie, self.scene_path)
-                        if scene_data:
-                            upload_data_list.append({
-                                'caption': self.scene_caption or 'Scene',
-                                'mediaCategory': 'MEDIA_CATEGORY_SCENE',
-                                'uploadMediaGenerationId': scene_data['uploadMediaGenerationId'],
-                                'workflowId': scene_data['workflowId'],
-                                'sessionId': scene_data['sessionId']
-                            })
-                    
-                    if self.style_path:
-                        self.progress.emit("Uploading Style image...")
-                        style_data = upload_image_to_google_labs(self.cookie, self.style_path)
-                        if style_data:
-                            upload_data_list.append({
-                                'caption': self.style_caption or 'Style',
-                                'mediaCategory': 'MEDIA_CATEGORY_STYLE',
-                                'uploadMediaGenerationId': style_data['uploadMediaGenerationId'],
-                                'workflowId': style_data['workflowId'],
-                                'sessionId': style_data['sessionId']
-                            })
-                    
-                    if upload_data_list:
-                        self.progress.emit("✅ Upload thành công")
-                        result = generate_image_from_multiple_images(access_token, upload_data_list, self.prompt, self.seed + i, "IMAGEN_3_5", self.aspect_ratio, self.output_folder)
-                        
-                        if result and 'imagePanels' in result:
-                            for panel in result['imagePanels']:
-                                if 'generatedImages' in panel:
-                                    for img in panel['generatedImages']:
-                                        if 'encodedImage' in img:
-                                            filename = sanitize_filename(i+1, self.prompt)
-                                            if save_base64_image(img['encodedImage'], filename, self.output_folder):
-                                                self.progress.emit(f"✅ Đã lưu: {filename}")
-                                                success_count += 1
-                                            else:
-                                                self.progress.emit(f"❌ Lỗi khi lưu: {filename}")
-                        else:
-                            self.progress.emit("❌ Lỗi khi tạo ảnh")
-                    else:
-                        self.progress.emit("❌ Không có ảnh nào được upload thành công")
-            
-            if success_count > 0:
-                self.finished.emit(True, f"Tạo thành công {success_count} ảnh trong thư mục '{self.output_folder}'")
-            else:
-                self.finished.emit(False, "Không tạo được ảnh nào - Có thể do:\n• Access token hết hạn (401)\n• Quá nhiều request - Rate limit (429)\n• Tài nguyên đã cạn kiệt - Quota hết\n\n💡 Hướng dẫn khắc phục:\n1. Vào tab 'Quản lý Tài khoản' -> Chọn tài khoản -> Click 'Checker'\n2. Nếu vẫn lỗi, thêm cookie mới từ Google Labs\n3. Giảm số luồng xuống 1-2 để tránh rate limit\n4. Chờ 5-10 phút rồi thử lại")
+            runner = SinglePromptRunner(self.cookie, access_token, self.prompt, self.mode,
+                                        self.subject_path, self.scene_path, self.style_path,
+                                        self.subject_caption, self.scene_caption, self.style_caption,
+                                        self.seed, self.count, self.aspect_ratio, self.output_folder,
+                                        progress=self.report, on_task_event=self.run_stats.handle,
+                                        result_cache=result_cache, force_regenerate=self.force_regenerate,
+                                        catalog=output_catalog, account=self.account_name,
+                                        thread_count=self.thread_count)
+            outcome = runner.run()
+            self.finished.emit(outcome.success, outcome.message)
                 
         except Exception as e:
             self.finished.emit(False, f"Lỗi: {str(e)}")
@@ -1854,7 +1643,10 @@ class SyncTab(QWidget):
         self.output_folder_path = None
         self.media_generation_id = None
         self.raw_bytes = None
-        self.failed_tasks = []  # Danh sách các task thất bại
+        self.failed_tasks = []  # Các entry lỗi/dở dang đọc từ journal
+        # Đọc lại preview khi file Excel đang chọn bị sửa
+        self.excel_watcher = ExcelFileWatcher(self)
+        self.excel_watcher.sheet_changed.connect(self.on_excel_file_changed)
         self.init_ui()
     
     def init_ui(self):
@@ -1985,43 +1777,12 @@ class SyncTab(QWidget):
         self.excel_preview_label.setWordWrap(True)
         excel_layout.addWidget(self.excel_preview_label)
         
-        # Excel data table
-        self.excel_table = QTableWidget()
-        self.excel_table.setColumnCount(2)
-        self.excel_table.setHorizontalHeaderLabels(["STT", "PROMPT"])
-        self.excel_table.setStyleSheet("""
-            QTableWidget {
-                background-color: white;
-                border-radius: 3px;
-                gridline-color: #f0f0f0;
-                font-family: "Open Sans";
-                border: none;
-            }
-            QHeaderView::section {
-                background-color: #f8f9fa;
-                padding: 8px;
-                border: none;
-                border-right: 1px solid #f0f0f0;
-                border-bottom: 1px solid #e0e0e0;
-                font-weight: bold;
-                font-size: 12px;
-                font-family: "Open Sans";
-                color: #333;
-            }
-            QHeaderView::section:first {
-                border-left: none;
-            }
-            QHeaderView::section:last {
-                border-right: none;
-            }
-        """)
-        self.excel_table.setAlternatingRowColors(True)
-        self.excel_table.horizontalHeader().setStretchLastSection(True)
-        self.excel_table.verticalHeader().setDefaultSectionSize(35)
-        
-        # Căn giữa header
-        header = self.excel_table.horizontalHeader()
-        header.setDefaultAlignment(Qt.AlignCenter)
+        # Excel data table (model/view: chỉ vẽ các dòng đang hiển thị)
+        self.excel_model = SheetTableModel((0, 1), self)
+        self.excel_model.rows_loading.connect(self.on_sheet_rows_loading)
+        self.excel_model.loaded.connect(self.on_sheet_loaded)
+        self.excel_model.failed.connect(self.on_sheet_load_failed)
+        self.excel_table = create_sheet_table(self.excel_model)
         
         excel_layout.addWidget(self.excel_table)
         
@@ -2176,11 +1937,15 @@ class SyncTab(QWidget):
         right_panel = QWidget()
         right_layout = QVBoxLayout()
         
+        # Dashboard tiến độ (ảnh/phút, ETA, độ trễ...) của lượt chạy hiện tại
+        self.dashboard = RunDashboard(self.progress_bar)
+        right_layout.addWidget(self.dashboard)
+        
         log_label = QLabel("Nhật ký")
         log_label.setStyleSheet("font-weight: bold;")
         right_layout.addWidget(log_label)
         
-        self.log_text = QTextBrowser()
+        self.log_text = LogConsole()
         self.log_text.setStyleSheet("""
             QTextBrowser {
                 background-color: #1e1e1e;
@@ -2242,7 +2007,7 @@ class SyncTab(QWidget):
                         display_text = f"{account_name} ({email})"
                         self.account_combo.addItem(display_text, account_name)
         except Exception as e:
-            self.log_message(f"Lỗi khi load tài khoản: {str(e)}")
+            self.log_message(f"Lỗi khi load tài khoản: {str(e)}", LOG_ERROR)
     
     def select_image(self):
         """Chọn ảnh gốc"""
@@ -2322,54 +2087,44 @@ class SyncTab(QWidget):
     def select_excel_file(self):
         """Chọn file Excel"""
         file_path, _ = QFileDialog.getOpenFileName(
-            self, "Chọn file Excel", "", "Excel Files (*.xlsx *.xls)")
+            self, "Chọn file Excel", "", SHEET_FILE_FILTER)
         
         if file_path:
             self.selected_excel_path = file_path
             self.excel_path_label.setText(os.path.basename(file_path))
             self.excel_path_label.setStyleSheet("color: black;")
+            self.excel_watcher.watch(file_path)
             
             # Preview Excel data
             self.preview_excel_data(file_path)
+            self.refresh_failed_tasks()
+    
+    def on_excel_file_changed(self, file_path):
+        """File Excel đang chọn đã được sửa: parse lại và cập nhật preview"""
+        if file_path != self.selected_excel_path:
+            return
+        self.log_message(f"🔄 File {os.path.basename(file_path)} đã thay đổi - đã đọc lại dữ liệu", LOG_STATUS)
+        self.preview_excel_data(file_path)
     
     def preview_excel_data(self, file_path):
-        """Preview dữ liệu Excel"""
-        try:
-            import pandas as pd
-            
-            df = pd.read_excel(file_path)
-            
-            if len(df.columns) >= 2:
-                stt_list = df.iloc[:, 0].tolist()
-                prompt_list = df.iloc[:, 1].tolist()
-                
-                preview_text = f"📊 Đã đọc {len(stt_list)} dòng dữ liệu"
-                self.excel_preview_label.setText(preview_text)
-                
-                # Hiển thị trong table (2 cột: STT, PROMPT)
-                self.excel_table.setColumnCount(2)
-                self.excel_table.setHorizontalHeaderLabels(["STT", "PROMPT"])
-                self.excel_table.setRowCount(len(stt_list))
-                
-                for i, (stt, prompt) in enumerate(zip(stt_list, prompt_list)):
-                    # STT
-                    stt_item = QTableWidgetItem(str(stt))
-                    stt_item.setTextAlignment(Qt.AlignCenter)
-                    self.excel_table.setItem(i, 0, stt_item)
-                    
-                    # Prompt
-                    prompt_item = QTableWidgetItem(str(prompt))
-                    self.excel_table.setItem(i, 1, prompt_item)
-            else:
-                preview_text = "❌ File Excel cần có ít nhất 2 cột: STT, PROMPT"
-                self.excel_preview_label.setText(preview_text)
-                self.excel_preview_label.setStyleSheet("color: red; font-size: 12px;")
-                self.excel_table.setRowCount(0)
-            
-        except Exception as e:
-            self.excel_preview_label.setText(f"❌ Lỗi khi đọc file Excel: {str(e)}")
-            self.excel_preview_label.setStyleSheet("color: red; font-size: 12px;")
-            self.excel_table.setRowCount(0)
+        """Preview dữ liệu Excel (parse trong thread riêng, bảng hiện dần theo từng đợt dòng)"""
+        # Parse một lần, dùng lại khi nhấn Đồng bộ nếu file chưa đổi
+        self.excel_preview_label.setText("⏳ Đang đọc dữ liệu...")
+        self.excel_preview_label.setStyleSheet("color: blue; font-size: 12px;")
+        self.excel_model.load(file_path)
+    
+    def on_sheet_rows_loading(self, count):
+        self.excel_preview_label.setText(f"⏳ Đang đọc dữ liệu... {count} dòng")
+    
+    def on_sheet_loaded(self, sheet):
+        self.excel_preview_label.setText(f"📊 Đã đọc {sheet.stats['rows']} dòng dữ liệu")
+    
+    def on_sheet_load_failed(self, message, missing_columns):
+        if missing_columns:
+            self.excel_preview_label.setText("❌ File Excel cần có ít nhất 2 cột: STT, PROMPT")
+        else:
+            self.excel_preview_label.setText(f"❌ Lỗi khi đọc file Excel: {message}")
+        self.excel_preview_label.setStyleSheet("color: red; font-size: 12px;")
     
     def select_output_folder(self):
         """Chọn thư mục lưu ảnh"""
@@ -2391,35 +2146,24 @@ class SyncTab(QWidget):
             self.output_folder_label.setText(display_path)
             self.output_folder_label.setStyleSheet("color: #2E7D32; font-weight: bold;")
             self.log_message(f"📁 Đã chọn thư mục lưu ảnh: {folder_path}")
+            self.refresh_failed_tasks()
     
-    def log_message(self, message):
-        """Thêm message vào log với màu sắc"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        
-        # Xác định màu sắc dựa trên nội dung message
-        if "✅" in message or "thành công" in message.lower():
-            color = "#4CAF50"  # Xanh lá
-        elif "❌" in message or "lỗi" in message.lower() or "error" in message.lower():
-            color = "#F44336"  # Đỏ
-        elif "⚠️" in message or "cảnh báo" in message.lower() or "warning" in message.lower():
-            color = "#FF9800"  # Cam
-        elif "🔧" in message or "hướng dẫn" in message.lower():
-            color = "#2196F3"  # Xanh dương
-        elif "📊" in message or "thống kê" in message.lower():
-            color = "#9C27B0"  # Tím
-        elif "🔄" in message or "đang" in message.lower():
-            color = "#00BCD4"  # Cyan
-        else:
-            color = "#FFFFFF"  # Trắng mặc định
-        
-        # Tạo HTML với màu sắc
-        html_message = f'<span style="color: {color};">[{timestamp}] {message}</span>'
-        self.log_text.append(html_message)
+    def refresh_failed_tasks(self):
+        """Đọc các task lỗi/dở dang từ journal của (file Excel, thư mục output) hiện tại"""
+        self.failed_tasks = []
+        if self.selected_excel_path and self.output_folder_path:
+            try:
+                self.failed_tasks = unfinished_sync_entries(self.selected_excel_path, self.output_folder_path)
+            except Exception as e:
+                self.log_message(f"⚠️ Không đọc được journal: {str(e)}", LOG_WARNING)
         
-        # Scroll xuống cuối
-        self.log_text.verticalScrollBar().setValue(
-            self.log_text.verticalScrollBar().maximum()
-        )
+        self.retry_btn.setEnabled(bool(self.failed_tasks))
+        if self.failed_tasks:
+            self.log_message(f"🔄 Có {len(self.failed_tasks)} ảnh thất bại/dở dang có thể retry", LOG_STATUS)
+    
+    def log_message(self, message, level=LOG_INFO):
+        """Thêm message vào nhật ký (màu theo mức log, hiển thị theo lô)"""
+        self.log_text.append_message(message, level)
     
     def start_sync(self):
         """Bắt đầu đồng bộ"""
@@ -2466,28 +2210,22 @@ class SyncTab(QWidget):
         self.sync_thread = SyncThread(
             cookie, self.media_generation_id, self.raw_bytes, 
             self.selected_excel_path, self.seed_spinbox.value(), 
-            self.thread_spinbox.value(), self.output_folder_path
+            self.thread_spinbox.value(), self.output_folder_path, account_name
         )
         
         self.sync_thread.progress.connect(self.log_message)
         self.sync_thread.finished.connect(self.on_sync_finished)
+        self.dashboard.track(self.sync_thread.run_stats, expected_task_count(self.selected_excel_path))
         self.sync_thread.start()
     
     def on_sync_finished(self, success, message):
         """Xử lý khi hoàn thành đồng bộ"""
         self.sync_btn.setEnabled(True)
         self.progress_bar.setVisible(False)
+        self.dashboard.stop()
         
-        # Lưu failed_tasks từ sync_thread
-        if hasattr(self, 'sync_thread') and hasattr(self.sync_thread, 'failed_tasks'):
-            self.failed_tasks = self.sync_thread.failed_tasks.copy()
-            
-            # Kích hoạt nút retry nếu có task thất bại
-            if self.failed_tasks:
-                self.retry_btn.setEnabled(True)
-                self.log_message(f"🔄 Có {len(self.failed_tasks)} ảnh thất bại có thể retry")
-            else:
-                self.retry_btn.setEnabled(False)
+        # Đọc lại các task thất bại từ journal để kích hoạt nút retry
+        self.refresh_failed_tasks()
         
         if success:
             QMessageBox.information(self, "Thành công", message)
@@ -2527,29 +2265,29 @@ class SyncTab(QWidget):
         self.progress_bar.setVisible(True)
         self.progress_bar.setRange(0, 0)
         
+        # Tạo lại task từ journal với ảnh gốc và cookie hiện tại
+        retry_tasks = [(entry['stt'], entry['prompt'], cookie, self.media_generation_id,
+                        self.raw_bytes, entry['seed'], self.output_folder_path) for entry in self.failed_tasks]
+        
         # Tạo thread để retry
         self.retry_thread = RetryThread(
-            cookie, self.media_generation_id, self.raw_bytes, 
-            self.failed_tasks, self.thread_spinbox.value(), self.output_folder_path
+            cookie, self.media_generation_id, self.raw_bytes, self.selected_excel_path,
+            retry_tasks, self.thread_spinbox.value(), self.output_folder_path, account_name
         )
         
         self.retry_thread.progress.connect(self.log_message)
         self.retry_thread.finished.connect(self.on_retry_finished)
+        self.dashboard.track(self.retry_thread.run_stats, len(retry_tasks))
         self.retry_thread.start()
     
-    def on_retry_finished(self, success, message, new_failed_tasks):
+    def on_retry_finished(self, success, message):
         """Xử lý khi hoàn thành retry"""
         self.sync_btn.setEnabled(True)
         self.progress_bar.setVisible(False)
+        self.dashboard.stop()
         
-        # Cập nhật failed_tasks
-        self.failed_tasks = new_failed_tasks
-        
-        # Kích hoạt nút retry nếu vẫn còn task thất bại
-        if self.failed_tasks:
-            self.retry_btn.setEnabled(True)
-        else:
-            self.retry_btn.setEnabled(False)
+        # Kích hoạt nút retry nếu journal vẫn còn task thất bại
+        self.refresh_failed_tasks()
         
         if success:
             QMessageBox.information(self, "Thành công", message)
@@ -2577,6 +2315,7 @@ class SyncTab(QWidget):
             # Reset các biến
             self.selected_image_path = None
             self.selected_excel_path = None
+            self.excel_watcher.watch(None)
             self.output_folder_path = None
             self.media_generation_id = None
             self.raw_bytes = None
@@ -2590,7 +2329,7 @@ class SyncTab(QWidget):
             self.excel_path_label.setText("Chưa chọn file Excel")
             self.excel_path_label.setStyleSheet("color: gray; font-style: italic;")
             self.excel_preview_label.setText("")
-            self.excel_table.setRowCount(0)
+            self.excel_model.clear()
             
             self.output_folder_label.setText("Chưa chọn thư mục")
             self.output_folder_label.setStyleSheet("color: #666; font-style: italic;")
@@ -2610,98 +2349,12 @@ class SyncTab(QWidget):
             # Reload accounts
             self.load_accounts()
             
-            self.log_message("🔄 Đã reset toàn bộ tab đồng bộ")
+            self.log_message("🔄 Đã reset toàn bộ tab đồng bộ", LOG_STATUS)
             QMessageBox.information(self, "Thành công", "Đã reset tab đồng bộ về trạng thái ban đầu")
 
 
-def check_image_size(image_path, aspect_ratio="16:9"):
-    """
-    Kiểm tra kích thước ảnh có chuẩn không
-    Args:
-        image_path: Đường dẫn ảnh gốc
-        aspect_ratio: Tỷ lệ khung hình ("16:9", "9:16", "1:1")
-    Returns:
-        tuple: (is_correct_size, current_size, target_size)
-    """
-    # Định nghĩa kích thước chuẩn
-    size_mapping = {
-        "16:9": (1408, 768),
-        "9:16": (768, 1408), 
-        "1:1": (1024, 1024)
-    }
-    
-    if aspect_ratio not in size_mapping:
-        aspect_ratio = "16:9"  # Mặc định
-    
-    target_size = size_mapping[aspect_ratio]
-    
-    try:
-        # Mở ảnh gốc
-        with Image.open(image_path) as img:
-            current_size = img.size
-            is_correct = current_size == target_size
-            return is_correct, current_size, target_size
-            
-    except Exception as e:
-        print(f"Lỗi khi kiểm tra kích thước ảnh: {str(e)}")
-        return False, (0, 0), target_size
-
-
-def resize_image_to_standard_size(image_path, aspect_ratio="16:9"):
-    """
-    Resize ảnh theo kích thước chuẩn (chỉ khi cần thiết)
-    Args:
-        image_path: Đường dẫn ảnh gốc
-        aspect_ratio: Tỷ lệ khung hình ("16:9", "9:16", "1:1")
-    Returns:
-        str: Đường dẫn ảnh (gốc nếu đã đúng kích thước, hoặc đã resize)
-    """
-    # Định nghĩa kích thước chuẩn
-    size_mapping = {
-        "16:9": (1408, 768),
-        "9:16": (768, 1408), 
-        "1:1": (1024, 1024)
-    }
-    
-    if aspect_ratio not in size_mapping:
-        aspect_ratio = "16:9"  # Mặc định
-    
-    target_size = size_mapping[aspect_ratio]
-    
-    try:
-        # Kiểm tra kích thước hiện tại
-        is_correct, current_size, target_size = check_image_size(image_path, aspect_ratio)
-        
-        if is_correct:
-            return image_path  # Trả về đường dẫn gốc
-        
-        # Mở ảnh gốc
-        with Image.open(image_path) as img:
-            # Chuyển sang RGB nếu cần
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Resize ảnh với thuật toán LANCZOS để đảm bảo chất lượng
-            resized_img = img.resize(target_size, Image.Resampling.LANCZOS)
-            
-            # Tạo đường dẫn file mới
-            base_name = os.path.splitext(image_path)[0]
-            extension = os.path.splitext(image_path)[1]
-            resized_path = f"{base_name}_resized_{aspect_ratio.replace(':', 'x')}{extension}"
-            
-            # Lưu ảnh đã resize
-            resized_img.save(resized_path, 'JPEG', quality=95)
-            
-            return resized_path
-            
-    except Exception as e:
-        print(f"Lỗi khi resize ảnh: {str(e)}")
-        return image_path  # Trả về đường dẫn gốc nếu có lỗi
-
-
-class ImageUploadThread(QThread):
+class ImageUploadThread(WorkerThread):
     """Thread để upload ảnh"""
-    progress = pyqtSignal(str)
     finished = pyqtSignal(bool, str, str, str)  # success, message, media_generation_id, raw_bytes
     
     def __init__(self, cookie, image_path, aspect_ratio="16:9"):
@@ -2712,52 +2365,24 @@ class ImageUploadThread(QThread):
     
     def run(self):
         try:
-            self.progress.emit("🔍 Đang kiểm tra kích thước ảnh...")
-            
-            # Kiểm tra kích thước ảnh trước
-            is_correct, current_size, target_size = check_image_size(self.image_path, self.aspect_ratio)
-            
-            if is_correct:
-                self.progress.emit(f"✅ Ảnh đã đúng kích thước {self.aspect_ratio} ({current_size[0]}x{current_size[1]})")
-                resized_image_path = self.image_path  # Sử dụng ảnh gốc
-            else:
-                self.progress.emit(f"🔄 Ảnh cần resize từ {current_size[0]}x{current_size[1]} thành {target_size[0]}x{target_size[1]}")
-                self.progress.emit("Đang resize ảnh theo kích thước chuẩn...")
-                
-                # Resize ảnh theo kích thước chuẩn
-                resized_image_path = resize_image_to_standard_size(self.image_path, self.aspect_ratio)
-                self.progress.emit(f"✅ Đã resize ảnh thành {target_size[0]}x{target_size[1]}")
-            
-            self.progress.emit("Đang upload ảnh lên Google Labs...")
-            
-            # Upload ảnh đã resize
-            upload_data = upload_image_to_google_labs(self.cookie, resized_image_path)
-            
-            if upload_data:
-                self.progress.emit("✅ Upload ảnh thành công!")
-                
-                # Đọc ảnh đã resize và chuyển thành base64
-                import base64
-                with open(resized_image_path, 'rb') as image_file:
-                    image_data = base64.b64encode(image_file.read()).decode('utf-8')
-                    raw_bytes = f"data:image/jpeg;base64,{image_data}"
-                
-                self.finished.emit(True, "Upload ảnh thành công", upload_data['uploadMediaGenerationId'], raw_bytes)
+            source = prepare_sync_source(self.cookie, self.image_path, self.aspect_ratio, self.report)
+            if source:
+                media_generation_id, raw_bytes = source
+                self.finished.emit(True, "Upload ảnh thành công", media_generation_id, raw_bytes)
             else:
-                self.progress.emit("❌ Upload ảnh thất bại")
                 self.finished.emit(False, "Upload ảnh thất bại", "", "")
                 
         except Exception as e:
-            self.progress.emit(f"❌ Lỗi khi upload: {str(e)}")
+            self.report(f"❌ Lỗi khi upload: {str(e)}", LOG_ERROR)
             self.finished.emit(False, f"Lỗi khi upload: {str(e)}", "", "")
 
 
-class SyncThread(QThread):
-    """Thread để đồng bộ"""
-    progress = pyqtSignal(str)
+class SyncThread(WorkerThread):
+    """Thread để đồng bộ (chạy SyncBatchRunner của batch_engine)"""
     finished = pyqtSignal(bool, str)
     
-    def __init__(self, cookie, media_generation_id, raw_bytes, excel_path, seed, thread_count, output_folder):
+    def __init__(self, cookie, media_generation_id, raw_bytes, excel_path, seed, thread_count, output_folder,
+                 account_name=None):
         super().__init__()
         self.cookie = cookie
         self.media_generation_id = media_generation_id
@@ -2766,248 +2391,48 @@ class SyncThread(QThread):
         self.seed = seed
         self.thread_count = thread_count
         self.output_folder = output_folder
-        self.failed_tasks = []  # Danh sách các task thất bại
+        self.account_name = account_name
     
     def run(self):
         try:
-            import pandas as pd
-            from concurrent.futures import ThreadPoolExecutor, as_completed
-            
-            # Đọc dữ liệu Excel
-            self.progress.emit("Đang đọc file Excel...")
-            
-            df = pd.read_excel(self.excel_path)
-            if len(df.columns) < 2:
-                self.finished.emit(False, "File Excel cần có ít nhất 2 cột: STT, PROMPT")
-                return
-            
-            stt_list = df.iloc[:, 0].tolist()
-            prompt_list = df.iloc[:, 1].tolist()
-            
-            # Validate dữ liệu
-            valid_data = []
-            for i, (stt, prompt) in enumerate(zip(stt_list, prompt_list)):
-                if str(prompt).strip() and str(prompt).strip().lower() != 'nan':
-                    valid_data.append((stt, prompt))
-            
-            if not valid_data:
-                self.finished.emit(False, "Không có dữ liệu hợp lệ trong file Excel")
-                return
-            
-            self.progress.emit(f"✅ Đã đọc {len(valid_data)} dòng dữ liệu từ Excel")
-            self.progress.emit(f"Bắt đầu edit ảnh với {self.thread_count} luồng...")
-            
-            # Tạo danh sách tasks
-            tasks = []
-            for i, (stt, prompt) in enumerate(valid_data):
-                task_data = (stt, prompt, self.cookie, self.media_generation_id, 
-                           self.raw_bytes, self.seed + i, self.output_folder)
-                tasks.append(task_data)
-            
-            success_count = 0
-            error_count = 0
-            api_error_count = 0
-            save_error_count = 0
-            
-            # Sử dụng ThreadPoolExecutor để xử lý multi-threading
-            with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
-                future_to_task = {}
-                for task in tasks:
-                    future_to_task[executor.submit(self.process_single_sync_task, task)] = task
-                
-                # Xử lý kết quả khi hoàn thành
-                for future in as_completed(future_to_task):
-                    task = future_to_task[future]
-                    stt = task[0]
-                    prompt = task[1]
-                    
-                    try:
-                        result = future.result()
-                        if result:
-                            self.progress.emit(f"✅ Hoàn thành STT {stt}")
-                            success_count += 1
-                        else:
-                            self.progress.emit(f"❌ Thất bại STT {stt}")
-                            self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-                            error_count += 1
-                            # Lưu task thất bại để retry
-                            self.failed_tasks.append(task)
-                    except Exception as e:
-                        self.progress.emit(f"❌ Exception STT {stt}: {str(e)}")
-                        self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-                        error_count += 1
-                        # Lưu task thất bại để retry
-                        self.failed_tasks.append(task)
-            
-            # Hiển thị thống kê chi tiết
-            self.progress.emit("📊 THỐNG KÊ KẾT QUẢ:")
-            self.progress.emit(f"✅ Thành công: {success_count}/{len(valid_data)} ảnh")
-            self.progress.emit(f"❌ Thất bại: {error_count}/{len(valid_data)} ảnh")
-            
-            if self.failed_tasks:
-                self.progress.emit(f"🔄 Có {len(self.failed_tasks)} ảnh thất bại có thể retry")
-                self.progress.emit("💡 Nhấn nút 'Retry Lỗi' để chạy lại các ảnh thất bại")
-            
-            if success_count > 0:
-                self.finished.emit(True, f"Đồng bộ thành công {success_count}/{len(valid_data)} ảnh trong thư mục '{self.output_folder}'")
-            else:
-                self.finished.emit(False, f"Không edit được ảnh nào. Tổng lỗi: {error_count}")
+            runner = SyncBatchRunner(self.cookie, self.media_generation_id, self.raw_bytes, self.excel_path,
+                                     self.seed, self.thread_count, self.output_folder, progress=self.report,
+                                     on_task_event=self.run_stats.handle, catalog=output_catalog,
+                                     account=self.account_name)
+            outcome = runner.run()
+            self.finished.emit(outcome.success, outcome.message)
                 
         except Exception as e:
             self.finished.emit(False, f"Lỗi: {str(e)}")
-    
-    def process_single_sync_task(self, task_data):
-        """Xử lý một task edit ảnh trong thread"""
-        stt, prompt, cookie, media_generation_id, raw_bytes, seed, output_folder = task_data
-        
-        try:
-            # Gọi API edit image
-            result = edit_image_with_prompt(cookie, media_generation_id, raw_bytes, prompt, seed)
-            
-            if result and 'imagePanels' in result:
-                for panel in result['imagePanels']:
-                    if 'generatedImages' in panel:
-                        for img in panel['generatedImages']:
-                            if 'encodedImage' in img:
-                                filename = sanitize_filename(stt, prompt)
-                                self.progress.emit(f"💾 Đang lưu ảnh: {filename}")
-                                if save_base64_image(img['encodedImage'], filename, output_folder):
-                                    self.progress.emit(f"✅ Đã lưu thành công: {filename}")
-                                    return True
-                                else:
-                                    self.progress.emit(f"❌ Lỗi khi lưu: {filename}")
-                                    return False
-            elif result is None:
-                # API trả về None - có thể do lỗi 401, 429, hoặc lỗi khác
-                self.progress.emit(f"❌ STT {stt} - API không phản hồi")
-                self.progress.emit(f"💡 Có thể do: Access token hết hạn (401), Rate limit (429), hoặc Quota hết")
-                self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-                return False
-            else:
-                # API trả về dữ liệu không hợp lệ
-                self.progress.emit(f"❌ STT {stt} - Dữ liệu API không hợp lệ")
-                self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-                return False
-                
-        except Exception as e:
-            # Log lỗi chi tiết để debug
-            import traceback
-            self.progress.emit(f"❌ Exception STT {stt}: {str(e)}")
-            self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-            self.progress.emit(f"🔧 Traceback: {traceback.format_exc()}")
-            return False
 
 
-class RetryThread(QThread):
+class RetryThread(WorkerThread):
     """Thread để retry các task thất bại"""
-    progress = pyqtSignal(str)
-    finished = pyqtSignal(bool, str, list)  # success, message, new_failed_tasks
+    finished = pyqtSignal(bool, str)  # success, message (task còn lỗi được ghi trong journal)
     
-    def __init__(self, cookie, media_generation_id, raw_bytes, failed_tasks, thread_count, output_folder):
+    def __init__(self, cookie, media_generation_id, raw_bytes, excel_path, failed_tasks, thread_count, output_folder,
+                 account_name=None):
         super().__init__()
         self.cookie = cookie
         self.media_generation_id = media_generation_id
         self.raw_bytes = raw_bytes
+        self.excel_path = excel_path
         self.failed_tasks = failed_tasks
         self.thread_count = thread_count
         self.output_folder = output_folder
+        self.account_name = account_name
     
     def run(self):
         try:
-            from concurrent.futures import ThreadPoolExecutor, as_completed
-            
-            self.progress.emit(f"🔄 Bắt đầu retry {len(self.failed_tasks)} ảnh thất bại...")
-            
-            success_count = 0
-            error_count = 0
-            new_failed_tasks = []
-            
-            # Sử dụng ThreadPoolExecutor để xử lý multi-threading
-            with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
-                future_to_task = {}
-                for task in self.failed_tasks:
-                    future_to_task[executor.submit(self.process_single_sync_task, task)] = task
-                
-                # Xử lý kết quả khi hoàn thành
-                for future in as_completed(future_to_task):
-                    task = future_to_task[future]
-                    stt = task[0]
-                    prompt = task[1]
-                    
-                    try:
-                        result = future.result()
-                        if result:
-                            self.progress.emit(f"✅ Retry thành công STT {stt}")
-                            success_count += 1
-                        else:
-                            self.progress.emit(f"❌ Retry thất bại STT {stt}")
-                            self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-                            error_count += 1
-                            new_failed_tasks.append(task)
-                    except Exception as e:
-                        self.progress.emit(f"❌ Exception STT {stt}: {str(e)}")
-                        self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-                        error_count += 1
-                        new_failed_tasks.append(task)
-            
-            # Hiển thị thống kê chi tiết
-            self.progress.emit("📊 THỐNG KÊ RETRY:")
-            self.progress.emit(f"✅ Thành công: {success_count}/{len(self.failed_tasks)} ảnh")
-            self.progress.emit(f"❌ Vẫn thất bại: {error_count}/{len(self.failed_tasks)} ảnh")
-            
-            if new_failed_tasks:
-                self.progress.emit(f"🔄 Còn {len(new_failed_tasks)} ảnh thất bại có thể retry tiếp")
-            else:
-                self.progress.emit("🎉 Đã retry thành công tất cả ảnh!")
-            
-            if success_count > 0:
-                self.finished.emit(True, f"Retry thành công {success_count}/{len(self.failed_tasks)} ảnh", new_failed_tasks)
-            else:
-                self.finished.emit(False, f"Retry thất bại tất cả {len(self.failed_tasks)} ảnh", new_failed_tasks)
-                
-        except Exception as e:
-            self.finished.emit(False, f"Lỗi retry: {str(e)}", self.failed_tasks)
-    
-    def process_single_sync_task(self, task_data):
-        """Xử lý một task edit ảnh trong thread (tái sử dụng từ SyncThread)"""
-        stt, prompt, cookie, media_generation_id, raw_bytes, seed, output_folder = task_data
-        
-        try:
-            # Gọi API edit image
-            result = edit_image_with_prompt(cookie, media_generation_id, raw_bytes, prompt, seed)
-            
-            if result and 'imagePanels' in result:
-                for panel in result['imagePanels']:
-                    if 'generatedImages' in panel:
-                        for img in panel['generatedImages']:
-                            if 'encodedImage' in img:
-                                filename = sanitize_filename(stt, prompt)
-                                self.progress.emit(f"💾 Đang lưu ảnh: {filename}")
-                                if save_base64_image(img['encodedImage'], filename, output_folder):
-                                    self.progress.emit(f"✅ Đã lưu thành công: {filename}")
-                                    return True
-                                else:
-                                    self.progress.emit(f"❌ Lỗi khi lưu: {filename}")
-                                    return False
-            elif result is None:
-                # API trả về None - có thể do lỗi 401, 429, hoặc lỗi khác
-                self.progress.emit(f"❌ STT {stt} - API không phản hồi")
-                self.progress.emit(f"💡 Có thể do: Access token hết hạn (401), Rate limit (429), hoặc Quota hết")
-                self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-                return False
-            else:
-                # API trả về dữ liệu không hợp lệ
-                self.progress.emit(f"❌ STT {stt} - Dữ liệu API không hợp lệ")
-                self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-                return False
+            runner = SyncBatchRunner(self.cookie, self.media_generation_id, self.raw_bytes, self.excel_path,
+                                     0, self.thread_count, self.output_folder, progress=self.report,
+                                     on_task_event=self.run_stats.handle, catalog=output_catalog,
+                                     account=self.account_name)
+            outcome = runner.retry(self.failed_tasks)
+            self.finished.emit(outcome.success, outcome.message)
                 
         except Exception as e:
-            # Log lỗi chi tiết để debug
-            import traceback
-            self.progress.emit(f"❌ Exception STT {stt}: {str(e)}")
-            self.progress.emit(f"🔍 Prompt: {prompt[:50]}...")
-            self.progress.emit(f"🔧 Traceback: {traceback.format_exc()}")
-            return False
+            self.finished.emit(False, f"Lỗi retry: {str(e)}")
 
 
 class MainWindow(QMainWindow):
@@ -3191,6 +2616,14 @@ def main():
     font = QFont("Open Sans", 9)
     app.setFont(font)
     
+    # Endpoint Prometheus /metrics (chỉ bật khi có biến môi trường WHISK_METRICS_PORT)
+    try:
+        metrics_server = start_metrics_server()
+        if metrics_server:
+            log.info("Metrics: {}", metrics_server.url)
+    except (OSError, ValueError) as e:
+        log.warning("Không bật được endpoint metrics: {}", e)
+    
     # Create main window
     if check_for_update(VERSION_CHECK_ENDPOINT):
         return 0
@@ -3206,28 +2639,28 @@ def main():
     if saved_key and saved_key_info:
         # Kiểm tra expiry local trước
         if config_manager.is_key_expired_locally(device_id):
-            print("Key đã hết hạn (kiểm tra local), xóa key cũ...")
+            log.warning("Key đã hết hạn (kiểm tra local), xóa key cũ...")
             config_manager.clear_api_key()
             saved_key = None
             saved_key_info = None
         elif config_manager.should_refresh_key(device_id, force_refresh_hours=24):
             # Key đã lưu lâu (>24h), kiểm tra với server để đảm bảo
-            print("Key đã lưu lâu, đang kiểm tra với server...")
+            log.info("Key đã lưu lâu, đang kiểm tra với server...")
             success, message, info = check_key_online(saved_key, API_AUTH_ENDPOINT)
             
             if success:
-                print("Key vẫn hợp lệ, cập nhật thông tin...")
+                log.success("Key vẫn hợp lệ, cập nhật thông tin...")
                 # Cập nhật lại thông tin key với dữ liệu mới từ server
                 config_manager.save_api_key(saved_key, device_id, info, remember=True)
                 key_info = info
             else:
-                print(f"Key không còn hợp lệ: {message}")
+                log.warning("Key không còn hợp lệ: {}", message)
                 config_manager.clear_api_key()
                 saved_key = None
                 saved_key_info = None
         else:
             # Key còn "tươi" (<24h), sử dụng thông tin đã lưu
-            print("Sử dụng key đã lưu (không cần kiểm tra server)...")
+            log.info("Sử dụng key đã lưu (không cần kiểm tra server)...")
             key_info = saved_key_info
     
     # Nếu không có key hợp lệ, hiện dialog đăng nhập
@@ -3246,9 +2679,9 @@ def main():
             if api_key:
                 success = config_manager.save_api_key(api_key, device_id, key_info, remember=True)
                 if success:
-                    print("Đã lưu key thành công!")
+                    log.success("Đã lưu key thành công!")
                 else:
-                    print("Không thể lưu key.")
+                    log.error("Không thể lưu key.")
     
     # Lấy thông tin key để hiển thị
     key = key_info.get("key")
@@ -3264,4 +2697,6 @@ def main():
     return app.exec_()
 
 if __name__ == '__main__':
+    # Cần cho process hậu xử lý (postprocess.py) khi chạy từ bản đóng gói .exe
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
@@ -0,0 +1,308 @@
+"""Metrics của tiến trình (counter, gauge, histogram) cho giám sát khi chạy thật
+
+Các metric được khai báo một lần ở cuối file và cập nhật từ api (make_request, retry, lưu ảnh)
+và limiter. Xuất ra theo hai cách:
+- HTTP cục bộ (tùy chọn) ở định dạng Prometheus text: /metrics, và JSON: /metrics.json
+  (bật bằng --metrics-port của batch_engine hoặc biến môi trường WHISK_METRICS_PORT)
+- File JSON tóm tắt số liệu của từng lượt chạy, ghi vào thư mục output khi batch kết thúc
+"""
+import bisect
+import json
+import os
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT_ENV = "WHISK_METRICS_PORT"
+SUMMARY_PREFIX = "whisk_metrics_"
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60, 120)
+DISK_SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)  # Ghi file nhanh hơn request nhiều
+BYTES_BUCKETS = (16 * 1024, 64 * 1024, 128 * 1024, 256 * 1024, 512 * 1024, 1024 * 1024, 2 * 1024 * 1024,
+                 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_text(labelnames, key, extra=()):
+    """{a="1",b="2"} theo định dạng Prometheus ("" nếu không có label)"""
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Giá trị chỉ tăng (theo từng bộ label)"""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        return [f"{self.name}{_label_text(self.labelnames, key)} {_format_number(value)}"
+                for key, value in sorted(self.samples().items())]
+
+class Gauge(Counter):
+    """Giá trị tăng/giảm tùy ý (vd: số request đang chạy)"""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram:
+    """Phân bố giá trị theo bucket cố định (kèm tổng và số mẫu)"""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = {}  # label key -> [số mẫu theo bucket (+Inf cuối), tổng, số mẫu]
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def render(self):
+        lines = []
+        for key, (counts, total, count) in sorted(self.samples().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = (("le", _format_number(float(bound))),)
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {_format_number(total)}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {count}")
+        return lines
+
+def bucket_quantile(buckets, counts, fraction):
+    """Ước lượng phân vị từ số mẫu theo bucket (nội suy tuyến tính trong bucket)"""
+    total = sum(counts)
+    if not total:
+        return None
+    target = fraction * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(buckets + (float("inf"),), counts):
+        if count and cumulative + count >= target:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (target - cumulative) / count
+        cumulative += count
+        lower = bound
+    return lower
+
+class MetricsRegistry:
+    """Tập hợp các metric của tiến trình; xuất Prometheus text hoặc snapshot dạng dict"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=SECONDS_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """{tên metric: {"type", "labelnames", "buckets"?, "samples": {label key: giá trị}}}"""
+        result = {}
+        for metric in self.metrics():
+            entry = {'type': metric.kind, 'labelnames': metric.labelnames, 'samples': metric.samples()}
+            if metric.kind == "histogram":
+                entry['buckets'] = metric.buckets
+            result[metric.name] = entry
+        return result
+
+    def summary(self, since=None):
+        """Snapshot dạng JSON được; nếu có since (snapshot trước đó) thì counter/histogram là phần tăng thêm"""
+        since = since or {}
+        result = {}
+        for name, entry in self.snapshot().items():
+            before = since.get(name, {}).get('samples', {})
+            values = {}
+            for key, value in entry['samples'].items():
+                label = ",".join(f"{n}={v}" for n, v in zip(entry['labelnames'], key))
+                if entry['type'] == "histogram":
+                    counts, total, count = value
+                    if key in before:
+                        old_counts, old_total, old_count = before[key]
+                        counts = [a - b for a, b in zip(counts, old_counts)]
+                        total, count = total - old_total, count - old_count
+                    if not count:
+                        continue
+                    values[label] = {
+                        'count': count, 'sum': round(total, 4), 'avg': round(total / count, 4),
+                        'p50': round(bucket_quantile(entry['buckets'], counts, 0.5), 4),
+                        'p95': round(bucket_quantile(entry['buckets'], counts, 0.95), 4),
+                    }
+                elif entry['type'] == "counter":
+                    value -= before.get(key, 0)
+                    if value:
+                        values[label] = value
+                else:
+                    values[label] = value
+            if values:
+                result[name] = values
+        return result
+
+# ===== XUẤT METRICS =====
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body = self.registry.render_prometheus().encode('utf-8')
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            body = json.dumps(self.registry.summary(), ensure_ascii=False).encode('utf-8')
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Không in access log ra console
+
+class MetricsServer:
+    """HTTP server cục bộ (thread nền) phục vụ /metrics và /metrics.json"""
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        handler = type("MetricsHandler", (_MetricsHandler,), {'registry': registry})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/metrics"
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def start_metrics_server(port=None, host="127.0.0.1"):
+    """Bật endpoint metrics; port None thì đọc WHISK_METRICS_PORT (không có -> không bật, trả về None)"""
+    if port is None:
+        value = os.environ.get(METRICS_PORT_ENV, "").strip()
+        if not value:
+            return None
+        port = int(value)
+    return MetricsServer(registry, port, host)
+
+def write_run_summary(output_folder, summary):
+    """Ghi tóm tắt một lượt chạy ra output_folder/whisk_metrics_<thời gian>.json, trả về đường dẫn"""
+    os.makedirs(output_folder, exist_ok=True)
+    path = os.path.join(output_folder, f"{SUMMARY_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2, default=str)
+    return path
+
+# Registry dùng chung cho toàn tiến trình
+registry = MetricsRegistry()
+
+HTTP_REQUESTS = registry.counter(
+    "whisk_http_requests_total", "Số HTTP request đã gửi", ("method", "host", "status"))
+HTTP_ERRORS = registry.counter(
+    "whisk_http_errors_total", "Request lỗi ở tầng HTTP (không có response)", ("host", "kind"))
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "whisk_http_request_seconds", "Thời gian chờ response HTTP (không gồm random_delay)", ("host",))
+HTTP_IN_FLIGHT = registry.gauge(
+    "whisk_http_in_flight", "Số HTTP request đang chờ response")
+RANDOM_DELAY_SECONDS = registry.histogram(
+    "whisk_random_delay_seconds", "Thời gian random_delay trước mỗi request")
+API_ATTEMPTS = registry.counter(
+    "whisk_api_attempts_total", "Số lần gọi API theo kết quả (rate_limited = 429)", ("api", "outcome"))
+API_RETRIES = registry.counter(
+    "whisk_api_retries_total", "Số lần thử lại theo lý do", ("api", "outcome"))
+API_RETRY_WAIT_SECONDS = registry.counter(
+    "whisk_api_retry_wait_seconds_total", "Tổng thời gian chờ backoff giữa các lần thử lại", ("api",))
+API_CALL_SECONDS = registry.histogram(
+    "whisk_api_call_seconds", "Thời gian một lệnh gọi API (gồm cả retry)", ("api", "outcome"))
+RESPONSE_BYTES = registry.counter(
+    "whisk_response_bytes_total", "Số byte response API đã tải về", ("api",))
+IMAGES_SAVED = registry.counter(
+    "whisk_images_saved_total", "Số ảnh đã ghi ra đĩa", ("path",))
+IMAGE_BYTES_WRITTEN = registry.counter(
+    "whisk_image_bytes_written_total", "Số byte ảnh đã ghi ra đĩa", ("path",))
+IMAGE_SAVE_SECONDS = registry.histogram(
+    "whisk_image_save_seconds", "Thời gian ghi một ảnh ra đĩa", ("path",), DISK_SECONDS_BUCKETS)
+IMAGE_SIZE_BYTES = registry.histogram(
+    "whisk_image_size_bytes", "Kích thước ảnh đã lưu", (), BYTES_BUCKETS)
+RESULT_CACHE_LOOKUPS = registry.counter(
+    "whisk_result_cache_lookups_total", "Số lần tra result cache theo kết quả (hit/miss)", ("outcome",))
+CONCURRENCY_LIMIT = registry.gauge(
+    "whisk_concurrency_limit", "Số request đồng thời hiện tại của limiter AIMD")
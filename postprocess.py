@@ -0,0 +1,187 @@
+"""Giai đoạn hậu xử lý tùy chọn: chuyển định dạng và tạo thumbnail cho ảnh vừa lưu
+
+Chạy sau giai đoạn disk của image_pipeline, trong ProcessPoolExecutor (không tranh GIL với worker
+network/decode, không chạy trên thread Qt). Process con đọc ảnh từ file vừa lưu (thường còn trong cache
+của hệ điều hành), hoặc từ bytes nếu người gọi đã có sẵn trong bộ nhớ.
+Mỗi worker có tối đa QUEUE_PER_WORKER ảnh chờ; khi hàng đợi đầy, ảnh được hoãn tới cuối lượt chạy
+thay vì chặn giai đoạn disk, nên hậu xử lý không làm chậm tốc độ mạng.
+
+Cấu hình là danh sách output "FORMAT[@CẠNH_DÀI][:QUALITY]" phân tách bằng dấu phẩy, vd:
+    webp          -> <thư mục ảnh>/webp/<tên>.webp (giữ kích thước)
+    webp@256:70   -> <thư mục ảnh>/webp_256/<tên>.webp (cạnh dài tối đa 256px, quality 70)
+    jpeg@512      -> <thư mục ảnh>/jpeg_512/<tên>.jpg
+Bật bằng --postprocess của batch_engine hoặc biến môi trường WHISK_POSTPROCESS.
+"""
+import io
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+POSTPROCESS_ENV = "WHISK_POSTPROCESS"
+DEFAULT_POSTPROCESS_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+QUEUE_PER_WORKER = 2  # Số ảnh tối đa đang chờ/đang xử lý cho mỗi process
+MAX_ERRORS_KEPT = 5   # Số lỗi gần nhất giữ lại để báo cáo
+
+# Định dạng hỗ trợ: tên trong cấu hình -> (tên định dạng của Pillow, đuôi file)
+FORMATS = {
+    'webp': ('WEBP', '.webp'),
+    'jpeg': ('JPEG', '.jpg'),
+    'jpg': ('JPEG', '.jpg'),
+    'png': ('PNG', '.png'),
+}
+
+# format: khóa trong FORMATS, size: cạnh dài tối đa (None: giữ nguyên), quality: None là mặc định của Pillow
+OutputSpec = namedtuple('OutputSpec', 'format size quality')
+
+def parse_specs(text):
+    """Đọc cấu hình "webp,webp@256:70" thành tuple OutputSpec (ValueError nếu sai định dạng)"""
+    specs = []
+    for part in (text or "").split(","):
+        part = part.strip().lower()
+        if not part:
+            continue
+        name, _, quality = part.partition(":")
+        name, _, size = name.partition("@")
+        if name not in FORMATS:
+            raise ValueError(f"Định dạng hậu xử lý không hỗ trợ: {name} (hỗ trợ: {', '.join(sorted(FORMATS))})")
+        try:
+            spec = OutputSpec(name, int(size) if size else None, int(quality) if quality else None)
+        except ValueError:
+            raise ValueError(f"Cấu hình hậu xử lý không hợp lệ: {part}") from None
+        if (spec.size is not None and spec.size <= 0) or (spec.quality is not None and not 1 <= spec.quality <= 100):
+            raise ValueError(f"Cấu hình hậu xử lý không hợp lệ: {part}")
+        specs.append(spec)
+    return tuple(specs)
+
+def specs_from_env():
+    """Cấu hình trong WHISK_POSTPROCESS (tuple rỗng nếu không có hoặc sai định dạng)"""
+    try:
+        return parse_specs(os.environ.get(POSTPROCESS_ENV, ""))
+    except ValueError:
+        return ()
+
+def output_path(image_path, spec):
+    """Đường dẫn file kết quả của một output: <thư mục ảnh>/<format>[_<size>]/<tên><đuôi>"""
+    folder = spec.format if spec.size is None else f"{spec.format}_{spec.size}"
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(os.path.dirname(image_path), folder, stem + FORMATS[spec.format][1])
+
+def transcode(content, image_path, specs):
+    """Chạy trong process con: tạo mọi output của một ảnh, trả về danh sách file đã ghi
+
+    content: bytes ảnh đã lưu (None: đọc lại từ image_path).
+    """
+    from PIL import Image
+
+    if content is None:
+        with open(image_path, 'rb') as f:
+            content = f.read()
+    written = []
+    with Image.open(io.BytesIO(content)) as source:
+        source.load()
+        for spec in specs:
+            image = source
+            if spec.size is not None and max(source.size) > spec.size:
+                image = source.copy()
+                image.thumbnail((spec.size, spec.size), Image.LANCZOS)
+            pil_format = FORMATS[spec.format][0]
+            if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            options = {} if spec.quality is None else {'quality': spec.quality}
+            target = output_path(image_path, spec)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            part_path = f"{target}.part"
+            try:
+                image.save(part_path, pil_format, **options)
+                os.replace(part_path, target)
+            except Exception:
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+                raise
+            written.append(target)
+    return written
+
+class PostProcessor:
+    """Gửi ảnh vừa lưu sang process pool để chuyển định dạng/tạo thumbnail, không bao giờ chặn người gọi"""
+
+    def __init__(self, specs, workers=DEFAULT_POSTPROCESS_WORKERS):
+        self.specs = tuple(specs)
+        self.workers = max(1, int(workers))
+        self._slots = threading.BoundedSemaphore(self.workers * QUEUE_PER_WORKER)
+        self._lock = threading.Lock()
+        self._executor = None   # Tạo khi có ảnh đầu tiên
+        self._deferred = []     # Ảnh bị hoãn vì hàng đợi đầy: xử lý ở close(), đọc lại từ file
+        self.submitted = 0
+        self.deferred = 0
+        self.processed = 0
+        self.failed = 0
+        self.outputs = 0
+        self.errors = []
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: process con không kế thừa lock của các thread đang chạy (network, Qt)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def submit(self, image_path, content=None):
+        """Đưa một ảnh vào hàng đợi hậu xử lý; hàng đợi đầy thì hoãn tới close()"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._deferred.append(image_path)
+                self.deferred += 1
+            return
+        self._submit(image_path, content)
+
+    def _submit(self, image_path, content):
+        try:
+            future = self._pool().submit(transcode, content, image_path, self.specs)
+        except Exception as e:
+            self._slots.release()
+            self._failed(image_path, e)
+            return
+        with self._lock:
+            self.submitted += 1
+        future.add_done_callback(lambda f: self._on_done(image_path, f))
+
+    def _on_done(self, image_path, future):
+        self._slots.release()
+        try:
+            written = future.result()
+        except Exception as e:
+            self._failed(image_path, e)
+            return
+        with self._lock:
+            self.processed += 1
+            self.outputs += len(written)
+
+    def _failed(self, image_path, error):
+        with self._lock:
+            self.failed += 1
+            self.errors = (self.errors + [f"{os.path.basename(image_path)}: {error}"])[-MAX_ERRORS_KEPT:]
+
+    def close(self):
+        """Xử lý nốt các ảnh bị hoãn, chờ mọi ảnh xong rồi dừng process pool"""
+        while True:
+            with self._lock:
+                if not self._deferred:
+                    break
+                image_path = self._deferred.pop(0)
+            self._slots.acquire()  # Lúc này mạng đã xong, được phép chờ
+            self._submit(image_path, None)
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats_dict(self):
+        with self._lock:
+            return {'workers': self.workers, 'submitted': self.submitted, 'deferred': self.deferred,
+                    'processed': self.processed, 'failed': self.failed, 'outputs': self.outputs,
+                    'errors': list(self.errors)}
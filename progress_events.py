@@ -0,0 +1,105 @@
+"""Event tiến độ có kiểu của từng task và bộ tổng hợp số liệu cho dashboard
+
+Runner gửi TaskEvent mỗi khi task chuyển giai đoạn:
+    queued -> network -> decode -> disk -> done / failed
+(skipped cho dòng đã hoàn thành ở lần chạy trước). RunStats gom event từ mọi worker
+(thread-safe) để GUI đọc snapshot theo nhịp cố định thay vì parse message text.
+"""
+import threading
+import time
+from collections import Counter, deque, namedtuple
+
+STAGE_QUEUED = "queued"    # Đã đưa vào pipeline, chờ worker network
+STAGE_NETWORK = "network"  # Đang gửi request
+STAGE_DECODE = "decode"    # Đã có response thô, chờ/đang giải mã
+STAGE_DISK = "disk"        # Đã giải mã, chờ/đang ghi file
+STAGE_DONE = "done"
+STAGE_FAILED = "failed"
+STAGE_SKIPPED = "skipped"
+
+ACTIVE_STAGES = (STAGE_NETWORK, STAGE_DECODE, STAGE_DISK)
+
+# task: id duy nhất trong lượt chạy (khóa journal hoặc STT), stt: STT hiển thị
+# duration: số giây của giai đoạn vừa kết thúc; với done/failed là thời gian request (kể cả retry)
+# bytes: dung lượng dữ liệu chuyển sang giai đoạn mới (response thô khi vào decode, ảnh khi vào disk)
+# error: loại lỗi khi failed (RequestOutcome hoặc tên exception)
+TaskEvent = namedtuple('TaskEvent', 'task stt stage duration bytes error ts')
+
+LATENCY_WINDOW = 500  # Số request gần nhất dùng để tính p50/p95
+RATE_WINDOW = 60.0    # Số giây gần nhất dùng để tính tốc độ ảnh/phút
+
+def percentile(values, fraction):
+    """Phân vị của danh sách đã sắp xếp (None nếu rỗng)"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+class RunStats:
+    """Tổng hợp TaskEvent của một lượt chạy: số task theo giai đoạn, tốc độ, ETA, độ trễ request"""
+
+    def __init__(self, total=None):
+        self.total = total  # Số task dự kiến (None nếu chưa biết)
+        self._lock = threading.Lock()
+        self._stages = {}   # task -> giai đoạn hiện tại (task chưa kết thúc)
+        self._active = Counter()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._finished_at = deque()  # Thời điểm kết thúc của task trong RATE_WINDOW giây gần nhất
+        self.errors = Counter()
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes_written = 0
+        self.started = time.time()
+
+    def handle(self, event):
+        """Nhận một TaskEvent (gọi được từ bất kỳ thread nào)"""
+        with self._lock:
+            previous = self._stages.pop(event.task, None)
+            if previous is not None:
+                self._active[previous] -= 1
+            if event.stage in (STAGE_DONE, STAGE_FAILED):
+                if event.stage == STAGE_DONE:
+                    self.done += 1
+                else:
+                    self.failed += 1
+                    self.errors[event.error or "unknown"] += 1
+                if event.duration:
+                    self._latencies.append(event.duration)
+                self._finished_at.append(event.ts)
+            elif event.stage == STAGE_SKIPPED:
+                self.skipped += 1
+            else:
+                self._stages[event.task] = event.stage
+                self._active[event.stage] += 1
+                if event.stage == STAGE_DISK and event.bytes:
+                    self.bytes_written += event.bytes
+
+    def snapshot(self, now=None):
+        """Số liệu hiện tại dạng dict (images_per_min, in_flight, queue_depth, eta, p50, p95, ...)"""
+        now = now or time.time()
+        with self._lock:
+            while self._finished_at and self._finished_at[0] < now - RATE_WINDOW:
+                self._finished_at.popleft()
+            window = min(RATE_WINDOW, max(now - self.started, 1.0))
+            finished_per_second = len(self._finished_at) / window
+            latencies = sorted(self._latencies)
+            remaining = None
+            if self.total is not None:
+                remaining = max(0, self.total - self.done - self.failed - self.skipped)
+            return {
+                'images_per_min': round(finished_per_second * 60, 1),
+                'in_flight': sum(self._active[stage] for stage in ACTIVE_STAGES),
+                'queue_depth': self._active[STAGE_QUEUED],
+                'stages': {stage: self._active[stage] for stage in (STAGE_QUEUED,) + ACTIVE_STAGES},
+                'done': self.done,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'total': self.total,
+                'remaining': remaining,
+                'eta': remaining / finished_per_second if remaining is not None and finished_per_second > 0 else None,
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'bytes_written': self.bytes_written,
+                'errors': dict(self.errors),
+                'elapsed': now - self.started,
+            }
@@ -0,0 +1,295 @@
+"""Cache kết quả tạo ảnh giữa các lần chạy, khóa theo fingerprint của request
+
+Cùng (mode, prompt, seed, model, aspect ratio, ảnh tham chiếu) thì API trả về cùng ảnh, nên ảnh đã
+tạo ở lần chạy trước (kể cả vào thư mục output khác) được lấy lại bằng hardlink/copy thay vì gọi mạng.
+
+Ảnh được giữ trong kho riêng theo nội dung (objects/<sha256>.jpg, hardlink với file output nên thường
+không tốn thêm dung lượng, và không mất khi file output bị xóa/sửa) cùng một index JSONL append-only
+giống job_journal. Tổng dung lượng kho bị giới hạn bởi max_bytes; vượt quá thì bỏ entry ít dùng nhất.
+Khi lấy từ cache, checksum được kiểm tra lại; file hỏng hoặc bị xóa thì entry bị bỏ và task gọi API như thường.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+
+from api import log
+
+RESULT_CACHE_DIR = "result_cache"
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2 GB
+INDEX_NAME = "index.jsonl"
+
+def request_fingerprint(mode, prompt, seed, model, aspect_ratio, references=()):
+    """sha256 của request ở dạng chuẩn hóa
+
+    references: [(sha256 nội dung ảnh, caption, media category)] của ảnh tham chiếu (img2img).
+    """
+    canonical = json.dumps({
+        'mode': mode,
+        'prompt': str(prompt).strip(),
+        'seed': int(seed),
+        'model': model,
+        'aspect_ratio': aspect_ratio,
+        'references': [list(reference) for reference in references],
+    }, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def link_or_copy(source, target):
+    """Tạo target từ source bằng hardlink (cùng ổ đĩa), không được thì copy; qua file tạm rồi đổi tên"""
+    part_path = f"{target}.{threading.get_ident()}.part"
+    try:
+        try:
+            os.link(source, part_path)
+        except OSError:
+            shutil.copyfile(source, part_path)
+        os.replace(part_path, target)
+    except Exception:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+
+def _same_file(path, other):
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return False
+
+class ResultCache:
+    """Ánh xạ fingerprint request -> các ảnh đã lưu (vị trí panel/index, sha256, kích thước)"""
+
+    def __init__(self, root=RESULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None   # fingerprint -> {'images': [...], 'created', 'last_used'}; nạp khi dùng lần đầu
+        self._refs = Counter()  # sha256 -> số entry dùng ảnh đó
+        self._sizes = {}       # sha256 -> kích thước
+        self._bytes = 0        # Tổng kích thước các ảnh trong kho (mỗi sha256 tính một lần)
+        self._index = None
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    @property
+    def index_path(self):
+        return os.path.join(self.root, INDEX_NAME)
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, "objects", sha256[:2], f"{sha256}.jpg")
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            self._load_locked()
+            return self._bytes
+
+    def _load_locked(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        line_count = 0
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        line_count += 1
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue  # Dòng ghi dở
+                        fingerprint = record.get('fp')
+                        if not fingerprint:
+                            continue
+                        if record.get('removed'):
+                            self._entries.pop(fingerprint, None)
+                        elif 'images' in record:
+                            self._entries[fingerprint] = {'images': record['images'], 'created': record['created'],
+                                                          'last_used': record['created']}
+                        elif fingerprint in self._entries:
+                            self._entries[fingerprint]['last_used'] = record.get('used', 0)
+            except OSError as e:
+                log.warning("Không đọc được result cache {}: {}", self.index_path, e)
+        for entry in self._entries.values():
+            self._add_refs_locked(entry)
+        if line_count > 2 * len(self._entries) + 100:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        """Ghi lại index chỉ với trạng thái hiện tại (bỏ bản ghi 'used'/'removed' cũ)"""
+        self._close_index_locked()
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for fingerprint, entry in self._entries.items():
+                f.write(json.dumps({'fp': fingerprint, 'images': entry['images'], 'created': entry['created']}) + "\n")
+                if entry['last_used'] != entry['created']:
+                    f.write(json.dumps({'fp': fingerprint, 'used': entry['last_used']}) + "\n")
+        os.replace(tmp_path, self.index_path)
+
+    def _append_locked(self, record):
+        if self._index is None:
+            os.makedirs(self.root, exist_ok=True)
+            self._index = open(self.index_path, 'a', encoding='utf-8')
+        self._index.write(json.dumps(record) + "\n")
+        self._index.flush()  # Không fsync: mất vài bản ghi cuối khi crash chỉ làm cache miss
+
+    def _close_index_locked(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _add_refs_locked(self, entry):
+        for image in entry['images']:
+            sha256 = image['sha256']
+            if sha256 not in self._refs:
+                self._sizes[sha256] = image['size']
+                self._bytes += image['size']
+            self._refs[sha256] += 1
+
+    def _remove_locked(self, fingerprint):
+        """Bỏ entry, trả về các ảnh trong kho không còn entry nào dùng (cần xóa file)"""
+        entry = self._entries.pop(fingerprint, None)
+        if entry is None:
+            return []
+        self._append_locked({'fp': fingerprint, 'removed': True})
+        orphans = []
+        for image in entry['images']:
+            sha256 = image['sha256']
+            self._refs[sha256] -= 1
+            if self._refs[sha256] <= 0:
+                del self._refs[sha256]
+                self._bytes -= self._sizes.pop(sha256, 0)
+                orphans.append(sha256)
+        return orphans
+
+    def _delete_objects(self, orphans):
+        for sha256 in orphans:
+            try:
+                os.remove(self.object_path(sha256))
+            except OSError:
+                pass
+
+    def _evict_locked(self):
+        """Bỏ entry ít dùng nhất tới khi tổng dung lượng kho <= max_bytes"""
+        orphans = []
+        if self._bytes <= self.max_bytes:
+            return orphans
+        for fingerprint in sorted(self._entries, key=lambda key: self._entries[key]['last_used']):
+            if self._bytes <= self.max_bytes:
+                break
+            orphans += self._remove_locked(fingerprint)
+            self.evicted += 1
+        return orphans
+
+    def materialize(self, fingerprint, image_path_for):
+        """Tạo lại các ảnh của request từ kho (image_path_for(panel, index, ordinal) -> đường dẫn đích)
+
+        Trả về data dạng response (imagePanels[*].generatedImages[*].savedPath) hoặc None nếu
+        không có trong cache / file trong kho đã hỏng.
+        """
+        with self._lock:
+            self._load_locked()
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                self.misses += 1
+                return None
+            images = list(entry['images'])
+        try:
+            # Kiểm tra checksum mọi ảnh trước khi tạo file nào ở thư mục đích
+            for image in images:
+                if file_sha256(self.object_path(image['sha256'])) != image['sha256']:
+                    raise OSError(f"checksum không khớp: {image['sha256']}")
+            panels = {}
+            for ordinal, image in enumerate(images):
+                target = image_path_for(image['panel'], image['index'], ordinal)
+                if target is None:
+                    continue
+                folder = os.path.dirname(target)
+                if folder:
+                    os.makedirs(folder, exist_ok=True)
+                source = self.object_path(image['sha256'])
+                if not _same_file(source, target):
+                    link_or_copy(source, target)
+                panels.setdefault(image['panel'], []).append(
+                    {'savedPath': target, 'savedBytes': image['size'], 'savedSha256': image['sha256'],
+                     'fromCache': True})
+        except OSError as e:
+            log.warning("Bỏ entry result cache hỏng {}: {}", fingerprint[:12], e)
+            with self._lock:
+                self.misses += 1
+                orphans = self._remove_locked(fingerprint)
+            self._delete_objects(orphans)
+            return None
+        if not panels:
+            return None
+        now = time.time()
+        with self._lock:
+            if fingerprint in self._entries:
+                self._entries[fingerprint]['last_used'] = now
+                self._append_locked({'fp': fingerprint, 'used': now})
+            self.hits += 1
+        return {'imagePanels': [{'generatedImages': panels[panel]} for panel in sorted(panels)]}
+
+    def store(self, fingerprint, data):
+        """Đưa các ảnh đã lưu (savedPath trong data) của một request vào kho; trả về số ảnh đã cache"""
+        images = []
+        for p, panel in enumerate((data or {}).get('imagePanels', [])):
+            for j, image in enumerate(panel.get('generatedImages', [])):
+                path = image.get('savedPath')
+                if not path or image.get('fromCache'):
+                    continue
+                try:
+                    sha256 = image.get('savedSha256') or file_sha256(path)  # Pipeline đã tính khi giải mã
+                    object_path = self.object_path(sha256)
+                    if not os.path.exists(object_path):
+                        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                        link_or_copy(path, object_path)
+                    images.append({'panel': p, 'index': j, 'sha256': sha256, 'size': os.path.getsize(object_path)})
+                except OSError as e:
+                    log.warning("Không cache được {}: {}", path, e)
+        if not images:
+            return 0
+        now = time.time()
+        with self._lock:
+            self._load_locked()
+            orphans = self._remove_locked(fingerprint) if fingerprint in self._entries else []
+            entry = {'images': images, 'created': now, 'last_used': now}
+            self._entries[fingerprint] = entry
+            self._add_refs_locked(entry)
+            orphans = [sha256 for sha256 in orphans if sha256 not in self._refs]
+            self._append_locked({'fp': fingerprint, 'images': images, 'created': now})
+            self.stored += 1
+            orphans += self._evict_locked()
+        self._delete_objects(orphans)
+        return len(images)
+
+    def invalidate(self, fingerprint):
+        with self._lock:
+            self._load_locked()
+            orphans = self._remove_locked(fingerprint)
+        self._delete_objects(orphans)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'stored': self.stored, 'evicted': self.evicted,
+                    'entries': len(self._entries or {}), 'bytes': self._bytes}
+
+    def close(self):
+        with self._lock:
+            self._close_index_locked()
+
+# Cache dùng chung cho toàn tiến trình (GUI + runner)
+result_cache = ResultCache()
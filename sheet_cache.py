@@ -0,0 +1,128 @@
+"""Cache sheet đã parse, dùng chung giữa preview, validate và lượt chạy
+
+Chọn file trên GUI sẽ parse một lần (ParsedSheet); nhấn Generate/Đồng bộ dùng lại đúng dữ liệu
+đó nếu file chưa đổi. Khóa cache gồm đường dẫn, mtime và kích thước file nên file bị sửa
+sau khi preview sẽ không bao giờ bị đọc từ cache cũ.
+"""
+import os
+import threading
+
+from sheet_reader import iter_sheet_rows, valid_prompt, generation_mode, GenerationRow, SyncRow
+
+PARSE_CHUNK_ROWS = 2000  # Số dòng mỗi lần báo tiến độ khi parse (preview hiện dần)
+
+def sheet_signature(path):
+    """(đường dẫn tuyệt đối, mtime_ns, size) của file, None nếu không đọc được"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+class ParsedSheet:
+    """Các dòng dữ liệu (8 cột, đã chuẩn hóa) của một file cùng thống kê validation"""
+
+    def __init__(self, path, signature, rows):
+        self.path = path
+        self.signature = signature
+        self.rows = rows
+        self.stats = {'rows': len(rows), 'valid': 0, 'prompt_to_image': 0, 'image_to_image': 0}
+        self._modes = []  # Mode của từng dòng, None nếu dòng không có prompt hợp lệ
+        for row in rows:
+            if not valid_prompt(row[1]):
+                self._modes.append(None)
+                continue
+            mode = generation_mode(row)
+            self._modes.append(mode)
+            self.stats['valid'] += 1
+            if mode == "Image to Image":
+                self.stats['image_to_image'] += 1
+            else:
+                self.stats['prompt_to_image'] += 1
+
+    @classmethod
+    def parse(cls, path, on_rows=None, chunk_size=PARSE_CHUNK_ROWS):
+        """Đọc toàn bộ file; on_rows(list dòng mới) được gọi sau mỗi chunk_size dòng đã đọc
+
+        on_rows có thể raise để dừng giữa chừng (ví dụ người dùng đã chọn file khác).
+        """
+        signature = sheet_signature(path)
+        rows = []
+        chunk = []
+        for row in iter_sheet_rows(path, width=8):
+            chunk.append(row)
+            if on_rows is not None and len(chunk) >= chunk_size:
+                rows.extend(chunk)
+                on_rows(chunk)
+                chunk = []
+        rows.extend(chunk)
+        if on_rows is not None and chunk:
+            on_rows(chunk)
+        return cls(path, signature, rows)
+
+    def generation_rows(self):
+        """Các dòng hợp lệ cho chế độ tạo ảnh (GenerationRow)"""
+        for row, mode in zip(self.rows, self._modes):
+            if mode is not None:
+                yield GenerationRow(*row, mode)
+
+    def sync_rows(self):
+        """Các dòng hợp lệ cho chế độ đồng bộ (SyncRow: STT, PROMPT)"""
+        for row, mode in zip(self.rows, self._modes):
+            if mode is not None:
+                yield SyncRow(row[0], row[1])
+
+class SheetCache:
+    """Giữ tối đa max_entries ParsedSheet gần nhất; entry tự hết hiệu lực khi file đổi"""
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}  # đường dẫn tuyệt đối -> ParsedSheet (theo thứ tự dùng gần nhất)
+        self.hits = 0
+        self.misses = 0
+
+    def peek(self, path):
+        """ParsedSheet còn khớp với file hiện tại, None nếu chưa có hoặc file đã đổi (không parse)"""
+        signature = sheet_signature(path)
+        if signature is None:
+            return None
+        with self._lock:
+            sheet = self._entries.get(signature[0])
+            if sheet is None or sheet.signature != signature:
+                return None
+            self._entries[signature[0]] = self._entries.pop(signature[0])
+            self.hits += 1
+            return sheet
+
+    def get(self, path, on_rows=None):
+        """ParsedSheet của file, chỉ parse lại khi chưa có trong cache hoặc file đã đổi
+
+        on_rows chỉ được gọi khi thực sự parse (xem ParsedSheet.parse); lấy từ cache thì không.
+        """
+        sheet = self.peek(path)
+        if sheet is not None:
+            return sheet
+        sheet = ParsedSheet.parse(path, on_rows=on_rows)
+        with self._lock:
+            self.misses += 1
+            key = os.path.abspath(path)
+            self._entries.pop(key, None)
+            self._entries[key] = sheet
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+        return sheet
+
+    def is_current(self, path):
+        """True nếu cache đang giữ đúng phiên bản hiện tại của file"""
+        signature = sheet_signature(path)
+        with self._lock:
+            sheet = self._entries.get(os.path.abspath(path))
+            return sheet is not None and signature is not None and sheet.signature == signature
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(os.path.abspath(path), None)
+
+# Cache dùng chung cho toàn tiến trình (GUI preview + runner)
+sheet_cache = SheetCache()
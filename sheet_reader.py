@@ -0,0 +1,135 @@
+"""Đọc bảng dữ liệu đầu vào (Excel .xlsx, CSV, JSONL) theo từng dòng, không cần pandas
+
+Dòng đầu tiên là tiêu đề (như pandas.read_excel); các dòng sau được trả về dần dưới dạng
+tuple các ô đã chuẩn hóa, nên sheet hàng trăm nghìn dòng không phải nằm hết trong bộ nhớ.
+"""
+import csv
+import json
+import math
+import os
+from collections import namedtuple
+
+COLUMN_NAMES = ("STT", "PROMPT", "SUBJECT", "SUBJECT_CAPTION", "SCENE", "SCENE_CAPTION", "STYLE", "STYLE_CAPTION")
+SHEET_FILE_FILTER = "Bảng dữ liệu (*.xlsx *.xls *.csv *.jsonl);;Excel Files (*.xlsx *.xls)"
+
+# Dòng đã validate: mode là "Image to Image" (có ít nhất một ảnh tham chiếu) hoặc "Prompt to Image"
+GenerationRow = namedtuple('GenerationRow', 'stt prompt subject subject_caption scene scene_caption style style_caption mode')
+SyncRow = namedtuple('SyncRow', 'stt prompt')
+
+class MissingColumnsError(ValueError):
+    """File không đủ số cột tối thiểu (theo dòng tiêu đề)"""
+
+    def __init__(self, message="File Excel cần có ít nhất 2 cột: STT, PROMPT"):
+        super().__init__(message)
+
+def normalize_cell(value):
+    """Ô trống/NaN -> "", số thực nguyên (1.0) -> int, giá trị khác giữ nguyên"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ""
+        if value.is_integer():
+            return int(value)
+    return value
+
+def reference_path(value):
+    """Đường dẫn ảnh tham chiếu trong ô Excel, None nếu ô trống/NaN"""
+    path = str(value).strip() if value is not None else ""
+    if not path or path.lower() == 'nan':
+        return None
+    return path
+
+def valid_prompt(prompt):
+    text = str(prompt).strip()
+    return bool(text) and text.lower() != 'nan'
+
+def generation_mode(row):
+    """Mode của một dòng 8 cột: có ảnh subject/scene/style -> Image to Image"""
+    if reference_path(row[2]) or reference_path(row[4]) or reference_path(row[6]):
+        return "Image to Image"
+    return "Prompt to Image"
+
+def iter_sheet_rows(path, width=None, min_columns=2):
+    """Trả về từng dòng dữ liệu (bỏ dòng tiêu đề và dòng trống) dưới dạng tuple đã chuẩn hóa
+
+    width: cắt/đệm "" cho mỗi dòng đủ số cột. Thiếu cột (theo dòng tiêu đề) -> MissingColumnsError.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        rows = _iter_csv(path)
+    elif extension == '.jsonl':
+        rows = _iter_jsonl(path)
+    elif extension == '.xls':
+        rows = _iter_xls(path)
+    else:
+        rows = _iter_xlsx(path)
+
+    try:
+        header = next(rows, None)
+        header_width = len(header or ())
+        while header_width and normalize_cell(header[header_width - 1]) == "":
+            header_width -= 1
+        if header_width < min_columns:
+            raise MissingColumnsError()
+
+        for row in rows:
+            cells = tuple(normalize_cell(value) for value in (row[:width] if width else row))
+            if not any(cell != "" for cell in cells):
+                continue
+            if width and len(cells) < width:
+                cells += ("",) * (width - len(cells))
+            yield cells
+    finally:
+        rows.close()
+
+def _iter_xlsx(path):
+    """Sheet đầu tiên của file .xlsx ở chế độ read-only (đọc XML theo luồng)"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook.worksheets[0]
+        # Kích thước ghi trong file có thể sai (file do tool khác tạo) - đọc theo dữ liệu thực tế
+        worksheet.reset_dimensions()
+        yield from worksheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def _iter_xls(path):
+    """File .xls cũ: openpyxl không đọc được, dùng pandas (cần xlrd) nếu có"""
+    try:
+        import pandas as pd
+    except ImportError:
+        raise ValueError("Không đọc được file .xls - hãy lưu lại dưới dạng .xlsx hoặc .csv")
+    df = pd.read_excel(path, header=None)
+    yield from df.itertuples(index=False, name=None)
+
+def _iter_csv(path):
+    """CSV (UTF-8, có thể có BOM); tự nhận dấu phân cách , ; hoặc tab"""
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        sample = f.read(64 * 1024)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.reader(f, dialect)
+
+def _iter_jsonl(path):
+    """JSONL: mỗi dòng là một mảng ô hoặc object theo tên cột (STT, PROMPT, SUBJECT, ...)"""
+    yield COLUMN_NAMES
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ValueError(f"Dòng {line_number} của file JSONL không hợp lệ")
+            if isinstance(record, dict):
+                values = {str(key).upper(): value for key, value in record.items()}
+                yield tuple(values.get(name) for name in COLUMN_NAMES)
+            else:
+                yield tuple(record)
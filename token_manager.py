@@ -0,0 +1,216 @@
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+
+from api import get_access_token, browser_sim, log, LABS_BASE_URL
+
+REFRESH_MARGIN = 10 * 60         # Làm mới token trước khi hết hạn 10 phút
+UNKNOWN_EXPIRY_TTL = 15 * 60     # Thời hạn giả định khi API không trả về expires
+BACKGROUND_RETRY_DELAY = 60      # Chờ trước khi thử làm mới trong nền lại sau một lần lỗi
+EXPIRES_AT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def account_key(cookie):
+    """Khóa của tài khoản trong cache (không giữ cookie dạng rõ làm khóa)"""
+    return hashlib.sha256(str(cookie).encode('utf-8')).hexdigest()[:16]
+
+def parse_expires_at(value):
+    """expires_at ("%Y-%m-%d %H:%M:%S", giờ máy) -> epoch giây; None nếu không rõ"""
+    if not value or value in ('Unknown', 'Parse Error', 'No Expires Info'):
+        return None
+    try:
+        return datetime.strptime(value, EXPIRES_AT_FORMAT).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def saved_token_expiry(access_token, cookies_file='cookies.json'):
+    """Thời điểm hết hạn (epoch) của access token đã lưu trong cookies.json, None nếu không rõ"""
+    try:
+        with open(cookies_file, 'r', encoding='utf-8') as f:
+            cookies_data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    for data in cookies_data.values():
+        user_info = data.get('user_info', {})
+        if user_info.get('access_token') == access_token:
+            return parse_expires_at(user_info.get('expires_at'))
+    return None
+
+def is_access_token_valid(access_token, cookies_file='cookies.json'):
+    """Kiểm tra access token còn hợp lệ (theo expires_at đã lưu, sau đó gọi API session)"""
+    try:
+        # Kiểm tra thời gian hết hạn trước (nếu có thông tin trong cookies.json)
+        expires_at = saved_token_expiry(access_token, cookies_file)
+        if expires_at is not None and time.time() > expires_at:
+            return False  # Token đã hết hạn theo thời gian
+
+        # Test bằng cách gọi API session với timeout ngắn
+        url = f"{LABS_BASE_URL}/fx/api/auth/session"
+        headers = browser_sim.get_api_headers(access_token=access_token)
+        response = browser_sim.make_request("GET", url, headers=headers, timeout=10)
+        if response is not None and response.status_code == 401:
+            return False
+        # Nếu không phải 401, có thể là lỗi khác, coi như token hợp lệ
+        return response is not None
+    except Exception:
+        return False
+
+class _TokenEntry:
+    """Token của một tài khoản; lock đảm bảo mỗi lần chỉ một thread gọi API lấy token"""
+
+    def __init__(self, cookie):
+        self.cookie = cookie
+        self.access_token = None
+        self.expires_at = None       # epoch giây
+        self.access_data = None      # Response đầy đủ của lần lấy token gần nhất
+        self.failed_token = None     # Token bị 401 mà lần làm mới sau đó thất bại
+        self.refresh_lock = threading.Lock()
+        self.refresh_at = None       # epoch giây: get_token() từ thời điểm này sẽ làm mới trong nền
+        self.refreshing = False
+        self.background_retry_at = 0.0  # Không thử làm mới trong nền trước thời điểm này (sau lần lỗi)
+
+class TokenManager:
+    """Cache access token theo tài khoản cho toàn tiến trình (mọi tab, mọi worker)
+
+    - Trả token đã cache ngay, không đọc cookies.json hay gọi API nếu token còn hạn.
+    - Làm mới trong nền khi get_token() được gọi lúc token sắp hết hạn (refresh_margin giây):
+      chỉ tài khoản đang được dùng mới gọi API, không có timer chạy mãi cho tài khoản đã dùng xong.
+    - Khi worker gặp 401, refresh_after_auth_error() chỉ lấy token mới một lần cho cả lượt chạy.
+    """
+
+    def __init__(self, refresh_margin=REFRESH_MARGIN, cookies_file='cookies.json'):
+        self.refresh_margin = refresh_margin
+        self.cookies_file = cookies_file
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _entry(self, cookie):
+        key = account_key(cookie)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _TokenEntry(cookie)
+            return entry
+
+    def _is_fresh(self, entry, now=None):
+        now = now if now is not None else time.time()
+        return entry.access_token is not None and entry.expires_at is not None and now < entry.expires_at
+
+    def get_token(self, cookie, saved_access_token=None):
+        """Access token còn hạn của tài khoản; chỉ chặn khi chưa có token nào dùng được"""
+        entry = self._entry(cookie)
+        now = time.time()
+        if self._is_fresh(entry, now):
+            if entry.refresh_at is not None and now >= entry.refresh_at:
+                self._refresh_in_background(entry)
+            return entry.access_token
+
+        with entry.refresh_lock:
+            if self._is_fresh(entry):
+                return entry.access_token
+            if saved_access_token and saved_access_token != entry.failed_token:
+                if self._adopt_saved_token(entry, saved_access_token):
+                    return entry.access_token
+            self._refresh_locked(entry)
+            return entry.access_token
+
+    def refresh(self, cookie):
+        """Lấy token mới ngay (vd: nút Checker); trả về response đầy đủ của get_access_token hoặc None"""
+        entry = self._entry(cookie)
+        with entry.refresh_lock:
+            return self._refresh_locked(entry)
+
+    def refresh_after_auth_error(self, cookie, failed_token):
+        """Gọi khi request bị 401 với failed_token; trả về token mới (None nếu không lấy được)
+
+        Nhiều worker cùng gặp 401 chỉ gây ra một lần gọi API: các worker sau nhận luôn token mới.
+        """
+        entry = self._entry(cookie)
+        with entry.refresh_lock:
+            if entry.access_token and entry.access_token != failed_token and self._is_fresh(entry):
+                return entry.access_token
+            if entry.failed_token == failed_token:
+                return None  # Đã thử làm mới cho token này và thất bại
+            log.warning("Access token bị từ chối (401) - đang lấy token mới")
+            if self._refresh_locked(entry) and entry.access_token != failed_token:
+                return entry.access_token
+            entry.failed_token = failed_token
+            return None
+
+    def expires_in(self, cookie):
+        """Số giây còn lại của token đã cache, None nếu chưa có"""
+        entry = self._entry(cookie)
+        if entry.expires_at is None:
+            return None
+        return max(entry.expires_at - time.time(), 0.0)
+
+    def invalidate(self, cookie):
+        entry = self._entry(cookie)
+        with entry.refresh_lock:
+            entry.access_token = None
+            entry.expires_at = None
+            entry.refresh_at = None
+
+    def _adopt_saved_token(self, entry, saved_access_token):
+        """Dùng token trong cookies.json: tin expires_at nếu có, không rõ thì kiểm tra bằng API"""
+        expires_at = saved_token_expiry(saved_access_token, self.cookies_file)
+        if expires_at is not None:
+            if time.time() >= expires_at - self.refresh_margin:
+                return False
+        elif is_access_token_valid(saved_access_token, self.cookies_file):
+            expires_at = time.time() + UNKNOWN_EXPIRY_TTL
+        else:
+            return False
+        self._store_locked(entry, saved_access_token, expires_at, None)
+        return True
+
+    def _refresh_locked(self, entry):
+        """Gọi API lấy token mới (đang giữ entry.refresh_lock)"""
+        access_data = get_access_token(entry.cookie)
+        if not access_data or not access_data.get('access_token'):
+            return None
+        expires_in = access_data.get('expires_in_seconds') or 0
+        expires_at = time.time() + (expires_in if expires_in > 0 else UNKNOWN_EXPIRY_TTL)
+        self._store_locked(entry, access_data['access_token'], expires_at, access_data)
+        return access_data
+
+    def _store_locked(self, entry, access_token, expires_at, access_data):
+        entry.access_token = access_token
+        entry.expires_at = expires_at
+        entry.access_data = access_data
+        entry.failed_token = None
+        entry.refresh_at = self._refresh_time(expires_at)
+
+    def _refresh_time(self, expires_at):
+        """Thời điểm bắt đầu làm mới token trong nền (khi có get_token) trước khi hết hạn"""
+        now = time.time()
+        refresh_at = expires_at - self.refresh_margin
+        if refresh_at <= now:
+            # Token có thời hạn ngắn hơn refresh_margin: làm mới ở nửa thời hạn còn lại
+            refresh_at = now + max((expires_at - now) / 2, 30.0)
+        return refresh_at
+
+    def _refresh_in_background(self, entry):
+        with self._lock:
+            if entry.refreshing or time.time() < entry.background_retry_at:
+                return
+            entry.refreshing = True
+            token_before = entry.access_token
+
+        def run():
+            try:
+                with entry.refresh_lock:
+                    if entry.access_token != token_before:
+                        return  # Đã được làm mới bởi thread khác
+                    if not self._refresh_locked(entry):
+                        entry.background_retry_at = time.time() + BACKGROUND_RETRY_DELAY
+                        log.warning("Không làm mới được access token trong nền - sẽ thử lại khi cần")
+            finally:
+                with self._lock:
+                    entry.refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+# Token manager dùng chung cho toàn tiến trình
+token_manager = TokenManager()
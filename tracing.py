@@ -0,0 +1,196 @@
+"""Trace theo từng ảnh (span) để biết thời gian của một batch chậm nằm ở đâu
+
+Mỗi ảnh được chọn mẫu (sampling) sẽ có một trace; trong trace đó các giai đoạn được ghi thành span:
+random_delay, chờ limiter, HTTP request, đọc body, parse JSON + giải mã base64, chờ queue, ghi file,
+thời gian chờ retry... Cuối lượt chạy các span được ghi ra <output>/whisk_trace_<thời gian>.json
+ở định dạng Chrome trace-event (mở bằng chrome://tracing hoặc https://ui.perfetto.dev).
+
+Mặc định tắt (tỷ lệ 0): span() khi không có trace đang chạy chỉ tốn một lần đọc thread-local.
+Bật bằng --trace-rate của batch_engine hoặc biến môi trường WHISK_TRACE_RATE (0..1, vd: 0.05).
+Trace được gom chung cho cả tiến trình nên hai lượt chạy song song sẽ nằm chung một file.
+"""
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+TRACE_RATE_ENV = "WHISK_TRACE_RATE"
+TRACE_PREFIX = "whisk_trace_"
+MAX_TRACE_EVENTS = 200000  # Giới hạn bộ nhớ: quá số event này thì bỏ event mới cho tới lần ghi file
+
+def now_us():
+    """Thời điểm hiện tại (µs theo perf_counter), mốc thời gian của mọi event"""
+    return time.perf_counter() * 1e6
+
+def rate_from_env():
+    """Tỷ lệ lấy mẫu trong WHISK_TRACE_RATE (0 nếu không có hoặc sai định dạng)"""
+    try:
+        return float(os.environ.get(TRACE_RATE_ENV, "") or 0)
+    except ValueError:
+        return 0.0
+
+class Trace:
+    """Một task (ảnh) được lấy mẫu; span của nó mang args.trace = id để lọc trong trace viewer"""
+
+    __slots__ = ('id', 'name', 'args')
+
+    def __init__(self, trace_id, name, args):
+        self.id = trace_id
+        self.name = name
+        self.args = args
+
+class _NullSpan:
+    """Span rỗng khi task không được lấy mẫu"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, tracer, trace, name, args):
+        self.tracer = tracer
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self.trace, self.name, self.started, now_us(), **self.args)
+        return False
+
+    def set(self, **args):
+        """Thêm args biết được sau khi span bắt đầu (vd: outcome, số byte)"""
+        self.args.update(args)
+
+class _RootSpan(_Span):
+    """Span tự mở trace mới khi thread chưa có trace (vd: gọi generate_image trực tiếp)"""
+
+    def __enter__(self):
+        self.previous = self.tracer.activate(self.trace)
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        self.tracer.end(self.trace)
+        self.tracer.activate(self.previous)
+        return False
+
+class Tracer:
+    """Gom span của các trace được lấy mẫu (thread-safe) và ghi ra file Chrome trace-event"""
+
+    def __init__(self, rate=0.0):
+        self.rate = 0.0
+        self.configure(rate)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._events = []
+        self._threads = {}  # tid -> tên thread (metadata cho trace viewer)
+        self.dropped = 0
+        self._pid = os.getpid()
+
+    def configure(self, rate):
+        self.rate = max(0.0, min(1.0, float(rate)))
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def begin(self, name, **args):
+        """Bắt đầu trace cho một task nếu được lấy mẫu, None nếu không"""
+        if self.rate <= 0 or (self.rate < 1 and random.random() >= self.rate):
+            return None
+        trace = Trace(next(self._ids), name, args)
+        self._append({'name': name, 'cat': 'task', 'ph': 'b', 'id': trace.id, 'ts': now_us(), 'args': dict(args)})
+        return trace
+
+    def end(self, trace, **args):
+        if trace is not None:
+            self._append({'name': trace.name, 'cat': 'task', 'ph': 'e', 'id': trace.id, 'ts': now_us(), 'args': args})
+
+    def current(self):
+        return getattr(self._local, 'trace', None)
+
+    def activate(self, trace):
+        """Gắn trace vào thread hiện tại (span() trong thread sẽ thuộc trace này), trả về trace cũ"""
+        previous = getattr(self._local, 'trace', None)
+        self._local.trace = trace
+        return previous
+
+    def span(self, name, **args):
+        """Context manager đo một giai đoạn của trace đang gắn với thread (không có thì không làm gì)"""
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            return _NULL_SPAN
+        return _Span(self, trace, name, args)
+
+    def trace(self, name, **args):
+        """Như span(), nhưng tự mở trace mới (theo tỷ lệ lấy mẫu) nếu thread chưa có trace"""
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            return _Span(self, trace, name, args)
+        trace = self.begin(name, **args)
+        if trace is None:
+            return _NULL_SPAN
+        return _RootSpan(self, trace, name, args)
+
+    def record(self, trace, name, start_us, end_us, **args):
+        """Ghi một span đã biết thời điểm bắt đầu/kết thúc (µs theo perf_counter)"""
+        if trace is None:
+            return
+        args['trace'] = trace.id
+        self._append({'name': name, 'cat': 'phase', 'ph': 'X', 'ts': start_us,
+                      'dur': max(0.0, end_us - start_us), 'args': args})
+
+    def _append(self, event):
+        thread = threading.current_thread()
+        event['pid'] = self._pid
+        event['tid'] = thread.ident
+        with self._lock:
+            if len(self._events) >= MAX_TRACE_EVENTS:
+                self.dropped += 1
+                return
+            self._events.append(event)
+            self._threads.setdefault(thread.ident, thread.name)
+
+    def drain(self):
+        """Lấy toàn bộ event đang giữ (kèm metadata tên thread) và xóa bộ đệm"""
+        with self._lock:
+            events, self._events = self._events, []
+            threads, self._threads = self._threads, {}
+            dropped, self.dropped = self.dropped, 0
+        if not events:
+            return [], dropped
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid, 'args': {'name': name}}
+                    for tid, name in threads.items()]
+        return metadata + events, dropped
+
+    def write(self, output_folder):
+        """Ghi event đang giữ ra output_folder/whisk_trace_<thời gian>.json, trả về đường dẫn (None nếu không có gì)"""
+        events, dropped = self.drain()
+        if not events:
+            return None
+        os.makedirs(output_folder, exist_ok=True)
+        path = os.path.join(output_folder, f"{TRACE_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'sample_rate': self.rate, 'dropped_events': dropped}}, f, default=str)
+        return path
+
+# Tracer dùng chung cho toàn tiến trình
+tracer = Tracer(rate_from_env())